@@ -0,0 +1,251 @@
+import argparse
+import fnmatch
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SRC_DIR = os.path.join(ROOT_DIR, "src")
+FIXTURES_DIR = os.path.join(ROOT_DIR, "tests", "test_files")
+
+sys.path.insert(0, SRC_DIR)
+
+from files_converter.converter import FileConverter  # noqa: E402
+
+# Runs inside a child interpreter, one per pair, so that peak RSS is per pair and a
+# crashing backend cannot take the whole run down. CPU time includes the tools
+# (ffmpeg, Inkscape, ...) the converter spawns.
+PROBE = """
+import json, os, resource, sys, tempfile, time
+from files_converter.converter import FileConverter
+
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    tools = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + tools.ru_utime + tools.ru_stime
+
+input_path, target_format, repeat, warmup = json.loads({args!r})
+converter = FileConverter()
+samples = []
+error = None
+with tempfile.TemporaryDirectory() as output_dir:
+    output_path = os.path.join(output_dir, "output." + target_format)
+    for run in range(warmup + repeat):
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        cpu_before = cpu_seconds()
+        start = time.perf_counter()
+        try:
+            converter.convert_file(input_path, output_path, target_format)
+        except Exception as e:
+            error = f"{{type(e).__name__}}: {{e}}"
+            break
+        elapsed = time.perf_counter() - start
+        if run >= warmup:
+            samples.append({{
+                "seconds": elapsed,
+                "cpu_seconds": cpu_seconds() - cpu_before,
+                "output_bytes": os.path.getsize(output_path),
+            }})
+
+peak_rss_kb = max(
+    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+)
+print(json.dumps({{"samples": samples, "peak_rss_kb": peak_rss_kb, "error": error}}))
+"""
+
+
+def find_fixture(source_format):
+    path = os.path.join(FIXTURES_DIR, f"input.{source_format}")
+    return path if os.path.isfile(path) else None
+
+
+def benchmark_pairs(converter, patterns):
+    pairs = []
+    for source_format, targets in sorted(converter.get_conversion_matrix().items()):
+        for target_format in sorted(targets):
+            name = f"{source_format}->{target_format}"
+            if patterns and not any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns):
+                continue
+            pairs.append((source_format, target_format))
+    return pairs
+
+
+def scale_input(converter, input_path, scale, work_dir):
+    # Returns the scaled-up copy of a fixture and the factor actually applied; families
+    # we cannot grow synthetically keep the original fixture
+    if scale <= 1:
+        return input_path, 1
+    source_format = converter.registry.detect_format(input_path)
+    family = converter.get_file_type(input_path)
+    output_path = os.path.join(work_dir, f"input-x{scale}.{source_format}")
+
+    if family == "photos":
+        from PIL import Image
+
+        with Image.open(input_path) as image:
+            image.load()
+            scaled = image.resize((image.width * scale, image.height * scale))
+            scaled.save(output_path, format=image.format)
+        return output_path, scale
+
+    if source_format in ("txt", "csv"):
+        with open(input_path, "rb") as src, open(output_path, "wb") as dst:
+            content = src.read()
+            for _ in range(scale):
+                dst.write(content)
+        return output_path, scale
+
+    if family in ("videos", "audio") and shutil.which("ffmpeg"):
+        # Loop the fixture without re-encoding it
+        completed = subprocess.run(
+            [
+                "ffmpeg",
+                "-y",
+                "-loglevel",
+                "error",
+                "-stream_loop",
+                str(scale - 1),
+                "-i",
+                input_path,
+                "-c",
+                "copy",
+                output_path,
+            ],
+            capture_output=True,
+        )
+        if completed.returncode == 0:
+            return output_path, scale
+
+    return input_path, 1
+
+
+def measure(input_path, target_format, repeat, warmup, timeout):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([SRC_DIR, env.get("PYTHONPATH", "")])
+    args = json.dumps([input_path, target_format, repeat, warmup])
+    try:
+        completed = subprocess.run(
+            [sys.executable, "-c", PROBE.format(args=args)],
+            env=env,
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        return {"samples": [], "peak_rss_kb": 0, "error": f"timed out after {timeout} seconds"}
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode != 0 or not lines:
+        stderr = completed.stderr.strip().splitlines()
+        error = stderr[-1] if stderr else f"exit status {completed.returncode}"
+        return {"samples": [], "peak_rss_kb": 0, "error": error}
+    return json.loads(lines[-1])
+
+
+def summarize(measurement, input_path, scale):
+    samples = measurement["samples"]
+    summary = {
+        "input_bytes": os.path.getsize(input_path),
+        "scale": scale,
+        "runs": len(samples),
+        "peak_rss_kb": measurement["peak_rss_kb"],
+        "error": measurement["error"],
+    }
+    if samples:
+        summary.update(
+            {
+                "seconds_min": min(sample["seconds"] for sample in samples),
+                "seconds_median": statistics.median(sample["seconds"] for sample in samples),
+                "cpu_seconds_median": statistics.median(
+                    sample["cpu_seconds"] for sample in samples
+                ),
+                "output_bytes": samples[-1]["output_bytes"],
+            }
+        )
+    return summary
+
+
+def compare(report, baseline, threshold):
+    # A pair regresses when its median wall time grew by more than `threshold`
+    regressions = {}
+    for name, result in report["pairs"].items():
+        previous = baseline.get("pairs", {}).get(name)
+        if not previous or "seconds_median" not in result or "seconds_median" not in previous:
+            continue
+        if previous.get("scale") != result.get("scale") or not previous["seconds_median"]:
+            continue
+        ratio = result["seconds_median"] / previous["seconds_median"]
+        result["baseline_ratio"] = round(ratio, 3)
+        if ratio > 1 + threshold:
+            regressions[name] = result["baseline_ratio"]
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure every conversion pair on the test fixtures."
+    )
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="measured runs per pair")
+    parser.add_argument(
+        "--warmup", type=int, default=1, help="unmeasured runs per pair (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--scale",
+        type=int,
+        default=1,
+        help="grow inputs synthetically by this factor where possible (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=600, help="seconds allowed per pair (default: %(default)s)"
+    )
+    parser.add_argument("-o", "--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="flag pairs whose median time grew by more than this fraction (default: %(default)s)",
+    )
+    parser.add_argument(
+        "pairs", nargs="*", metavar="PAIR", help="subset of pairs, e.g. 'jpg->png' or 'mp4->*'"
+    )
+    args = parser.parse_args(argv)
+
+    converter = FileConverter()
+    report = {"python": sys.version.split()[0], "scale": args.scale, "pairs": {}}
+    with tempfile.TemporaryDirectory() as work_dir:
+        scaled_inputs = {}
+        for source_format, target_format in benchmark_pairs(converter, args.pairs):
+            name = f"{source_format}->{target_format}"
+            fixture = find_fixture(source_format)
+            if fixture is None:
+                report["pairs"][name] = {"error": "no fixture in tests/test_files"}
+                continue
+            if source_format not in scaled_inputs:
+                scaled_inputs[source_format] = scale_input(converter, fixture, args.scale, work_dir)
+            input_path, scale = scaled_inputs[source_format]
+            measurement = measure(input_path, target_format, args.repeat, args.warmup, args.timeout)
+            report["pairs"][name] = summarize(measurement, input_path, scale)
+            print(name, json.dumps(report["pairs"][name]), file=sys.stderr)
+
+    regressions = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        report["regressions"] = regressions
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SRC_DIR = os.path.join(ROOT_DIR, "src")
+
+# Each target is imported in a fresh interpreter so that nothing is cached
+TARGETS = {
+    "converter": "import files_converter.converter",
+    "cli": "import files_converter.cli",
+    "nautilus_extension": "import files_converter_extension",
+}
+
+# Runs inside the child interpreter: time the import and report RSS before/after
+PROBE = """
+import json, sys, time
+
+def rss_kb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+rss_before = rss_kb()
+modules_before = set(sys.modules)
+start = time.perf_counter()
+try:
+    {statement}
+    error = None
+except Exception as e:
+    error = f"{{type(e).__name__}}: {{e}}"
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": elapsed,
+    "rss_kb": rss_kb(),
+    "rss_delta_kb": rss_kb() - rss_before,
+    "modules_loaded": len(set(sys.modules) - modules_before),
+    "error": error,
+}}))
+"""
+
+
+def measure(statement):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [SRC_DIR, os.path.join(SRC_DIR, "files_converter"), env.get("PYTHONPATH", "")]
+    )
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    completed = subprocess.run(
+        [sys.executable, "-c", PROBE.format(statement=statement)],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def summarize(samples):
+    errors = {sample["error"] for sample in samples if sample["error"]}
+    return {
+        "runs": len(samples),
+        "seconds_min": min(sample["seconds"] for sample in samples),
+        "seconds_median": statistics.median(sample["seconds"] for sample in samples),
+        "rss_kb_max": max(sample["rss_kb"] for sample in samples),
+        "rss_delta_kb_max": max(sample["rss_delta_kb"] for sample in samples),
+        "modules_loaded": max(sample["modules_loaded"] for sample in samples),
+        "error": errors.pop() if errors else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure cold import time and RSS.")
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="runs per target")
+    parser.add_argument("-o", "--output", help="write the JSON report to this file")
+    parser.add_argument("targets", nargs="*", help=f"subset of: {', '.join(TARGETS)}")
+    args = parser.parse_args(argv)
+    unknown = set(args.targets) - set(TARGETS)
+    if unknown:
+        parser.error(f"unknown targets: {', '.join(sorted(unknown))}")
+
+    report = {
+        "python": sys.version.split()[0],
+        "targets": {
+            name: summarize([measure(TARGETS[name]) for _ in range(args.repeat)])
+            for name in (args.targets or TARGETS)
+        },
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -65,6 +65,10 @@ setup(
         "packaging",
         "requests",
     ],
+    extras_require={
+        # wav, flac and ogg conversions without an ffmpeg process
+        "native-audio": ["soundfile"],
+    },
     entry_points={
         "console_scripts": [
             "files-converter=files_converter.__main__:main",
@@ -1,4 +1,20 @@
-from .ui import main
+import sys
+
+# Commands handled by the headless CLI; anything else opens the GTK window.
+# Both imports are deferred so that the CLI never loads gi.
+CLI_COMMANDS = ("convert", "watch")
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        from .cli import main as cli_main
+
+        sys.exit(cli_main(sys.argv[1:]))
+
+    from .ui import main as ui_main
+
+    ui_main()
+
 
 if __name__ == "__main__":
     main()
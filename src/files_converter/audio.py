@@ -0,0 +1,117 @@
+import contextlib
+
+# soundfile (libsndfile) is optional and imported where it is used; without it, or
+# for files it cannot read, every conversion goes through ffmpeg
+
+# ffmpeg muxer names, where they differ from the extension
+MUXERS = {"aac": "adts"}
+# Encoders for targets whose muxer would otherwise get ffmpeg's default for it
+DEFAULT_CODECS = {"aac": "aac"}
+# Names accepted in options["encoder_options"][target], and the ffmpeg options they
+# stand for; any other name is handed to ffmpeg as it is
+OPTION_NAMES = {"codec": "c:a", "bitrate": "b:a", "sample_rate": "ar", "channels": "ac"}
+
+
+def muxer(target_format):
+    return MUXERS.get(target_format, target_format)
+
+
+def output_options(target_format, options):
+    # ffmpeg output options for the target, e.g. {"mp3": {"bitrate": "192k"}} in
+    # options["encoder_options"] gives -b:a 192k
+    output_kwargs = {"format": muxer(target_format)}
+    if target_format in DEFAULT_CODECS:
+        output_kwargs["c:a"] = DEFAULT_CODECS[target_format]
+    for name, value in options.get("encoder_options", {}).get(target_format, {}).items():
+        output_kwargs[OPTION_NAMES.get(name, name)] = value
+    return output_kwargs
+
+
+def duration(probe):
+    # Seconds of audio, 0 when ffprobe could not tell
+    try:
+        return float(probe.get("format", {}).get("duration", 0))
+    except ValueError:
+        return 0.0
+
+
+# Targets libsndfile writes itself, with no ffmpeg process: its container name and the
+# sample formats it can store, best first
+NATIVE_TARGETS = {
+    "wav": ("WAV", ("PCM_16", "PCM_24", "PCM_32", "FLOAT", "DOUBLE", "PCM_U8")),
+    "flac": ("FLAC", ("PCM_16", "PCM_24", "PCM_S8")),
+    "ogg": ("OGG", ("VORBIS",)),
+}
+NATIVE_SOURCES = {"wav", "flac", "ogg"}
+# Frames read and written at a time, which bounds the memory a conversion takes
+BLOCK_FRAMES = 65536
+# What soundfile raises when libsndfile cannot write a target, e.g. a sample rate or
+# channel count FLAC does not take (LibsndfileError is a RuntimeError)
+NATIVE_ERRORS = (RuntimeError, ValueError)
+# Tags libsndfile keeps in all of wav, flac and ogg
+NATIVE_TAGS = ("title", "artist", "album", "date", "comment", "genre", "tracknumber", "copyright")
+
+
+def can_convert_natively(source_format, target_format, options):
+    # Encoder options are ffmpeg's, so asking for any of them means ffmpeg
+    return (
+        source_format in NATIVE_SOURCES
+        and target_format in NATIVE_TARGETS
+        and not options.get("encoder_options", {}).get(target_format)
+    )
+
+
+def open_native(input_path):
+    # The input opened with soundfile, or None to leave it to ffmpeg
+    try:
+        import soundfile
+    except ImportError:
+        return None
+    try:
+        return soundfile.SoundFile(input_path)
+    except (RuntimeError, TypeError):
+        return None
+
+
+def native_subtype(target_format, source_subtype):
+    # The source's sample format if the target stores it, else the closest one that
+    # keeps at least as much precision
+    subtypes = NATIVE_TARGETS[target_format][1]
+    if source_subtype in subtypes:
+        return source_subtype
+    if "PCM_24" in subtypes and source_subtype in ("PCM_32", "FLOAT", "DOUBLE"):
+        return "PCM_24"
+    return subtypes[0]
+
+
+def convert_in_blocks(source, outputs, on_block=None):
+    # Reads the source once for all (target_format, output_path) pairs
+    import soundfile
+
+    # Whole numbers stay whole numbers on the way through; float samples stay float
+    dtype = "float64" if source.subtype in ("FLOAT", "DOUBLE", "VORBIS", "OPUS") else "int32"
+    with contextlib.ExitStack() as stack:
+        files = []
+        for target_format, output_path in outputs:
+            output = stack.enter_context(
+                soundfile.SoundFile(
+                    output_path,
+                    "w",
+                    samplerate=source.samplerate,
+                    channels=source.channels,
+                    format=NATIVE_TARGETS[target_format][0],
+                    subtype=native_subtype(target_format, source.subtype),
+                )
+            )
+            for tag in NATIVE_TAGS:
+                value = getattr(source, tag, "")
+                if value:
+                    setattr(output, tag, value)
+            files.append(output)
+        done = 0
+        for block in source.blocks(blocksize=BLOCK_FRAMES, dtype=dtype, always_2d=True):
+            for output in files:
+                output.write(block)
+            done += len(block)
+            if on_block is not None and source.frames:
+                on_block(min(done / source.frames, 1.0))
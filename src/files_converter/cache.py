@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import tempfile
+
+from .fileops import clone_file
+from .registry import registry
+
+# Bump when converter output changes in a way that makes old cache entries stale
+CACHE_VERSION = 1
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+# Entries are also stored by other worker processes, so the cache directory is scanned
+# again after every max_size / RESCAN_FRACTION bytes stored by this one
+RESCAN_FRACTION = 16
+
+
+def default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "files-converter", "conversions")
+
+
+class ConversionCache:
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Running total of the entries' sizes, so a long batch is evicted from as it
+        # grows rather than only when pruned afterwards; None until scanned
+        self._size = None
+        self._stored_since_scan = 0
+
+    def make_key(self, input_path, target_format, options=None):
+        digest = hashlib.blake2b(digest_size=32)
+        with open(input_path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        # The same bytes under another extension go through another converter
+        params = json.dumps(
+            {
+                "version": CACHE_VERSION,
+                "source": registry.detect_format(input_path),
+                "target": target_format,
+                "options": options or {},
+            },
+            sort_keys=True,
+        )
+        digest.update(params.encode("utf-8"))
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key, output_path):
+        entry_path = self._entry_path(key)
+        try:
+            clone_file(entry_path, output_path)
+            # The modification time doubles as the last-used time for LRU eviction
+            os.utime(entry_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key, output_path):
+        if not os.path.isfile(output_path):
+            return False
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        # Write under a temporary name so concurrent workers never see a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path), suffix=".tmp")
+        os.close(fd)
+        try:
+            replaced = os.path.getsize(entry_path) if os.path.exists(entry_path) else 0
+            clone_file(output_path, temp_path)
+            os.replace(temp_path, entry_path)
+            added = os.path.getsize(entry_path) - replaced
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        self._stored_since_scan += added
+        if self._size is not None:
+            self._size += added
+        if (
+            self._size is None
+            or self._size > self.max_size
+            or self._stored_since_scan > self.max_size / RESCAN_FRACTION
+        ):
+            self.prune()
+        return True
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for bucket in os.scandir(self.cache_dir):
+            if not bucket.is_dir():
+                continue
+            for entry in os.scandir(bucket.path):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        return sum(size for _mtime, size, _path in self._entries())
+
+    def prune(self):
+        entries = self._entries()
+        total = sum(size for _mtime, size, _path in entries)
+        # Least recently used entries go first
+        for _mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            self.evictions += 1
+        self._size = total
+        self._stored_since_scan = 0
+        return total
+
+    def clear(self):
+        for _mtime, _size, path in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "size": self.size(),
+            "max_size": self.max_size,
+        }
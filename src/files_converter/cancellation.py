@@ -0,0 +1,81 @@
+import gettext
+import os
+import signal
+import subprocess
+import threading
+import time
+
+_ = gettext.gettext
+
+# How long a tool gets to exit after SIGTERM before it is killed outright
+KILL_GRACE_PERIOD = 5.0
+WATCHDOG_INTERVAL = 0.25
+
+
+class ConversionCancelled(Exception):
+    pass
+
+
+class ConversionTimeout(ConversionCancelled):
+    pass
+
+
+class CancellationToken:
+    def __init__(self, event=None, timeout=None):
+        # The event may be a multiprocessing.Event shared by all pool workers
+        self.event = event if event is not None else threading.Event()
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout else None
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def wait(self, interval):
+        remaining = self.remaining()
+        if remaining is not None:
+            interval = min(interval, remaining)
+        return self.event.wait(interval)
+
+    def check(self):
+        if self.cancelled:
+            raise ConversionCancelled(_("Conversion cancelled"))
+        if self.expired:
+            raise ConversionTimeout(_("Conversion timed out after {} seconds").format(self.timeout))
+
+
+def kill_process_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(KILL_GRACE_PERIOD)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class ProcessWatchdog(threading.Thread):
+    def __init__(self, process, token):
+        super().__init__(daemon=True)
+        self.process = process
+        self.token = token
+
+    def run(self):
+        while self.process.poll() is None:
+            if self.token.cancelled or self.token.expired:
+                kill_process_group(self.process)
+                return
+            self.token.wait(WATCHDOG_INTERVAL)
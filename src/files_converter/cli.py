@@ -0,0 +1,515 @@
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+from .cache import DEFAULT_MAX_SIZE, ConversionCache
+from .converter import FileConverter
+from .engine import ConversionEngine, ConversionJob, OutputClaims, build_output_path
+from .events import JsonLinesSink, PrometheusSink
+from .metadata import MetadataCache
+from .photos import DEFAULT_PRESET, ENCODER_PRESETS, encoder_format
+from .scanner import get_supported_extensions, scan_paths
+from .scheduler import COST_CLASSES, CostClass
+from .video import VIDEO_PROFILES
+
+
+def add_engine_arguments(parser):
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=0,
+        help="number of parallel conversions (default: one per CPU core)",
+    )
+    parser.add_argument(
+        "-o", "--output-dir", help="directory for converted files (default: next to the input)"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="always convert, bypassing the output cache"
+    )
+    parser.add_argument("--cache-dir", help="directory of the output cache")
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_MAX_SIZE // 1024 // 1024,
+        metavar="MB",
+        help="size limit of the output cache in MB (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        help="give up on a single conversion after this long (default: no limit)",
+    )
+    parser.add_argument(
+        "--timeout-for",
+        action="append",
+        default=[],
+        dest="family_timeouts",
+        metavar="FAMILY=SECONDS",
+        help="time limit for one family of formats, e.g. 'videos=3600' (repeatable)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        metavar="MB",
+        help="convert bigger uncompressed images in strips to stay within MB of memory",
+    )
+    resize = parser.add_mutually_exclusive_group()
+    resize.add_argument(
+        "--max-size",
+        type=int,
+        metavar="PX",
+        help="shrink photos so that their longer side is at most PX pixels",
+    )
+    resize.add_argument(
+        "--scale", type=float, metavar="FACTOR", help="resize photos by FACTOR, e.g. 0.5"
+    )
+    resize.add_argument(
+        "--thumbnail",
+        type=int,
+        metavar="PX",
+        help="make PX x PX photo thumbnails, cropping the longer side",
+    )
+    parser.add_argument(
+        "--preset",
+        choices=sorted(ENCODER_PRESETS),
+        help="trade photo encoding time against file size (default: %s)" % DEFAULT_PRESET,
+    )
+    parser.add_argument(
+        "--encoder-option",
+        action="append",
+        default=[],
+        dest="encoder_options",
+        metavar="FORMAT.NAME=VALUE",
+        help="override one photo save or audio encoder option, e.g. 'jpeg.quality=90' or "
+        "'mp3.bitrate=192k' (repeatable)",
+    )
+    parser.add_argument(
+        "--reencode",
+        action="store_true",
+        help="decode and encode even between names of one format, e.g. jpg to jpeg",
+    )
+    parser.add_argument(
+        "--passthrough",
+        choices=("copy", "hardlink", "rename"),
+        default="copy",
+        help="how files that need no conversion are written; 'rename' moves the input "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--video-profile",
+        choices=sorted(VIDEO_PROFILES),
+        help="encoder, quality, size and thread settings for re-encoded videos "
+        "(default: ffmpeg's own)",
+    )
+    parser.add_argument(
+        "--video-segments",
+        type=int,
+        metavar="N",
+        help="encode long videos as N keyframe-aligned pieces in parallel, then join them",
+    )
+    parser.add_argument(
+        "--progress-interval",
+        type=float,
+        metavar="SECONDS",
+        help="how often ffmpeg reports encoding progress (default: every 0.5 seconds)",
+    )
+    parser.add_argument(
+        "--inkscape-shells",
+        type=int,
+        metavar="N",
+        help="vector conversions at once, each through its own running Inkscape "
+        f"(default: {COST_CLASSES['vectors'].max_concurrent})",
+    )
+    parser.add_argument(
+        "--metadata-cache",
+        metavar="FILE",
+        help="keep file sizes and video probes in FILE, so later runs skip ffprobe "
+        "for files that did not change",
+    )
+    parser.add_argument(
+        "--events",
+        metavar="FILE",
+        help="append every job and stage event to FILE as JSON lines",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="FILE",
+        help="keep Prometheus text-format metrics in FILE (e.g. for a textfile collector)",
+    )
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="files-converter",
+        description="Convert files without opening the graphical interface.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert = subparsers.add_parser("convert", help="convert files and folders to a format")
+    convert.add_argument("paths", nargs="+", metavar="PATH", help="files or folders to convert")
+    convert.add_argument(
+        "--to",
+        required=True,
+        dest="target_format",
+        help="target format, or several separated by commas (e.g. 'jpg,webp'), all made "
+        "from one read of each input",
+    )
+    convert.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="replace output files that already exist; outputs never replace an input",
+    )
+    add_engine_arguments(convert)
+
+    watch = subparsers.add_parser(
+        "watch", help="watch folders and convert new or modified files matching rules"
+    )
+    watch.add_argument("paths", nargs="+", metavar="DIR", help="folders to watch recursively")
+    watch.add_argument(
+        "-r",
+        "--rule",
+        action="append",
+        required=True,
+        dest="rules",
+        metavar="PATTERN=FORMAT",
+        help="convert files matching PATTERN to FORMAT, e.g. '*.mov=mp4' (repeatable)",
+    )
+    watch.add_argument(
+        "--debounce",
+        type=float,
+        default=2.0,
+        metavar="SECONDS",
+        help="wait until a file has not changed for this long (default: %(default)s)",
+    )
+    watch.add_argument(
+        "--queue-size",
+        type=int,
+        default=1000,
+        help="maximum number of files waiting for a worker (default: %(default)s)",
+    )
+    watch.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="replace output files that already exist; outputs never replace a watched "
+        "file that a rule converts",
+    )
+    add_engine_arguments(watch)
+    return parser
+
+
+def parse_timeouts(specs):
+    timeouts = {}
+    for spec in specs:
+        family, _sep, seconds = spec.partition("=")
+        try:
+            timeouts[family.strip()] = float(seconds)
+        except ValueError:
+            raise ValueError(f"Invalid timeout {spec!r}, expected e.g. 'videos=3600'")
+    return timeouts
+
+
+def parse_encoder_options(specs):
+    encoder_options = {}
+    for spec in specs:
+        name, _sep, value = spec.partition("=")
+        target_format, _sep, option = name.strip().partition(".")
+        if not target_format or not option or not value:
+            raise ValueError(f"Invalid encoder option {spec!r}, expected e.g. 'jpeg.quality=90'")
+        try:
+            # Numbers and true/false as such, anything else as a string
+            value = json.loads(value)
+        except ValueError:
+            pass
+        encoder_options.setdefault(encoder_format(target_format), {})[option] = value
+    return encoder_options
+
+
+def make_engine(args):
+    cache = None
+    if not args.no_cache:
+        cache = ConversionCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+    cost_classes = {}
+    if args.inkscape_shells is not None:
+        if args.inkscape_shells < 1:
+            raise ValueError(f"Invalid number of Inkscape shells: {args.inkscape_shells}")
+        vectors = COST_CLASSES["vectors"]
+        cost_classes["vectors"] = CostClass(
+            vectors.weight, vectors.threads, max_concurrent=args.inkscape_shells
+        )
+    return ConversionEngine(
+        max_workers=args.jobs or None,
+        cache=cache,
+        timeouts=parse_timeouts(args.family_timeouts),
+        default_timeout=args.timeout,
+        cost_classes=cost_classes,
+        metadata=MetadataCache(args.metadata_cache),
+    )
+
+
+def open_event_sinks(args):
+    sinks = []
+    if args.events:
+        sinks.append(JsonLinesSink(args.events))
+    if args.metrics:
+        sinks.append(PrometheusSink(args.metrics))
+    return sinks
+
+
+def dispatch_events(sinks):
+    if not sinks:
+        return None
+
+    def on_event(event):
+        for sink in sinks:
+            sink(event)
+
+    return on_event
+
+
+def close_event_sinks(sinks):
+    for sink in sinks:
+        sink.close()
+
+
+def job_options(args):
+    options = {}
+    if args.memory_budget:
+        options["memory_budget"] = args.memory_budget * 1024 * 1024
+    for name in ("max_size", "scale", "thumbnail"):
+        if getattr(args, name):
+            options[name] = getattr(args, name)
+    if args.reencode:
+        options["reencode"] = True
+    if args.passthrough != "copy":
+        options["passthrough"] = args.passthrough
+    if args.preset:
+        options["preset"] = args.preset
+    if args.encoder_options:
+        options["encoder_options"] = parse_encoder_options(args.encoder_options)
+    if args.video_profile:
+        options["video_profile"] = args.video_profile
+    if args.video_segments:
+        if args.video_segments < 1:
+            raise ValueError(f"Invalid number of video segments: {args.video_segments}")
+        options["segments"] = args.video_segments
+    if args.progress_interval:
+        options["progress_interval"] = args.progress_interval
+    return options
+
+
+def result_record(result):
+    job = result.job
+    record = {
+        "input": job.input_path,
+        "output": job.output_path,
+        "target": job.target_format,
+        "status": result.status,
+        "seconds": round(result.elapsed, 6),
+        "cached": bool(result.cached),
+    }
+    if job.extra_outputs:
+        record["outputs"] = [
+            {"target": target_format, "output": output_path}
+            for target_format, output_path in job.outputs
+        ]
+    record["bytes_in"] = os.path.getsize(job.input_path) if os.path.exists(job.input_path) else 0
+    if result.success:
+        record["bytes_out"] = sum(
+            os.path.getsize(output_path) if os.path.exists(output_path) else 0
+            for _target_format, output_path in job.outputs
+        )
+    else:
+        record["error"] = result.error
+    return record
+
+
+def emit(record, stream):
+    stream.write(json.dumps(record) + "\n")
+    stream.flush()
+
+
+def parse_target_formats(spec):
+    target_formats = []
+    for target_format in spec.split(","):
+        target_format = target_format.strip().lower().lstrip(".")
+        if target_format and target_format not in target_formats:
+            target_formats.append(target_format)
+    return target_formats
+
+
+def collect_jobs(
+    converter, paths, target_formats, output_dir, stream, options=None, overwrite=False
+):
+    # One job per input, for every target it can be converted to and whose output is
+    # free to write
+    jobs = []
+    skipped = 0
+    supported_extensions = get_supported_extensions(converter.supported_formats)
+    input_paths = list(scan_paths(paths, supported_extensions))
+    claims = OutputClaims(input_paths, overwrite)
+    for input_path in input_paths:
+        outputs = []
+        for target_format in target_formats:
+            record = {"input": input_path, "target": target_format, "status": "skipped"}
+            if not converter.can_convert(input_path, target_format):
+                emit(record, stream)
+                skipped += 1
+                continue
+            output_path = build_output_path(input_path, output_dir, target_format)
+            reason = claims.claim(output_path)
+            if reason is not None:
+                emit(dict(record, output=output_path, error=reason), stream)
+                skipped += 1
+                continue
+            outputs.append((target_format, output_path))
+        if outputs:
+            (target_format, output_path), *extra_outputs = outputs
+            jobs.append(
+                ConversionJob(
+                    input_path,
+                    output_path,
+                    target_format,
+                    options=options,
+                    extra_outputs=extra_outputs,
+                )
+            )
+    return jobs, skipped
+
+
+def run_convert(args, stream):
+    start = time.monotonic()
+    converter = FileConverter()
+    target_formats = parse_target_formats(args.target_format)
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    try:
+        options = job_options(args)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    jobs, skipped = collect_jobs(
+        converter, args.paths, target_formats, args.output_dir, stream, options, args.overwrite
+    )
+    totals = {"files": len(jobs), "succeeded": 0, "failed": 0, "cancelled": 0, "skipped": skipped}
+    bytes_in = 0
+    bytes_out = 0
+
+    def on_result(result):
+        nonlocal bytes_in, bytes_out
+        record = result_record(result)
+        bytes_in += record["bytes_in"]
+        if result.success:
+            totals["succeeded"] += 1
+            bytes_out += record["bytes_out"]
+        elif result.status == "cancelled":
+            totals["cancelled"] += 1
+        else:
+            totals["failed"] += 1
+        emit(record, stream)
+
+    try:
+        engine = make_engine(args)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    # Ctrl+C or SIGTERM stops the batch: queued files are dropped and running tools killed
+    previous_handlers = {}
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            previous_handlers[signum] = signal.signal(signum, lambda signum, frame: engine.cancel())
+    sinks = open_event_sinks(args)
+    try:
+        engine.run(jobs, on_result=on_result, on_event=dispatch_events(sinks))
+    finally:
+        close_event_sinks(sinks)
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+    elapsed = time.monotonic() - start
+    totals.update(
+        {
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "seconds": round(elapsed, 6),
+            "files_per_second": round(totals["files"] / elapsed, 3) if elapsed else 0.0,
+            "mb_per_second": round(bytes_in / 1024 / 1024 / elapsed, 3) if elapsed else 0.0,
+        }
+    )
+    if engine.cache is not None:
+        totals["cache"] = engine.cache.stats()
+    emit({"summary": totals}, stream)
+    if engine.cancelled:
+        return 130
+    return 1 if totals["failed"] else 0
+
+
+def run_watch(args, stream):
+    from .watcher import ConversionRule, WatchDaemon
+
+    try:
+        rules = [ConversionRule.parse(spec) for spec in args.rules]
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    try:
+        engine = make_engine(args)
+        options = job_options(args)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    sinks = open_event_sinks(args)
+    daemon = WatchDaemon(
+        args.paths,
+        rules,
+        output_dir=args.output_dir,
+        engine=engine,
+        debounce=args.debounce,
+        queue_size=args.queue_size,
+        options=options,
+        overwrite=args.overwrite,
+        on_result=lambda result: emit(result_record(result), stream),
+        on_skip=lambda input_path, target_format, output_path, reason: emit(
+            {
+                "input": input_path,
+                "target": target_format,
+                "status": "skipped",
+                "output": output_path,
+                "error": reason,
+            },
+            stream,
+        ),
+        on_event=dispatch_events(sinks),
+    )
+    # Stop cleanly under service managers, letting in-flight conversions finish
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_event_sinks(sinks)
+    return 0
+
+
+def main(argv=None, stream=None):
+    args = build_parser().parse_args(argv)
+    stream = stream or sys.stdout
+    if args.command == "convert":
+        return run_convert(args, stream)
+    if args.command == "watch":
+        return run_watch(args, stream)
+    return 2
@@ -1,97 +1,369 @@
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import os
-import re
 import shutil
 import subprocess
+import sys
 import tarfile
+import tempfile
+import threading
+import time
 import zipfile
 import gettext
 
-import docx
-import ffmpeg
-import PyPDF2
-from pdf2docx import Converter
-from striprtf.striprtf import rtf_to_text
-from odf.opendocument import OpenDocumentText, load
-from odf import teletype
-from odf.text import P, Span
-from odf.style import Style, TextProperties
-from PIL import Image
+from .cancellation import ConversionCancelled, ProcessWatchdog, kill_process_group
+from .fileops import place_file
+from .metadata import MetadataCache
+from .registry import registry as default_registry
+
+# Conversion backends (Pillow, ffmpeg-python, python-docx, PyPDF2, pdf2docx,
+# striprtf, odfpy) are imported inside the methods that use them, so that only
+# the families a user actually converts pay for loading them.
 
 _ = gettext.gettext
 
+SUPPORTED_FORMATS = {
+    "photos": ["jpg", "jpeg", "png", "gif", "bmp", "tiff", "webp"],
+    "videos": ["mp4", "avi", "mov", "mkv", "webm"],
+    "vectors": ["svg", "eps"],
+    "audio": ["mp3", "wav", "ogg", "flac", "aac"],
+    "documents": ["pdf", "docx", "txt", "rtf", "odt"],
+    "archives": ["zip", "tar", "tar.gz", "tar.xz", "tar.bz2", "rar", "7z"],
+    "ebooks": ["epub", "mobi", "azw3", "fb2", "txt", "rtf", "pdf"],
+}
+
+# Lines of ffmpeg's own output kept for the message when it fails
+FFMPEG_OUTPUT_LINES = 20
+
+# Extensions naming the same format; converting between them copies the file
+FORMAT_ALIASES = {"jpeg": "jpg"}
+
 
 class FileConverter:
-    def __init__(self):
-        self.supported_formats = {
-            "photos": ["jpg", "jpeg", "png", "gif", "bmp", "tiff", "webp"],
-            "videos": ["mp4", "avi", "mov", "mkv", "webm"],
-            "vectors": ["svg", "eps"],
-            "audio": ["mp3", "wav", "ogg", "flac", "aac"],
-            "documents": ["pdf", "docx", "txt", "rtf", "odt"],
-            "archives": ["zip", "tar", "tar.gz", "tar.xz", "tar.bz2", "rar", "7z"],
-            "ebooks": ["epub", "mobi", "azw3", "fb2", "txt", "rtf", "pdf"],
-        }
+    def __init__(self, registry=None, metadata=None):
+        self.registry = registry or default_registry
+        self.metadata = metadata if metadata is not None else MetadataCache()
+        self.registry.load_plugins()
+        self.supported_formats = self.registry.families()
+        self.progress_callback = None
+        self.cancel_token = None
+        self.threads = None
+        self.event_callback = None
+        self._stage_tool = None
+        self.options = {}
 
     def get_file_type(self, file_path):
-        extension = ".".join(os.path.basename(file_path).split(os.extsep)[1:])
-        for file_type, formats in self.supported_formats.items():
-            if extension in formats:
-                return file_type
-        return None
+        return self.registry.get_family(self.registry.detect_format(file_path))
 
     def get_target_formats(self, file_type):
         return self.supported_formats.get(file_type, [])
 
     def get_current_format(self, file_path):
-        return os.path.splitext(file_path)[1][1:].lower()
-
-    def convert_file(self, input_path, output_path, target_format, progress_callback=None):
+        fmt = self.registry.detect_format(file_path)
+        if fmt is None:
+            return os.path.splitext(file_path)[1][1:].lower()
+        return fmt
+
+    def get_conversion_targets(self, file_path):
+        return self.registry.get_targets(self.registry.detect_format(file_path))
+
+    def get_conversion_matrix(self):
+        return self.registry.conversions()
+
+    def can_convert(self, file_path, target_format):
+        source_format = self.registry.detect_format(file_path)
+        return self.registry.get_converter(source_format, target_format) is not None
+
+    def convert_file(
+        self,
+        input_path,
+        output_path,
+        target_format,
+        progress_callback=None,
+        options=None,
+        cancel_token=None,
+        threads=None,
+        event_callback=None,
+    ):
+        self.convert_file_to_many(
+            input_path,
+            [(target_format, output_path)],
+            progress_callback,
+            options=options,
+            cancel_token=cancel_token,
+            threads=threads,
+            event_callback=event_callback,
+        )
+
+    def convert_file_to_many(
+        self,
+        input_path,
+        outputs,
+        progress_callback=None,
+        options=None,
+        cancel_token=None,
+        threads=None,
+        event_callback=None,
+    ):
+        # outputs are (target_format, output_path) pairs. Targets with a handler that
+        # can write several outputs from one decode of the input are converted together.
         self.progress_callback = progress_callback
-        file_type = self.get_file_type(input_path)
-
-        if file_type == "photos":
-            self._convert_photo(input_path, output_path, target_format)
-        elif file_type == "videos":
-            self._convert_video(input_path, output_path, target_format)
-        elif file_type == "vectors":
-            self._convert_vector(input_path, output_path, target_format)
-        elif file_type == "audio":
-            self._convert_audio(input_path, output_path, target_format)
-        elif file_type == "documents":
-            self._convert_document(input_path, output_path, target_format)
-        elif file_type == "archives":
-            self._convert_archive(input_path, output_path, target_format)
-        elif file_type == "ebooks":
-            self._convert_ebook(input_path, output_path, target_format)
-        else:
-            raise ValueError(_(f"Unsupported file type: {file_type}"))
+        self.options = dict(options or {})
+        self.cancel_token = cancel_token
+        self.threads = threads
+        # Called as event_callback(stage, seconds, tool) after each stage completes
+        self.event_callback = event_callback
+        self._check_cancelled()
+        source_format = self.registry.detect_format(input_path)
+        groups = {}
+        copies = []
+        for target_format, output_path in outputs:
+            handler = self.registry.get_converter(source_format, target_format)
+            if handler is None:
+                raise ValueError(
+                    _("Unsupported conversion: {} to {}").format(source_format, target_format)
+                )
+            if (
+                os.path.abspath(output_path) != os.path.abspath(input_path)
+                and os.path.exists(output_path)
+                and os.path.samefile(input_path, output_path)
+            ):
+                # Hardlinked to the input by an earlier passthrough; writing through the
+                # link would overwrite the input too
+                os.remove(output_path)
+            if self.is_passthrough(input_path, target_format, self.options):
+                copies.append(output_path)
+            else:
+                groups.setdefault(handler, []).append((target_format, output_path))
+
+        parts = []
+        for handler, group in groups.items():
+            fan_out = FAN_OUT_CONVERTERS.get(handler)
+            if fan_out is not None and len(group) > 1:
+                parts.append(functools.partial(fan_out, self, input_path, group))
+            else:
+                parts += [
+                    functools.partial(handler, self, input_path, output_path, target_format)
+                    for target_format, output_path in group
+                ]
+        # Copies come last, and only the last may move the input away
+        method = self.options.get("passthrough", "copy")
+        for index, output_path in enumerate(copies):
+            last = index == len(copies) - 1
+            parts.append(
+                functools.partial(
+                    self._place_file,
+                    input_path,
+                    output_path,
+                    method if last or method != "rename" else "copy",
+                )
+            )
+
+        for index, part in enumerate(parts):
+            if len(parts) > 1 and callable(progress_callback):
+                self.progress_callback = lambda progress, index=index: progress_callback(
+                    (index + progress) / len(parts)
+                )
+            part()
+
+    def _place_file(self, input_path, output_path, method):
+        with self._stage("write"):
+            self._stage_tool = place_file(input_path, output_path, method)
+
+    def is_passthrough(self, input_path, target_format, options=None):
+        # Between two names of one format (jpg and jpeg) the bytes are kept as they
+        # are, unless the options ask for something only an encoder can do
+        from . import photos
+
+        options = options or {}
+        source_format = self.registry.detect_format(input_path)
+        if options.get("reencode") or source_format == target_format:
+            return False
+        if not self.registry.same_format(source_format, target_format):
+            return False
+        return not photos.resize_requested(options) and photos.encoder_format(
+            target_format
+        ) not in options.get("encoder_options", {})
+
+    @contextlib.contextmanager
+    def _stage(self, stage, tool=None):
+        # Unless given, the tool is whichever program the stage ran, if any
+        self._stage_tool = tool
+        start = time.perf_counter()
+        yield
+        if self.event_callback is not None:
+            self.event_callback(stage, time.perf_counter() - start, self._stage_tool)
+
+    def _check_cancelled(self):
+        if self.cancel_token is not None:
+            self.cancel_token.check()
+
+    def _start_process(self, cmd, **kwargs):
+        # Each tool gets its own process group, so that cancelling also stops the
+        # processes it spawns itself (ebook-convert, for one, forks workers)
+        process = subprocess.Popen(cmd, start_new_session=True, **kwargs)
+        self._stage_tool = os.path.basename(cmd[0])
+        if self.cancel_token is not None:
+            ProcessWatchdog(process, self.cancel_token).start()
+        return process
+
+    def _run_process(self, cmd, check=True, **kwargs):
+        with self._start_process(cmd, **kwargs) as process:
+            process.wait()
+        # A tool killed by the watchdog exits with an error; report why it was stopped
+        self._check_cancelled()
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+        return process
 
     def _convert_photo(self, input_path, output_path, target_format):
-        with Image.open(input_path) as img:
-            if img.mode in ("RGBA", "LA"):
-                # If the image has an alpha channel, convert to RGB with a white background
-                background = Image.new("RGB", img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[3])  # 3 is the alpha channel
-                img = background
-            elif img.mode != "RGB":
-                # For other modes (like 'P'), convert to RGB
-                img = img.convert("RGB")
-
-            if target_format.lower() == "jpg":
-                target_format = "JPEG"
-            elif target_format.lower() == "tiff":
-                target_format = "TIFF"
-
-            save_kwargs = {}
-            if target_format.upper() == "TIFF":
-                save_kwargs["compression"] = "tiff_deflate"
-
-            img.save(output_path, format=target_format.upper(), **save_kwargs)
+        from PIL import Image
+
+        from . import frames, photos, tiling
+
+        memory_budget = self.options.get("memory_budget", tiling.DEFAULT_MEMORY_BUDGET)
+        resizing = photos.resize_requested(self.options)
+        prepare = functools.partial(photos.prepare_for_target, target_format=target_format)
+        try:
+            img = Image.open(input_path)
+        except Image.DecompressionBombError:
+            # Too big to decode at once, but it may still be converted (or shrunk) a
+            # strip at a time
+            img = tiling.open_unbounded(input_path)
+            if not (
+                tiling.can_convert_in_strips(img, target_format)
+                or (resizing and tiling.strip_layout(img) is not None)
+            ):
+                img.close()
+                raise
+
+        with img:
+            plan = photos.resize_plan(img.size, self.options)
+            if frames.can_convert_frames(img, target_format):
+
+                def prepare_frame(frame):
+                    if plan is not None:
+                        frame = photos.resize(frame, *plan)
+                    return prepare(frame)
+
+                with self._stage("encode", tool="pillow"):
+                    frames.convert_frames(
+                        img,
+                        output_path,
+                        target_format,
+                        prepare_frame,
+                        photos.save_options(target_format, self.options),
+                        on_frame=self._part_done,
+                    )
+                return
+
+            oversized = tiling.decoded_size(img) > memory_budget
+            if (
+                oversized
+                and plan is None
+                and tiling.can_convert_in_strips(img, target_format)
+                and photos.can_stream(target_format, self.options)
+            ):
+                with self._stage("encode", tool="pillow"):
+                    tiling.convert_in_strips(
+                        input_path,
+                        img,
+                        output_path,
+                        target_format,
+                        memory_budget,
+                        prepare_band=prepare,
+                        on_band=self._part_done,
+                        compress_level=photos.strip_compress_level(target_format, self.options),
+                    )
+                return
+
+            factor = 1
+            if oversized and plan is not None and tiling.strip_layout(img) is not None:
+                factor = photos.reduce_factor(img.size, plan[0])
+                if tiling.decoded_size(img) // factor**2 > memory_budget:
+                    # Shrink as far as the target allows, leaving less for the resampling
+                    factor = photos.reduce_factor(img.size, plan[0], gap=1)
+
+            with self._stage("decode", tool="pillow"):
+                if factor > 1:
+                    img = tiling.reduce_in_strips(
+                        input_path,
+                        img,
+                        factor,
+                        memory_budget,
+                        on_band=self._part_done,
+                    )
+                else:
+                    if plan is not None:
+                        photos.draft(img, plan[0])
+                    img.load()
+
+            with self._stage("encode", tool="pillow"):
+                if plan is not None:
+                    img = photos.resize(img, *plan)
+                self._save_photo(img, output_path, target_format)
+
+    def _save_photo(self, img, output_path, target_format):
+        from . import photos
+
+        img = photos.prepare_for_target(img, target_format)
+        save_kwargs = photos.save_options(target_format, self.options)
+        if target_format.lower() == "jpg":
+            target_format = "JPEG"
+        img.save(output_path, format=target_format.upper(), **save_kwargs)
+
+    def _convert_photo_to_many(self, input_path, outputs):
+        from PIL import Image
+
+        from . import frames, photos, tiling
+
+        memory_budget = self.options.get("memory_budget", tiling.DEFAULT_MEMORY_BUDGET)
+        try:
+            img = Image.open(input_path)
+        except Image.DecompressionBombError:
+            img = None
+        if img is not None and (
+            frames.frame_count(img) > 1 or tiling.decoded_size(img) > memory_budget
+        ):
+            img.close()
+            img = None
+        if img is None:
+            # Animations, and images too big to keep decoded, go one target at a time
+            for target_format, output_path in outputs:
+                self._convert_photo(input_path, output_path, target_format)
+            return
+
+        with img:
+            plan = photos.resize_plan(img.size, self.options)
+            with self._stage("decode", tool="pillow"):
+                if plan is not None:
+                    photos.draft(img, plan[0])
+                img.load()
+                if plan is not None:
+                    img = photos.resize(img, *plan)
+            for index, (target_format, output_path) in enumerate(outputs):
+                with self._stage("encode", tool="pillow"):
+                    self._save_photo(img, output_path, target_format)
+                self._part_done((index + 1) / len(outputs))
+
+    def _part_done(self, progress):
+        self._check_cancelled()
+        if callable(self.progress_callback):
+            self.progress_callback(progress)
 
     def _convert_video(self, input_path, output_path, target_format):
+        self._convert_video_to_many(input_path, [(target_format, output_path)])
+
+    def _convert_video_to_many(self, input_path, outputs):
+        import ffmpeg
+
+        from . import video
+
         try:
             # Get video duration
-            probe = ffmpeg.probe(input_path)
+            probe = self._probe(input_path)
             duration = float(probe.get("format", {}).get("duration", 0))
 
             # If duration is not in format info, try to find it in streams
@@ -108,342 +380,634 @@ class FileConverter:
                 )
                 duration = 1  # Default to 1 second to avoid division by zero
 
-            # Set up the conversion
-            stream = ffmpeg.input(input_path)
-
-            # Handle different target formats
-            if target_format == "mkv":
-                stream = ffmpeg.output(stream, output_path, vcodec="libx264", acodec="libvorbis")
-            else:
-                stream = ffmpeg.output(stream, output_path, format=target_format)
-
+            targets = []
+            for target_format, output_path in outputs:
+                # Streams the target container can hold are copied, the rest re-encoded
+                # with the settings of the video profile
+                settings = video.profile_settings(target_format, self.options)
+                plan = video.stream_plan(
+                    probe, target_format, self.options.get("reencode"), settings
+                )
+                for stream in video.dropped_streams(probe, plan):
+                    print(
+                        _("Warning: {} cannot hold stream {} ({} {}) of {}, leaving it out").format(
+                            target_format,
+                            stream.get("index"),
+                            stream.get("codec_type"),
+                            stream.get("codec_name"),
+                            os.path.basename(input_path),
+                        ),
+                        file=sys.stderr,
+                    )
+                entry = video.video_entry(plan)
+                height = None
+                if entry is not None:
+                    height = video.scaled_height(video.find_stream(probe, entry[0]), settings)
+
+                count = video.segment_count(duration, self.options.get("segments"))
+                if count > 1 and video.can_segment(plan):
+                    self._encode_segments(
+                        input_path,
+                        output_path,
+                        target_format,
+                        plan,
+                        duration,
+                        count,
+                        settings,
+                        height,
+                    )
+                    continue
+                targets.append((target_format, output_path, settings, plan, height))
+
+            source = ffmpeg.input(input_path)
+            # Outputs of one height share a single scale filter, split between them
+            scaled = {}
+            heights = collections.Counter(height for *_target, height in targets if height)
+            for height, uses in heights.items():
+                index = video.pick_stream(probe, "video")["index"]
+                scaled_stream = source[str(index)].filter("scale", -2, height)
+                if uses > 1:
+                    split = scaled_stream.split()
+                    scaled[height] = iter([split.stream(use) for use in range(uses)])
+                else:
+                    scaled[height] = iter([scaled_stream])
+
+            nodes = []
+            remux = True
+            for target_format, output_path, settings, plan, height in targets:
+                output_kwargs = {"format": video.muxer(target_format)}
+                threads = video.thread_count(self.threads, settings)
+                if threads:
+                    output_kwargs["threads"] = threads
+                streams = []
+                for position, (index, codec_type, codec) in enumerate(plan):
+                    input_stream = source[str(index)]
+                    if codec != "copy":
+                        if codec_type == "video" and height:
+                            input_stream = next(scaled[height])
+                        output_kwargs.update(video.encoder_options(codec_type, settings, position))
+                    streams.append(input_stream)
+                    if codec is not None:
+                        output_kwargs[f"c:{position}"] = codec
+                nodes.append(ffmpeg.output(*(streams or [source]), output_path, **output_kwargs))
+                remux = remux and video.is_remux(plan)
+            if not nodes:
+                return
+
+            # All outputs come from one ffmpeg, which reads and decodes the input once
+            stream = nodes[0] if len(nodes) == 1 else ffmpeg.merge_outputs(*nodes)
             stream = stream.overwrite_output()
 
             # Construct the ffmpeg command
             ffmpeg_cmd = ffmpeg.compile(stream)
 
+            def on_stats(stats):
+                if hasattr(self, "progress_callback") and callable(self.progress_callback):
+                    self.progress_callback(video.encode_progress(stats, duration))
+
             # Run the conversion with subprocess
-            with subprocess.Popen(
-                ffmpeg_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                bufsize=1,
-                universal_newlines=True,
-            ) as process:
-                # Monitor the conversion progress
-                pattern = re.compile(r"time=(\d{2}):(\d{2}):(\d{2})\.\d{2}")
-                for line in process.stdout:
-                    match = pattern.search(line)
-                    if match:
-                        hours, minutes, seconds = map(int, match.groups())
-                        time_processed = hours * 3600 + minutes * 60 + seconds
-                        progress = time_processed / duration
-                        if hasattr(self, "progress_callback") and callable(self.progress_callback):
-                            self.progress_callback(progress)
-
-                # Ensure the process is complete
-                process.wait()
-
-                if process.returncode != 0:
-                    raise Exception(
-                        _(f"ffmpeg process failed with return code: {process.returncode}")
-                    )
+            # A remux only rewrites the container, so it is reported as a write
+            stage = "write" if remux else "encode"
+            with self._stage(stage, tool="ffmpeg"):
+                self._run_ffmpeg(ffmpeg_cmd, on_stats)
 
         except ffmpeg.Error as e:
             print("stdout:", e.stdout.decode("utf8"))
             print("stderr:", e.stderr.decode("utf8"))
             raise
+        except ConversionCancelled:
+            raise
         except Exception as e:
             print(f"An error occurred: {str(e)}")
             raise
 
+    def _probe(self, input_path):
+        tool = "cache" if self.metadata.has_probe(input_path) else "ffprobe"
+        with self._stage("probe", tool=tool):
+            return self.metadata.probe(input_path)
+
+    def _run_ffmpeg(self, cmd, on_stats=None, on_start=None):
+        from . import video
+
+        # Progress comes as key=value lines on stdout; of the rest of the output only
+        # the end is kept, for the error message
+        cmd = [cmd[0]] + video.progress_args(self.options.get("progress_interval")) + cmd[1:]
+        with self._start_process(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        ) as process:
+            if on_start is not None:
+                on_start(process)
+            reader = video.ProgressReader()
+            output = collections.deque(maxlen=FFMPEG_OUTPUT_LINES)
+            for line in process.stdout:
+                values = reader.feed(line)
+                if values is None:
+                    output.append(line.rstrip())
+                elif values and on_stats is not None:
+                    on_stats(video.progress_stats(values))
+
+            # Ensure the process is complete
+            process.wait()
+        self._check_cancelled()
+
+        if process.returncode != 0:
+            message = _(f"ffmpeg process failed with return code: {process.returncode}")
+            raise Exception("\n".join([message, *output]))
+
+    def _encode_segments(
+        self, input_path, output_path, target_format, plan, duration, count, settings, height
+    ):
+        # Splits the video at keyframes, encodes the pieces side by side and joins
+        # them back without re-encoding. The audio is taken from the input in the
+        # last step, since encoding it in pieces would leave gaps at every cut.
+        from . import video
+
+        directory = tempfile.mkdtemp(
+            prefix=".segments-", dir=os.path.dirname(os.path.abspath(output_path))
+        )
+        try:
+            video_index, _codec_type, codec = video.video_entry(plan)
+            with self._stage("encode", tool="ffmpeg"):
+                self._run_ffmpeg(
+                    video.split_command(input_path, video_index, duration / count, directory)
+                )
+                pieces = sorted(
+                    os.path.join(directory, name)
+                    for name in os.listdir(directory)
+                    if name.startswith("split")
+                )
+                encoded = [
+                    os.path.join(directory, f"part{index:04d}.{target_format}")
+                    for index in range(len(pieces))
+                ]
+                # The threads the scheduler gave the job are shared between the pieces
+                threads = video.thread_count(
+                    max(self.threads // count, 1) if self.threads else None, settings
+                )
+                piece_stats = [video.progress_stats({})] * len(pieces)
+                processes = []
+                lock = threading.Lock()
+                failed = threading.Event()
+
+                def on_start(process):
+                    with lock:
+                        processes.append(process)
+                        stop = failed.is_set()
+                    if stop:
+                        kill_process_group(process)
+
+                def encode(index):
+                    def on_stats(stats):
+                        with lock:
+                            piece_stats[index] = stats
+                            combined = video.combine_stats(piece_stats)
+                        if callable(self.progress_callback):
+                            self.progress_callback(video.encode_progress(combined, duration))
+
+                    if failed.is_set():
+                        return
+                    self._run_ffmpeg(
+                        video.segment_command(
+                            pieces[index],
+                            encoded[index],
+                            target_format,
+                            codec,
+                            threads,
+                            settings,
+                            height,
+                        ),
+                        on_stats,
+                        on_start,
+                    )
+
+                with concurrent.futures.ThreadPoolExecutor(max_workers=count) as executor:
+                    futures = [executor.submit(encode, index) for index in range(len(pieces))]
+                    try:
+                        for future in concurrent.futures.as_completed(futures):
+                            future.result()
+                    except BaseException:
+                        # One failed piece fails the video; stop the others
+                        with lock:
+                            failed.set()
+                            running = list(processes)
+                        for future in futures:
+                            future.cancel()
+                        for process in running:
+                            kill_process_group(process)
+                        raise
+
+            list_path = os.path.join(directory, "segments.txt")
+            with open(list_path, "w", encoding="utf-8") as f:
+                f.write(video.concat_list(encoded))
+            with self._stage("write", tool="ffmpeg"):
+                self._run_ffmpeg(
+                    video.concat_command(
+                        list_path, input_path, output_path, target_format, plan, settings
+                    )
+                )
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
     def _convert_vector(self, input_path, output_path, target_format):
-        if shutil.which("inkscape"):
-            subprocess.run(["inkscape", input_path, f"--export-filename={output_path}"])
-        else:
+        from . import inkscape
+
+        if not shutil.which(inkscape.INKSCAPE):
             raise RuntimeError(
                 _("Inkscape is required for vector conversions but is not installed.")
             )
+        with self._stage("encode", tool="inkscape"):
+            # Through one of the process's running Inkscape shells, which saves
+            # Inkscape's startup on every file after the first
+            if inkscape.can_use_shell(input_path, output_path):
+                inkscape.shared_pool().convert(
+                    input_path, output_path, target_format, self.cancel_token
+                )
+            else:
+                self._run_process(inkscape.export_command(input_path, output_path, target_format))
 
     def _convert_audio(self, input_path, output_path, target_format):
-        if target_format == "aac":
-            (
-                ffmpeg.input(input_path)
-                .output(output_path, acodec="aac", format="adts")
-                .overwrite_output()
-                .run()
-            )
-        else:
-            (
-                ffmpeg.input(input_path)
-                .output(output_path, format=target_format)
-                .overwrite_output()
-                .run()
-            )
+        self._convert_audio_to_many(input_path, [(target_format, output_path)])
+
+    def _convert_audio_to_many(self, input_path, outputs):
+        import ffmpeg
+
+        from . import audio, video
+
+        # wav, flac and ogg are converted in this process, a block at a time; starting
+        # ffmpeg would take longer than that for short clips
+        source_format = self.get_current_format(input_path)
+        if all(
+            audio.can_convert_natively(source_format, target_format, self.options)
+            for target_format, _output_path in outputs
+        ):
+            source = audio.open_native(input_path)
+            if source is not None:
+                try:
+                    with source, self._stage("encode", tool="libsndfile"):
+                        audio.convert_in_blocks(source, outputs, self._part_done)
+                    return
+                except audio.NATIVE_ERRORS:
+                    # Left to ffmpeg, which can resample or remix where libsndfile
+                    # refuses to write
+                    for _target_format, output_path in outputs:
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(output_path)
+
+        try:
+            duration = audio.duration(self._probe(input_path))
+        except (ffmpeg.Error, OSError):
+            # Still convertible, only without progress
+            duration = 0
+
+        def on_stats(stats):
+            if duration and callable(self.progress_callback):
+                self.progress_callback(video.encode_progress(stats, duration))
+
+        source = ffmpeg.input(input_path)
+        nodes = [
+            source.output(output_path, **audio.output_options(target_format, self.options))
+            for target_format, output_path in outputs
+        ]
+        stream = nodes[0] if len(nodes) == 1 else ffmpeg.merge_outputs(*nodes)
+        with self._stage("encode", tool="ffmpeg"):
+            self._run_ffmpeg(ffmpeg.compile(stream.overwrite_output()), on_stats)
 
     def _convert_document(self, input_path, output_path, target_format):
-        if target_format == "pdf":
-            if input_path.endswith(".docx"):
-                doc = docx.Document(input_path)
-                doc.save(output_path)
-            elif input_path.endswith(".txt"):
-                from reportlab.lib.pagesizes import letter
-                from reportlab.pdfgen import canvas
-
-                c = canvas.Canvas(output_path, pagesize=letter)
-                with open(input_path, "r") as txt_file:
-                    text = txt_file.read()
-                    c.drawString(72, 800, text)
-                c.save()
-        elif target_format == "txt":
-            if input_path.endswith(".pdf"):
-                with open(input_path, "rb") as pdf_file:
-                    reader = PyPDF2.PdfReader(pdf_file)
-                    with open(output_path, "w") as txt_file:
-                        for page in reader.pages:
-                            txt_file.write(page.extract_text())
-            elif input_path.endswith(".docx"):
-                doc = docx.Document(input_path)
-                with open(output_path, "w") as txt_file:
-                    for para in doc.paragraphs:
-                        txt_file.write(para.text + "\n")
-        elif target_format == "docx":
-            if input_path.endswith(".pdf"):
-                cv = Converter(input_path)
-                cv.convert(output_path)
-                cv.close()
-            elif input_path.endswith(".txt"):
-                doc = docx.Document()
-
-                # Read the TXT file and add its content to the DOCX
-                with open(input_path, "r", encoding="utf-8") as txt_file:
-                    for line in txt_file:
-                        doc.add_paragraph(line.strip())
-
-                doc.save(output_path)
-            elif input_path.endswith(".rtf"):
-                # Read the RTF file
-                with open(input_path, "r", encoding="utf-8") as rtf_file:
-                    rtf_text = rtf_file.read()
-
-                # Convert RTF to plain text
-                plain_text = rtf_to_text(rtf_text)
-
-                doc = docx.Document()
-
-                # Add the content to the DOCX
-                for paragraph in plain_text.split("\n"):
-                    doc.add_paragraph(paragraph)
-
-                doc.save(output_path)
-            elif input_path.endswith(".odt"):
-                odt_doc = load(input_path)
-
-                docx_doc = docx.Document()
-
-                # Iterate through the ODT content
-                for element in odt_doc.getElementsByType(P):
-                    # Extract text from the paragraph
-                    paragraph_text = teletype.extractText(element)
-
-                    docx_doc.add_paragraph(paragraph_text)
-
-                docx_doc.save(output_path)
-        elif target_format == "rtf":
-            if input_path.endswith(".pdf"):
-                with open(input_path, "rb") as pdf_file:
-                    reader = PyPDF2.PdfReader(pdf_file)
-                    text = ""
-                    for page in reader.pages:
-                        text += page.extract_text()
-
-                rtf_content = "{\\rtf1\\ansi\n"
-                rtf_content += text.replace("\n", "\\par\n")
-                rtf_content += "}"
-
-                with open(output_path, "w") as rtf_file:
-                    rtf_file.write(rtf_content)
-            elif input_path.endswith(".docx"):
-                doc = docx.Document(input_path)
-                rtf_content = "{\\rtf1\\ansi\n"
-                for para in doc.paragraphs:
-                    rtf_content += para.text.replace("\n", "\\par\n") + "\\par\n"
-                rtf_content += "}"
-
-                with open(output_path, "w", encoding="utf-8") as rtf_file:
-                    rtf_file.write(rtf_content)
-            elif input_path.endswith(".txt"):
-                with open(input_path, "r", encoding="utf-8") as txt_file:
-                    text_content = txt_file.read()
-
-                # Create a simple RTF structure
-                rtf_content = "{\\rtf1\\ansi\\deff0\n"
-                rtf_content += "{\\fonttbl{\\f0 Arial;}}\n"
-                rtf_content += "\\f0\\fs24\n"
-
-                # Convert newlines to RTF paragraph breaks
-                rtf_content += text_content.replace("\n", "\\par\n")
-
-                rtf_content += "}"
-
-                with open(output_path, "w", encoding="utf-8") as rtf_file:
-                    rtf_file.write(rtf_content)
-            elif input_path.endswith(".odt"):
-                odt_doc = load(input_path)
-
-                # Create RTF header
-                rtf_content = "{\\rtf1\\ansi\\deff0\n"
-                rtf_content += "{\\fonttbl{\\f0 Arial;}}\n"
-                rtf_content += "\\f0\\fs24\n"
-
-                # Iterate through the ODT content
-                for element in odt_doc.getElementsByType(P):
-                    # Extract text from the paragraph
-                    paragraph_text = teletype.extractText(element)
-
-                    # Add the paragraph to RTF content
-                    rtf_content += paragraph_text.replace("\n", "\\par\n") + "\\par\n"
-
-                rtf_content += "}"
-
-                with open(output_path, "w", encoding="utf-8") as rtf_file:
-                    rtf_file.write(rtf_content)
-        elif target_format == "odt":
-            if input_path.endswith(".pdf"):
-                doc = OpenDocumentText()
-
-                # Read the PDF and extract text
-                with open(input_path, "rb") as pdf_file:
-                    reader = PyPDF2.PdfReader(pdf_file)
-                    for page in reader.pages:
-                        text = page.extract_text()
-                        # Add each line as a paragraph in the ODT
-                        for line in text.split("\n"):
-                            p = P(text=line)
-                            doc.text.addElement(p)
-
-                doc.save(output_path)
-            elif input_path.endswith(".docx"):
-                odt_doc = OpenDocumentText()
-
-                docx_doc = docx.Document(input_path)
-
-                # Create some basic styles
-                style_bold = Style(name="Bold", family="text")
-                style_bold.addElement(TextProperties(fontweight="bold"))
-                odt_doc.automaticstyles.addElement(style_bold)
-
-                style_italic = Style(name="Italic", family="text")
-                style_italic.addElement(TextProperties(fontstyle="italic"))
-                odt_doc.automaticstyles.addElement(style_italic)
-
-                # Convert paragraphs
-                for paragraph in docx_doc.paragraphs:
-                    odt_para = P()
-                    for run in paragraph.runs:
-                        span = Span(text=run.text)
-                        if run.bold:
-                            span.stylename = style_bold
-                        if run.italic:
-                            span.stylename = style_italic
-                        odt_para.addElement(span)
-                    odt_doc.text.addElement(odt_para)
-
-                odt_doc.save(output_path)
-            elif input_path.endswith(".txt"):
-                odt_doc = OpenDocumentText()
-
-                # Create a default text style
-                style_default = Style(name="Default", family="paragraph")
-                style_default.addElement(TextProperties(fontname="Arial", fontsize="12pt"))
-                odt_doc.automaticstyles.addElement(style_default)
-
-                # Read the TXT file and add its content to the ODT
-                with open(input_path, "r", encoding="utf-8") as txt_file:
-                    for line in txt_file:
-                        p = P(stylename=style_default)
-                        p.addText(line.strip())
-                        odt_doc.text.addElement(p)
-
-                odt_doc.save(output_path)
-            elif input_path.endswith(".rtf"):
-                odt_doc = OpenDocumentText()
-
-                # Create a default text style
-                style_default = Style(name="Default", family="paragraph")
-                style_default.addElement(TextProperties(fontname="Arial", fontsize="12pt"))
-                odt_doc.automaticstyles.addElement(style_default)
-
-                with open(input_path, "r", encoding="utf-8") as rtf_file:
-                    rtf_text = rtf_file.read()
-
-                # Convert RTF to plain text
-                plain_text = rtf_to_text(rtf_text)
-
-                # Add the content to the ODT
-                for paragraph in plain_text.split("\n"):
-                    p = P(stylename=style_default)
-                    p.addText(paragraph)
-                    odt_doc.text.addElement(p)
-
-                odt_doc.save(output_path)
-        else:
+        source_format = self.get_current_format(input_path)
+        handler = DOCUMENT_CONVERSIONS.get((source_format, target_format))
+        if handler is None:
             raise ValueError(
                 _("Unsupported document conversion: {} to {}").format(
                     os.path.splitext(input_path)[1], target_format
                 )
             )
+        # Reading and writing are interleaved in most of these, so they are one stage
+        with self._stage("encode"):
+            handler(self, input_path, output_path, target_format)
+
+    @staticmethod
+    def _read_pdf_text(input_path):
+        import PyPDF2
+
+        with open(input_path, "rb") as pdf_file:
+            reader = PyPDF2.PdfReader(pdf_file)
+            return [page.extract_text() for page in reader.pages]
+
+    @staticmethod
+    def _read_rtf_text(input_path):
+        from striprtf.striprtf import rtf_to_text
+
+        with open(input_path, "r", encoding="utf-8") as rtf_file:
+            rtf_text = rtf_file.read()
+
+        # Convert RTF to plain text
+        return rtf_to_text(rtf_text)
+
+    @staticmethod
+    def _read_odt_paragraphs(input_path):
+        from odf.opendocument import load
+        from odf import teletype
+        from odf.text import P
+
+        odt_doc = load(input_path)
+
+        # Extract the text of every paragraph in the ODT content
+        return [teletype.extractText(element) for element in odt_doc.getElementsByType(P)]
+
+    @staticmethod
+    def _write_text_pdf(text, output_path):
+        from reportlab.lib.pagesizes import letter
+        from reportlab.pdfgen import canvas
+
+        c = canvas.Canvas(output_path, pagesize=letter)
+        c.drawString(72, 800, text)
+        c.save()
+
+    @staticmethod
+    def _write_rtf_paragraphs(paragraphs, output_path):
+        # Create a simple RTF structure
+        rtf_content = "{\\rtf1\\ansi\\deff0\n"
+        rtf_content += "{\\fonttbl{\\f0 Arial;}}\n"
+        rtf_content += "\\f0\\fs24\n"
+
+        for paragraph in paragraphs:
+            rtf_content += paragraph.replace("\n", "\\par\n") + "\\par\n"
+
+        rtf_content += "}"
+
+        with open(output_path, "w", encoding="utf-8") as rtf_file:
+            rtf_file.write(rtf_content)
+
+    @staticmethod
+    def _new_odt_with_default_style():
+        from odf.opendocument import OpenDocumentText
+        from odf.style import Style, TextProperties
+
+        odt_doc = OpenDocumentText()
+
+        # Create a default text style
+        style_default = Style(name="Default", family="paragraph")
+        style_default.addElement(TextProperties(fontname="Arial", fontsize="12pt"))
+        odt_doc.automaticstyles.addElement(style_default)
+
+        return odt_doc, style_default
+
+    def _docx_to_pdf(self, input_path, output_path, target_format):
+        import docx
+
+        doc = docx.Document(input_path)
+        doc.save(output_path)
+
+    def _txt_to_pdf(self, input_path, output_path, target_format):
+        with open(input_path, "r") as txt_file:
+            self._write_text_pdf(txt_file.read(), output_path)
+
+    def _rtf_to_pdf(self, input_path, output_path, target_format):
+        self._write_text_pdf(self._read_rtf_text(input_path), output_path)
+
+    def _odt_to_pdf(self, input_path, output_path, target_format):
+        self._write_text_pdf("\n".join(self._read_odt_paragraphs(input_path)), output_path)
+
+    def _pdf_to_txt(self, input_path, output_path, target_format):
+        with open(output_path, "w") as txt_file:
+            for page_text in self._read_pdf_text(input_path):
+                txt_file.write(page_text)
+
+    def _docx_to_txt(self, input_path, output_path, target_format):
+        import docx
+
+        doc = docx.Document(input_path)
+        with open(output_path, "w") as txt_file:
+            for para in doc.paragraphs:
+                txt_file.write(para.text + "\n")
+
+    def _rtf_to_txt(self, input_path, output_path, target_format):
+        with open(output_path, "w", encoding="utf-8") as txt_file:
+            txt_file.write(self._read_rtf_text(input_path))
+
+    def _odt_to_txt(self, input_path, output_path, target_format):
+        with open(output_path, "w", encoding="utf-8") as txt_file:
+            for paragraph in self._read_odt_paragraphs(input_path):
+                txt_file.write(paragraph + "\n")
+
+    def _pdf_to_docx(self, input_path, output_path, target_format):
+        # pdf2docx pulls in PyMuPDF, OpenCV and numpy, so it is only loaded here
+        from pdf2docx import Converter
+
+        cv = Converter(input_path)
+        cv.convert(output_path)
+        cv.close()
+
+    def _txt_to_docx(self, input_path, output_path, target_format):
+        import docx
+
+        doc = docx.Document()
+
+        # Read the TXT file and add its content to the DOCX
+        with open(input_path, "r", encoding="utf-8") as txt_file:
+            for line in txt_file:
+                doc.add_paragraph(line.strip())
+
+        doc.save(output_path)
+
+    def _rtf_to_docx(self, input_path, output_path, target_format):
+        import docx
+
+        doc = docx.Document()
+
+        # Add the content to the DOCX
+        for paragraph in self._read_rtf_text(input_path).split("\n"):
+            doc.add_paragraph(paragraph)
+
+        doc.save(output_path)
+
+    def _odt_to_docx(self, input_path, output_path, target_format):
+        import docx
+
+        docx_doc = docx.Document()
+
+        for paragraph_text in self._read_odt_paragraphs(input_path):
+            docx_doc.add_paragraph(paragraph_text)
+
+        docx_doc.save(output_path)
+
+    def _pdf_to_rtf(self, input_path, output_path, target_format):
+        text = "".join(self._read_pdf_text(input_path))
+
+        rtf_content = "{\\rtf1\\ansi\n"
+        rtf_content += text.replace("\n", "\\par\n")
+        rtf_content += "}"
+
+        with open(output_path, "w") as rtf_file:
+            rtf_file.write(rtf_content)
+
+    def _docx_to_rtf(self, input_path, output_path, target_format):
+        import docx
+
+        doc = docx.Document(input_path)
+        rtf_content = "{\\rtf1\\ansi\n"
+        for para in doc.paragraphs:
+            rtf_content += para.text.replace("\n", "\\par\n") + "\\par\n"
+        rtf_content += "}"
+
+        with open(output_path, "w", encoding="utf-8") as rtf_file:
+            rtf_file.write(rtf_content)
+
+    def _txt_to_rtf(self, input_path, output_path, target_format):
+        with open(input_path, "r", encoding="utf-8") as txt_file:
+            text_content = txt_file.read()
+
+        # Create a simple RTF structure
+        rtf_content = "{\\rtf1\\ansi\\deff0\n"
+        rtf_content += "{\\fonttbl{\\f0 Arial;}}\n"
+        rtf_content += "\\f0\\fs24\n"
+
+        # Convert newlines to RTF paragraph breaks
+        rtf_content += text_content.replace("\n", "\\par\n")
+
+        rtf_content += "}"
+
+        with open(output_path, "w", encoding="utf-8") as rtf_file:
+            rtf_file.write(rtf_content)
+
+    def _odt_to_rtf(self, input_path, output_path, target_format):
+        self._write_rtf_paragraphs(self._read_odt_paragraphs(input_path), output_path)
+
+    def _pdf_to_odt(self, input_path, output_path, target_format):
+        from odf.opendocument import OpenDocumentText
+        from odf.text import P
+
+        doc = OpenDocumentText()
+
+        for text in self._read_pdf_text(input_path):
+            # Add each line as a paragraph in the ODT
+            for line in text.split("\n"):
+                p = P(text=line)
+                doc.text.addElement(p)
+
+        doc.save(output_path)
+
+    def _docx_to_odt(self, input_path, output_path, target_format):
+        import docx
+        from odf.opendocument import OpenDocumentText
+        from odf.style import Style, TextProperties
+        from odf.text import P, Span
+
+        odt_doc = OpenDocumentText()
+
+        docx_doc = docx.Document(input_path)
+
+        # Create some basic styles
+        style_bold = Style(name="Bold", family="text")
+        style_bold.addElement(TextProperties(fontweight="bold"))
+        odt_doc.automaticstyles.addElement(style_bold)
+
+        style_italic = Style(name="Italic", family="text")
+        style_italic.addElement(TextProperties(fontstyle="italic"))
+        odt_doc.automaticstyles.addElement(style_italic)
+
+        # Convert paragraphs
+        for paragraph in docx_doc.paragraphs:
+            odt_para = P()
+            for run in paragraph.runs:
+                span = Span(text=run.text)
+                if run.bold:
+                    span.stylename = style_bold
+                if run.italic:
+                    span.stylename = style_italic
+                odt_para.addElement(span)
+            odt_doc.text.addElement(odt_para)
+
+        odt_doc.save(output_path)
+
+    def _txt_to_odt(self, input_path, output_path, target_format):
+        from odf.text import P
+
+        odt_doc, style_default = self._new_odt_with_default_style()
+
+        # Read the TXT file and add its content to the ODT
+        with open(input_path, "r", encoding="utf-8") as txt_file:
+            for line in txt_file:
+                p = P(stylename=style_default)
+                p.addText(line.strip())
+                odt_doc.text.addElement(p)
+
+        odt_doc.save(output_path)
+
+    def _rtf_to_odt(self, input_path, output_path, target_format):
+        from odf.text import P
+
+        odt_doc, style_default = self._new_odt_with_default_style()
+
+        # Add the content to the ODT
+        for paragraph in self._read_rtf_text(input_path).split("\n"):
+            p = P(stylename=style_default)
+            p.addText(paragraph)
+            odt_doc.text.addElement(p)
+
+        odt_doc.save(output_path)
 
     def _convert_archive(self, input_path, output_path, target_format):
-        temp_dir = os.path.join(os.path.dirname(output_path), "temp_extract")
-        os.makedirs(temp_dir, exist_ok=True)
+        # A unique directory per job, so parallel conversions into one folder don't collide
+        temp_dir = tempfile.mkdtemp(prefix=".temp_extract-", dir=os.path.dirname(output_path))
 
         try:
             # Extract the input archive
-            if input_path.endswith((".tar", ".tar.gz", ".tar.xz", ".tar.bz2")):
-                with tarfile.open(input_path, "r:*") as tar:
-                    tar.extractall(temp_dir)
-            elif input_path.endswith(".zip"):
-                with zipfile.ZipFile(input_path, "r") as zip_ref:
-                    zip_ref.extractall(temp_dir)
-            elif input_path.endswith(".rar"):
-                subprocess.run(["unrar", "x", input_path, temp_dir], check=True)
-            elif input_path.endswith(".7z"):
-                subprocess.run(["7z", "x", input_path, f"-o{temp_dir}"], check=True)
-            else:
-                raise ValueError(
-                    _("Unsupported input archive format: {}").format(
-                        os.path.splitext(input_path)[1]
+            with self._stage("decode"):
+                if input_path.endswith((".tar", ".tar.gz", ".tar.xz", ".tar.bz2")):
+                    with tarfile.open(input_path, "r:*") as tar:
+                        tar.extractall(temp_dir)
+                elif input_path.endswith(".zip"):
+                    with zipfile.ZipFile(input_path, "r") as zip_ref:
+                        zip_ref.extractall(temp_dir)
+                elif input_path.endswith(".rar"):
+                    self._run_process(["unrar", "x", input_path, temp_dir])
+                elif input_path.endswith(".7z"):
+                    self._run_process(["7z", "x", input_path, f"-o{temp_dir}"])
+                else:
+                    raise ValueError(
+                        _("Unsupported input archive format: {}").format(
+                            os.path.splitext(input_path)[1]
+                        )
                     )
-                )
+
+            self._check_cancelled()
 
             # Create the output archive
-            if target_format == "zip":
-                base_name = os.path.basename(output_path).split(os.extsep)[0]
-                shutil.make_archive(
-                    os.path.join(os.path.dirname(output_path), base_name), "zip", temp_dir
-                )
-            elif target_format in ["tar", "tar.gz", "tar.xz", "tar.bz2"]:
-                base_name = os.path.basename(output_path).split(os.extsep)[0]
-                if target_format == "tar":
+            with self._stage("encode"):
+                if target_format == "zip":
+                    base_name = os.path.basename(self.registry.strip_format(output_path))
                     shutil.make_archive(
-                        os.path.join(os.path.dirname(output_path), base_name), "tar", temp_dir
+                        os.path.join(os.path.dirname(output_path), base_name), "zip", temp_dir
                     )
-                elif target_format in ["tar.xz", "tar.bz2"]:
-                    compression = "xz" if target_format == "tar.xz" else "bz2"
-                    with tarfile.open(output_path, f"w:{compression}") as tar:
-                        tar.add(temp_dir, arcname="")
+                elif target_format in ["tar", "tar.gz", "tar.xz", "tar.bz2"]:
+                    base_name = os.path.basename(self.registry.strip_format(output_path))
+                    if target_format == "tar":
+                        shutil.make_archive(
+                            os.path.join(os.path.dirname(output_path), base_name), "tar", temp_dir
+                        )
+                    elif target_format in ["tar.xz", "tar.bz2"]:
+                        compression = "xz" if target_format == "tar.xz" else "bz2"
+                        with tarfile.open(output_path, f"w:{compression}") as tar:
+                            tar.add(temp_dir, arcname="")
+                    else:
+                        shutil.make_archive(
+                            os.path.join(os.path.dirname(output_path), base_name), "gztar", temp_dir
+                        )
+                elif target_format == "rar":
+                    self._run_process(["rar", "a", output_path, temp_dir])
+                elif target_format == "7z":
+                    self._run_process(["7z", "a", output_path, temp_dir])
                 else:
-                    shutil.make_archive(
-                        os.path.join(os.path.dirname(output_path), base_name), "gztar", temp_dir
+                    raise ValueError(
+                        _("Unsupported output archive format: {}").format(target_format)
                     )
-            elif target_format == "rar":
-                subprocess.run(["rar", "a", output_path, temp_dir], check=True)
-            elif target_format == "7z":
-                subprocess.run(["7z", "a", output_path, temp_dir], check=True)
-            else:
-                raise ValueError(_("Unsupported output archive format: {}").format(target_format))
 
+        except ConversionCancelled:
+            raise
         except subprocess.CalledProcessError as e:
             raise RuntimeError(_("Error during archive conversion: {}").format(str(e)))
         except Exception as e:
@@ -454,10 +1018,69 @@ class FileConverter:
 
     def _convert_ebook(self, input_path, output_path, target_format):
         try:
-            subprocess.run(["ebook-convert", input_path, output_path], check=True)
+            with self._stage("encode", tool="ebook-convert"):
+                self._run_process(["ebook-convert", input_path, output_path])
         except subprocess.CalledProcessError:
             raise RuntimeError(
                 _("Failed to convert ebook from {input_path} to {output_path}").format(
                     input_path=input_path, output_path=output_path
                 )
             )
+
+
+DOCUMENT_CONVERSIONS = {
+    ("docx", "pdf"): FileConverter._docx_to_pdf,
+    ("txt", "pdf"): FileConverter._txt_to_pdf,
+    ("rtf", "pdf"): FileConverter._rtf_to_pdf,
+    ("odt", "pdf"): FileConverter._odt_to_pdf,
+    ("pdf", "txt"): FileConverter._pdf_to_txt,
+    ("docx", "txt"): FileConverter._docx_to_txt,
+    ("rtf", "txt"): FileConverter._rtf_to_txt,
+    ("odt", "txt"): FileConverter._odt_to_txt,
+    ("pdf", "docx"): FileConverter._pdf_to_docx,
+    ("txt", "docx"): FileConverter._txt_to_docx,
+    ("rtf", "docx"): FileConverter._rtf_to_docx,
+    ("odt", "docx"): FileConverter._odt_to_docx,
+    ("pdf", "rtf"): FileConverter._pdf_to_rtf,
+    ("docx", "rtf"): FileConverter._docx_to_rtf,
+    ("txt", "rtf"): FileConverter._txt_to_rtf,
+    ("odt", "rtf"): FileConverter._odt_to_rtf,
+    ("pdf", "odt"): FileConverter._pdf_to_odt,
+    ("docx", "odt"): FileConverter._docx_to_odt,
+    ("txt", "odt"): FileConverter._txt_to_odt,
+    ("rtf", "odt"): FileConverter._rtf_to_odt,
+}
+
+# Handlers that convert to several targets at once, from one decode of the input
+FAN_OUT_CONVERTERS = {
+    FileConverter._convert_photo: FileConverter._convert_photo_to_many,
+    FileConverter._convert_video: FileConverter._convert_video_to_many,
+    FileConverter._convert_audio: FileConverter._convert_audio_to_many,
+}
+
+FAMILY_CONVERTERS = {
+    "photos": FileConverter._convert_photo,
+    "videos": FileConverter._convert_video,
+    "vectors": FileConverter._convert_vector,
+    "audio": FileConverter._convert_audio,
+    "archives": FileConverter._convert_archive,
+    "ebooks": FileConverter._convert_ebook,
+}
+
+
+def register_builtin_converters(registry):
+    # Families are added in SUPPORTED_FORMATS order, so a format listed in several
+    # families (txt, rtf, pdf) is detected as the first one and a pair that several
+    # families could handle goes to the first family that registered it.
+    for alias, fmt in FORMAT_ALIASES.items():
+        registry.add_alias(alias, fmt)
+    for family, formats in SUPPORTED_FORMATS.items():
+        registry.add_family(family, formats)
+        if family == "documents":
+            for source_format, target_format in DOCUMENT_CONVERSIONS:
+                registry.register(source_format, target_format, FileConverter._convert_document)
+        else:
+            registry.register_family_converter(family, formats, FAMILY_CONVERTERS[family])
+
+
+register_builtin_converters(default_registry)
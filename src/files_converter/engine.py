@@ -0,0 +1,590 @@
+import collections
+import concurrent.futures
+import gettext
+import itertools
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from .cancellation import CancellationToken, ConversionCancelled, ConversionTimeout
+from .converter import FileConverter
+from .events import ConversionEvent
+from .metadata import MetadataCache
+from .registry import registry
+from .scheduler import ResourceScheduler, job_family
+
+_ = gettext.gettext
+
+
+class ConversionJob:
+    _ids = itertools.count(1)
+
+    def __init__(
+        self,
+        input_path,
+        output_path,
+        target_format,
+        job_id=None,
+        options=None,
+        timeout=None,
+        extra_outputs=None,
+    ):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.target_format = target_format
+        # More (target_format, output_path) pairs, made from the same decode of the input
+        self.extra_outputs = list(extra_outputs or [])
+        self.options = dict(options or {})
+        # Wall-clock limit in seconds; None falls back to the engine's per-family limits
+        self.timeout = timeout
+        # CPU threads the tool may use, as assigned by the scheduler; None lets it decide
+        self.threads = None
+        self.job_id = job_id if job_id is not None else next(self._ids)
+
+    @property
+    def outputs(self):
+        return [(self.target_format, self.output_path)] + self.extra_outputs
+
+    def __repr__(self):
+        targets = ", ".join(target_format for target_format, _output_path in self.outputs)
+        return f"ConversionJob({self.job_id}, {self.input_path!r} -> {targets})"
+
+
+class ConversionResult:
+    def __init__(self, job, success, error=None, elapsed=0.0, cached=None, status=None):
+        self.job = job
+        self.success = success
+        self.error = error
+        self.elapsed = elapsed
+        # True for a cache hit, False for a miss, None when the cache was not used
+        self.cached = cached
+        # "ok", "failed", "cancelled" or "timeout"
+        self.status = status or ("ok" if success else "failed")
+
+    @property
+    def cancelled(self):
+        return self.status in ("cancelled", "timeout")
+
+    def __repr__(self):
+        status = self.status if self.success else f"{self.status}: {self.error}"
+        if self.cached:
+            status += ", cached"
+        return f"ConversionResult({self.job.job_id}, {status})"
+
+
+def build_output_path(input_path, output_dir, target_format):
+    if output_dir is None:
+        output_dir = os.path.dirname(input_path)
+    base_name = os.path.basename(registry.strip_format(input_path))
+    return os.path.join(output_dir, f"{base_name}.{target_format}")
+
+
+class OutputClaims:
+    # The outputs of one batch. An output may not be one of the batch's inputs, which
+    # another job may be reading, nor an output of another job, nor, unless
+    # overwriting, a file that exists already. A batch whose inputs are not known up
+    # front (the watch daemon) tells them apart with is_input.
+
+    def __init__(self, input_paths, overwrite=False, is_input=None):
+        self.inputs = {os.path.realpath(path) for path in input_paths}
+        self.overwrite = overwrite
+        self.is_input = is_input
+        self.claimed = set()
+        # Outputs written and released, with the input each was made from
+        self.released = {}
+
+    def claim(self, output_path, input_path=None):
+        # None once the output is the caller's, otherwise why it cannot be
+        key = os.path.realpath(output_path)
+        if key in self.inputs or (self.is_input is not None and self.is_input(output_path)):
+            return _("Output would replace an input file: {}").format(output_path)
+        if key in self.claimed:
+            return _("Output is written by another conversion: {}").format(output_path)
+        # Converting an input again may replace what was made from it before
+        remade = input_path is not None and self.released.get(key) == os.path.realpath(input_path)
+        if not self.overwrite and not remade and os.path.lexists(output_path):
+            return _("Output file already exists: {}").format(output_path)
+        self.claimed.add(key)
+        return None
+
+    def release(self, output_path, input_path=None):
+        # Frees the output for later claims; given the input, once it has been written
+        key = os.path.realpath(output_path)
+        self.claimed.discard(key)
+        if input_path is not None:
+            self.released[key] = os.path.realpath(input_path)
+
+
+def default_max_workers():
+    return os.cpu_count() or 1
+
+
+# State of a pool worker process, set up once by _init_worker
+_worker_converter = None
+_worker_progress_queue = None
+_worker_cache = None
+_worker_cancel_event = None
+_worker_emit_events = False
+
+
+def _init_worker(progress_queue, cache, cancel_event, emit_events=False, metadata=None):
+    global _worker_converter, _worker_progress_queue, _worker_cache, _worker_cancel_event
+    global _worker_emit_events
+    # Ctrl+C reaches the whole process group; only the parent decides what to cancel
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if metadata is not None:
+        # Probes made here are sent back, so the parent's cache learns them too
+        metadata.on_probe = lambda path, entry: progress_queue.put(("metadata", path, entry))
+    _worker_converter = FileConverter(metadata=metadata)
+    _worker_progress_queue = progress_queue
+    _worker_cache = cache
+    _worker_cancel_event = cancel_event
+    _worker_emit_events = emit_events
+
+
+def _report_progress(job_id, progress):
+    if _worker_progress_queue is not None:
+        _worker_progress_queue.put(("progress", job_id, progress))
+
+
+def _report_event(event):
+    if _worker_progress_queue is not None:
+        _worker_progress_queue.put(("event", event))
+
+
+def _job_event(kind, job, **fields):
+    source_format = registry.detect_format(job.input_path)
+    return ConversionEvent(
+        kind,
+        job.job_id,
+        job.input_path,
+        source_format,
+        job.target_format,
+        registry.get_family(source_format),
+        **fields,
+    )
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def _output_signature(output_path):
+    try:
+        stat = os.stat(output_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _remove_partial_output(output_path, signature_before):
+    signature = _output_signature(output_path)
+    if signature is not None and signature != signature_before:
+        try:
+            os.remove(output_path)
+        except OSError:
+            pass
+
+
+def _execute_job(converter, job, progress_callback, cache=None, cancel_event=None, on_event=None):
+    start = time.monotonic()
+    token = CancellationToken(cancel_event, job.timeout)
+    signatures_before = {
+        output_path: _output_signature(output_path) for _target, output_path in job.outputs
+    }
+    cached = None
+
+    event_callback = None
+    if on_event is not None:
+        event_callback = lambda stage, seconds, tool: on_event(
+            _job_event(stage, job, seconds=seconds, tool=tool)
+        )
+        bytes_in = _file_size(job.input_path)
+        on_event(_job_event("started", job, bytes_in=bytes_in))
+
+    try:
+        token.check()
+        cache_key = None
+        # A copy of the input is cheaper to make again than to cache. Jobs with several
+        # outputs skip the cache, which holds one output per entry.
+        if (
+            cache is not None
+            and not job.extra_outputs
+            and not job.options.get("no_cache")
+            and not converter.is_passthrough(job.input_path, job.target_format, job.options)
+        ):
+            cache_key = cache.make_key(job.input_path, job.target_format, job.options)
+            fetch_start = time.perf_counter()
+            cached = cache.fetch(cache_key, job.output_path)
+            if cached and event_callback is not None:
+                event_callback("write", time.perf_counter() - fetch_start, "cache")
+
+        if not cached:
+            converter.convert_file_to_many(
+                job.input_path,
+                job.outputs,
+                progress_callback,
+                options=job.options,
+                cancel_token=token,
+                threads=job.threads,
+                event_callback=event_callback,
+            )
+            if cache_key is not None:
+                cache.store(cache_key, job.output_path)
+    except Exception as e:
+        # Don't leave a truncated file behind where an output should be
+        for output_path, signature_before in signatures_before.items():
+            _remove_partial_output(output_path, signature_before)
+        if isinstance(e, ConversionTimeout):
+            status = "timeout"
+        elif isinstance(e, ConversionCancelled):
+            status = "cancelled"
+        else:
+            status = "failed"
+        elapsed = time.monotonic() - start
+        if on_event is not None:
+            on_event(
+                _job_event(
+                    "failed", job, seconds=elapsed, bytes_in=bytes_in, status=status, error=str(e)
+                )
+            )
+        return ConversionResult(job, False, str(e), elapsed, cached, status)
+
+    elapsed = time.monotonic() - start
+    if on_event is not None:
+        on_event(
+            _job_event(
+                "finished",
+                job,
+                seconds=elapsed,
+                bytes_in=bytes_in,
+                bytes_out=sum(_file_size(output_path) or 0 for _target, output_path in job.outputs),
+                status="ok",
+            )
+        )
+    return ConversionResult(job, True, elapsed=elapsed, cached=cached)
+
+
+def _run_job(job):
+    return _execute_job(
+        _worker_converter,
+        job,
+        lambda progress: _report_progress(job.job_id, progress),
+        _worker_cache,
+        _worker_cancel_event,
+        _report_event if _worker_emit_events else None,
+    )
+
+
+class ConversionEngine:
+    def __init__(
+        self,
+        max_workers=None,
+        mp_context=None,
+        cache=None,
+        timeouts=None,
+        default_timeout=None,
+        cost_classes=None,
+        metadata=None,
+    ):
+        self.max_workers = max_workers or default_max_workers()
+        self.mp_context = mp_context or multiprocessing.get_context()
+        self.cache = cache
+        # Wall-clock limits in seconds per format family, e.g. {"videos": 3600}
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = default_timeout
+        # Per-family overrides of scheduler.COST_CLASSES
+        self.cost_classes = cost_classes
+        # File sizes and probes shared by every conversion of the engine
+        self.metadata = metadata if metadata is not None else MetadataCache()
+        self._cancel_event = None
+        self._futures = set()
+        self._lock = threading.Lock()
+        # Signalled whenever a job is queued, started or finished, or the run is cancelled
+        self._changed = threading.Condition(self._lock)
+
+    def cancel(self):
+        # Pending jobs are dropped; running ones have their tools killed by the
+        # workers' watchdogs and report a "cancelled" result
+        with self._lock:
+            if self._cancel_event is not None:
+                self._cancel_event.set()
+            self._changed.notify_all()
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event is not None and self._cancel_event.is_set()
+
+    def job_timeout(self, job):
+        if job.timeout is not None:
+            return job.timeout
+        return self.timeouts.get(job_family(job), self.default_timeout)
+
+    def run(self, jobs, on_result=None, on_progress=None, on_event=None):
+        # Any iterable of jobs is accepted and consumed lazily, so a long-running
+        # producer (such as the watch daemon) can keep feeding jobs as they appear.
+        if isinstance(jobs, (list, tuple)):
+            if not jobs:
+                return []
+            # A pool only pays off when there is more than one job to spread out. Each
+            # job takes at least one core, so no more run at once than there are jobs.
+            inline = self.max_workers == 1 or len(jobs) == 1
+            pool_size = min(self.max_workers, len(jobs))
+        else:
+            inline = self.max_workers == 1
+            pool_size = self.max_workers
+
+        # Re-entrant: cancelling from inside on_result delivers the dropped jobs right away
+        result_lock = threading.RLock()
+
+        def handle_result(result):
+            # Results arrive from executor threads; deliver them one at a time
+            with result_lock:
+                if self.cache is not None and result.cached is not None:
+                    self.cache.record(result.cached)
+                if on_result:
+                    on_result(result)
+
+        handle_event = None
+        if on_event is not None:
+            event_lock = threading.Lock()
+
+            def handle_event(event):
+                # Events come from the feeder, the progress listener and inline jobs
+                with event_lock:
+                    on_event(event)
+
+        with self._lock:
+            self._cancel_event = threading.Event() if inline else self.mp_context.Event()
+
+        if inline:
+            results = self._run_inline(jobs, handle_result, on_progress, handle_event)
+        else:
+            results = self._run_pool(jobs, pool_size, handle_result, on_progress, handle_event)
+
+        self.flush()
+        return results
+
+    def flush(self):
+        # Applies the cache's size limit and keeps what was learnt about the files; done
+        # after every run, and from time to time by callers whose run never ends
+        if self.cache is not None:
+            self.cache.prune()
+        self.metadata.save()
+
+    def _pending_jobs(self, jobs, on_event):
+        for job in jobs:
+            if self.cancelled:
+                return
+            job.timeout = self.job_timeout(job)
+            if on_event is not None:
+                on_event(_job_event("queued", job))
+            yield job
+
+    def _run_inline(self, jobs, on_result, on_progress, on_event):
+        converter = FileConverter(metadata=self.metadata)
+        results = []
+        for job in self._pending_jobs(jobs, on_event):
+            progress_callback = None
+            if on_progress:
+                progress_callback = lambda progress, job_id=job.job_id: on_progress(
+                    job_id, progress
+                )
+            result = _execute_job(
+                converter, job, progress_callback, self.cache, self._cancel_event, on_event
+            )
+            results.append(result)
+            on_result(result)
+        return results
+
+    def _run_pool(self, jobs, pool_size, on_result, on_progress, on_event):
+        progress_queue = self.mp_context.Queue()
+        listener = threading.Thread(
+            target=self._forward_updates,
+            args=(progress_queue, on_progress, on_event, self.metadata),
+            daemon=True,
+        )
+        listener.start()
+
+        results = []
+        # The cores are shared out by the scheduler whatever the pool size, so a few big
+        # jobs still get the threads their class asks for
+        scheduler = ResourceScheduler(self.max_workers, self.cost_classes)
+        # Jobs read ahead from the iterable as (family, job) pairs, so the scheduler has
+        # some choice of what to start next. Bounded, so the iterable is only drained
+        # about as fast as the workers keep up with it.
+        pending = collections.deque()
+        lookahead = pool_size * 4
+        feed_state = {"done": False, "closed": False, "error": None}
+        # A worker that dies takes the whole pool down with it, and every job the pool
+        # held fails. Those jobs become suspects and are run again one at a time, so
+        # that only the one that kills its worker is reported as failed.
+        pool_state = {"broken": False, "isolated": False}
+        suspects = set()
+
+        def cancelled_result(job):
+            result = ConversionResult(job, False, _("Conversion cancelled"), status="cancelled")
+            results.append(result)
+            on_result(result)
+
+        def feed():
+            try:
+                for job in self._pending_jobs(jobs, on_event):
+                    family = job_family(job)
+                    with self._changed:
+                        while len(pending) >= lookahead and not self.cancelled:
+                            self._changed.wait()
+                        closed = feed_state["closed"]
+                        if not closed:
+                            # Even once cancelled, so that the job is reported below
+                            pending.append((family, job))
+                            self._changed.notify_all()
+                    if closed:
+                        cancelled_result(job)
+                    if self.cancelled:
+                        break
+            except Exception as e:
+                feed_state["error"] = e
+            finally:
+                with self._changed:
+                    feed_state["done"] = True
+                    self._changed.notify_all()
+
+        def pick():
+            if pool_state["isolated"]:
+                return None
+            for index, (_family, job) in enumerate(pending):
+                if job.job_id in suspects:
+                    return None if self._futures else index
+            return scheduler.pick(pending)
+
+        def job_done(family, job, future):
+            error = None if future.cancelled() else future.exception()
+            with self._changed:
+                self._futures.discard(future)
+                scheduler.release(family, job)
+                retry = False
+                if job.job_id in suspects:
+                    pool_state["isolated"] = False
+                    suspects.discard(job.job_id)
+                elif isinstance(error, BrokenProcessPool):
+                    suspects.add(job.job_id)
+                    pending.appendleft((family, job))
+                    retry = True
+                if isinstance(error, BrokenProcessPool):
+                    pool_state["broken"] = True
+                self._changed.notify_all()
+            if retry:
+                return
+            if future.cancelled():
+                cancelled_result(job)
+                return
+            if error is None:
+                result = future.result()
+            else:
+                # The worker itself died (e.g. killed for running out of memory)
+                result = ConversionResult(job, False, _("Worker process failed: {}").format(error))
+            results.append(result)
+            on_result(result)
+
+        def start_pool():
+            return concurrent.futures.ProcessPoolExecutor(
+                max_workers=pool_size,
+                mp_context=self.mp_context,
+                initializer=_init_worker,
+                initargs=(
+                    progress_queue,
+                    self.cache,
+                    self._cancel_event,
+                    on_event is not None,
+                    self.metadata,
+                ),
+            )
+
+        # The producer may block for a long time (the watch daemon waits for files),
+        # so it gets its own thread and never holds up starting queued jobs
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        executor = start_pool()
+        try:
+            while True:
+                with self._changed:
+                    index = None
+                    restart = False
+                    while not self.cancelled:
+                        if feed_state["done"] and not pending and not self._futures:
+                            break
+                        if pool_state["broken"]:
+                            # Replaced once every job it held has come back
+                            if not self._futures:
+                                restart = True
+                                break
+                        else:
+                            index = pick()
+                            if index is not None:
+                                break
+                        self._changed.wait()
+                    if index is not None:
+                        family, job = pending[index]
+                        del pending[index]
+                        job.threads = scheduler.acquire(family, job)
+                        try:
+                            future = executor.submit(_run_job, job)
+                        except BrokenProcessPool:
+                            scheduler.release(family, job)
+                            pending.insert(index, (family, job))
+                            pool_state["broken"] = True
+                            continue
+                        if job.job_id in suspects:
+                            pool_state["isolated"] = True
+                        self._futures.add(future)
+                        self._changed.notify_all()
+                if restart:
+                    executor.shutdown()
+                    executor = start_pool()
+                    pool_state["broken"] = False
+                    continue
+                if index is None:
+                    break
+                # Outside the lock: the callback runs right away if the job already finished
+                future.add_done_callback(partial(job_done, family, job))
+        finally:
+            executor.shutdown()
+            # Jobs that were queued but never started, because the run was cancelled
+            with self._changed:
+                feed_state["closed"] = True
+                dropped = [job for _family, job in pending]
+                pending.clear()
+            for job in dropped:
+                cancelled_result(job)
+            progress_queue.put(None)
+            listener.join()
+            progress_queue.close()
+
+        if feed_state["error"] is not None:
+            raise feed_state["error"]
+        return results
+
+    @staticmethod
+    def _forward_updates(progress_queue, on_progress, on_event, metadata):
+        while True:
+            item = progress_queue.get()
+            if item is None:
+                break
+            if item[0] == "progress":
+                if on_progress:
+                    on_progress(item[1], item[2])
+            elif item[0] == "metadata":
+                metadata.merge(item[1], item[2])
+            elif on_event:
+                on_event(item[1])
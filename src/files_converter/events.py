@@ -0,0 +1,213 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Job lifecycle, in order. The stages in between are reported by the converter as it
+# gets through them; not every conversion has all of them (a cache hit is just "write").
+JOB_EVENTS = ("queued", "started", "finished", "failed")
+STAGES = ("probe", "decode", "encode", "write")
+
+JOB_SECONDS_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 1800)
+
+
+class ConversionEvent:
+    FIELDS = (
+        "kind",
+        "job_id",
+        "input_path",
+        "source_format",
+        "target_format",
+        "family",
+        "timestamp",
+        "seconds",
+        "bytes_in",
+        "bytes_out",
+        "tool",
+        "status",
+        "error",
+    )
+
+    def __init__(
+        self,
+        kind,
+        job_id=None,
+        input_path=None,
+        source_format=None,
+        target_format=None,
+        family=None,
+        timestamp=None,
+        seconds=None,
+        bytes_in=None,
+        bytes_out=None,
+        tool=None,
+        status=None,
+        error=None,
+    ):
+        self.kind = kind
+        self.job_id = job_id
+        self.input_path = input_path
+        self.source_format = source_format
+        self.target_format = target_format
+        self.family = family
+        self.timestamp = timestamp if timestamp is not None else time.time()
+        # Duration of the stage, or of the whole job for "finished" and "failed"
+        self.seconds = seconds
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        # External program or library doing the work, e.g. "ffmpeg" or "pillow"
+        self.tool = tool
+        self.status = status
+        self.error = error
+
+    def to_dict(self):
+        return {
+            field: getattr(self, field) for field in self.FIELDS if getattr(self, field) is not None
+        }
+
+    def __repr__(self):
+        return f"ConversionEvent({self.kind!r}, job={self.job_id}, seconds={self.seconds})"
+
+
+class JsonLinesSink:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self._file.write(json.dumps(event.to_dict()) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _labels(**labels):
+    return ",".join(f'{name}="{value}"' for name, value in sorted(labels.items()))
+
+
+class PrometheusSink:
+    # Aggregates events into counters and writes them in the Prometheus text format,
+    # e.g. for node_exporter's textfile collector. The file is replaced atomically at
+    # most every `write_interval` seconds, and once more on close().
+
+    def __init__(self, path, write_interval=5.0):
+        self.path = path
+        self.write_interval = write_interval
+        self._lock = threading.Lock()
+        self._last_write = 0.0
+        self._queued = 0
+        self._jobs = {}
+        self._job_seconds = {}
+        self._job_counts = {}
+        self._job_buckets = {}
+        self._bytes_in = {}
+        self._bytes_out = {}
+        self._stage_seconds = {}
+        self._stage_runs = {}
+
+    @staticmethod
+    def _add(counter, key, value):
+        counter[key] = counter.get(key, 0) + value
+
+    def __call__(self, event):
+        with self._lock:
+            family = event.family or "unknown"
+            if event.kind == "queued":
+                self._queued += 1
+            elif event.kind in STAGES:
+                key = (family, event.kind, event.tool or "")
+                self._add(self._stage_seconds, key, event.seconds or 0.0)
+                self._add(self._stage_runs, key, 1)
+            elif event.kind in ("finished", "failed"):
+                status = event.status or ("ok" if event.kind == "finished" else "failed")
+                # A format that could not be detected is None, which would not sort
+                source = event.source_format or "unknown"
+                target = event.target_format or "unknown"
+                self._add(self._jobs, (family, source, target, status), 1)
+                seconds = event.seconds or 0.0
+                self._add(self._job_seconds, family, seconds)
+                self._add(self._job_counts, family, 1)
+                buckets = self._job_buckets.setdefault(family, [0] * len(JOB_SECONDS_BUCKETS))
+                for index, bound in enumerate(JOB_SECONDS_BUCKETS):
+                    if seconds <= bound:
+                        buckets[index] += 1
+                self._add(self._bytes_in, family, event.bytes_in or 0)
+                self._add(self._bytes_out, family, event.bytes_out or 0)
+                if time.monotonic() - self._last_write >= self.write_interval:
+                    self._write()
+
+    def render(self):
+        lines = [
+            "# HELP files_converter_jobs_queued_total Conversions handed to the engine.",
+            "# TYPE files_converter_jobs_queued_total counter",
+            f"files_converter_jobs_queued_total {self._queued}",
+            "# HELP files_converter_jobs_total Conversions by outcome.",
+            "# TYPE files_converter_jobs_total counter",
+        ]
+        for (family, source, target, status), count in sorted(self._jobs.items()):
+            labels = _labels(family=family, source=source, target=target, status=status)
+            lines.append(f"files_converter_jobs_total{{{labels}}} {count}")
+
+        lines += [
+            "# HELP files_converter_job_seconds Wall time of whole conversions.",
+            "# TYPE files_converter_job_seconds histogram",
+        ]
+        for family, buckets in sorted(self._job_buckets.items()):
+            for bound, count in zip(JOB_SECONDS_BUCKETS, buckets):
+                labels = _labels(family=family, le=bound)
+                lines.append(f"files_converter_job_seconds_bucket{{{labels}}} {count}")
+            count = self._job_counts[family]
+            labels = _labels(family=family, le="+Inf")
+            lines.append(f"files_converter_job_seconds_bucket{{{labels}}} {count}")
+            labels = _labels(family=family)
+            lines.append(f"files_converter_job_seconds_sum{{{labels}}} {self._job_seconds[family]}")
+            lines.append(f"files_converter_job_seconds_count{{{labels}}} {count}")
+
+        for name, counter, help_text in (
+            ("bytes_in", self._bytes_in, "Input bytes of finished conversions."),
+            ("bytes_out", self._bytes_out, "Output bytes of finished conversions."),
+        ):
+            lines.append(f"# HELP files_converter_{name}_total {help_text}")
+            lines.append(f"# TYPE files_converter_{name}_total counter")
+            for family, value in sorted(counter.items()):
+                lines.append(f"files_converter_{name}_total{{{_labels(family=family)}}} {value}")
+
+        lines += [
+            "# HELP files_converter_stage_seconds_total Time spent per conversion stage.",
+            "# TYPE files_converter_stage_seconds_total counter",
+        ]
+        for (family, stage, tool), seconds in sorted(self._stage_seconds.items()):
+            labels = _labels(family=family, stage=stage, tool=tool)
+            lines.append(f"files_converter_stage_seconds_total{{{labels}}} {seconds}")
+        lines += [
+            "# HELP files_converter_stage_runs_total Conversion stages completed.",
+            "# TYPE files_converter_stage_runs_total counter",
+        ]
+        for (family, stage, tool), runs in sorted(self._stage_runs.items()):
+            labels = _labels(family=family, stage=stage, tool=tool)
+            lines.append(f"files_converter_stage_runs_total{{{labels}}} {runs}")
+        return "\n".join(lines) + "\n"
+
+    def _write(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            # mkstemp makes the file private; collectors often run as another user
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.render())
+            os.replace(temp_path, self.path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._last_write = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self._write()
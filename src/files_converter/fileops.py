@@ -0,0 +1,73 @@
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl(2) request that makes dst share src's extents (btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+
+def _reflink(src_file, dst_file):
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def _copy_file_range(src_file, dst_file):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError("copy_file_range is not available")
+    remaining = os.fstat(src_file.fileno()).st_size
+    while remaining > 0:
+        copied = os.copy_file_range(src_file.fileno(), dst_file.fileno(), remaining)
+        if copied == 0:
+            break
+        remaining -= copied
+
+
+def clone_file(src, dst):
+    # Cheapest first: a reflink shares blocks, copy_file_range stays in the kernel
+    # (and can be offloaded by NFS/CIFS), and a plain copy always works.
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        for method, copy in (("reflink", _reflink), ("copy_file_range", _copy_file_range)):
+            try:
+                copy(src_file, dst_file)
+                return method
+            except OSError:
+                src_file.seek(0)
+                dst_file.seek(0)
+                dst_file.truncate()
+
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+def place_file(src, dst, method="copy"):
+    # For outputs that are byte for byte the input. "rename" moves src to dst (src is
+    # gone afterwards), "hardlink" makes dst another name for it and "copy" clones
+    # it; the first two fall back to a clone across filesystems. Returns the method
+    # actually used.
+    if method == "rename":
+        try:
+            os.replace(src, dst)
+            return "rename"
+        except OSError:
+            copied = clone_file(src, dst)
+            os.remove(src)
+            return copied
+
+    if method == "hardlink":
+        # Linked under a temporary name first, so that an existing dst is replaced
+        # atomically
+        temp_path = f"{dst}.{os.getpid()}.link"
+        try:
+            os.link(src, temp_path)
+            os.replace(temp_path, dst)
+            return "hardlink"
+        except OSError:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+
+    return clone_file(src, dst)
@@ -0,0 +1,145 @@
+import io
+import struct
+
+from PIL import Image
+
+
+def frame_count(img):
+    return getattr(img, "n_frames", 1)
+
+
+def frame_duration(frame):
+    return frame.info.get("duration", 0)
+
+
+def frame_disposal(frame):
+    # Frames come out of Pillow fully composited. Those of a GIF keep their own
+    # disposal, which plays back the same; others are cleared before the next frame
+    # is drawn, or what they leave transparent would show the previous one.
+    disposal = getattr(frame, "disposal_method", None)
+    if disposal is None:
+        return 2 if frame.has_transparency_data else 0
+    return disposal
+
+
+class FrameStream(Image.Image):
+    # A multi-frame image whose frames are decoded, and prepared for the target, only
+    # when seeked to. Pillow's save_all writers seek through the frames in order, so
+    # they never hold more than the frame they are encoding.
+
+    def __init__(self, source, prepare, on_frame=None):
+        super().__init__()
+        self.source = source
+        self.prepare = prepare
+        self.on_frame = on_frame
+        self.n_frames = frame_count(source)
+        self.is_animated = True
+        # Filled in as the frames are reached; handed to the WebP writer as its
+        # per-frame durations, which it reads right after encoding each frame
+        self.durations = []
+        self._frame = None
+        self.seek(0)
+
+    def seek(self, frame):
+        if frame == self._frame:
+            return
+        self.source.seek(frame)
+        self.source.load()
+        prepared = self.prepare(self.source)
+        self.im = prepared.im
+        self._mode = prepared.mode
+        self._size = prepared.size
+        self.palette = prepared.palette
+        self.info = dict(prepared.info)
+        self.disposal_method = frame_disposal(self.source)
+        if frame == len(self.durations):
+            self.durations.append(frame_duration(self.source))
+            if self.on_frame is not None:
+                self.on_frame((frame + 1) / self.n_frames)
+        self._frame = frame
+
+    def tell(self):
+        return self._frame
+
+
+class GifFrameWriter:
+    # Pillow's GIF writer keeps every frame until the end, to merge repeated ones.
+    # Here each frame is encoded by Pillow on its own, as a single-frame GIF, and
+    # spliced into the output with its palette as a local color table.
+
+    def __init__(self, file, size, loop=None):
+        self.file = file
+        file.write(b"GIF89a" + struct.pack("<HHBBB", size[0], size[1], 0, 0, 0))
+        if loop is not None:
+            file.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", loop) + b"\x00")
+
+    def write(self, frame, duration=0, disposal=0, **save_kwargs):
+        buffer = io.BytesIO()
+        frame.save(buffer, format="GIF", **save_kwargs)
+        data = buffer.getvalue()
+
+        # Logical screen descriptor, then the global color table if there is one
+        packed = data[10]
+        color_table = b""
+        if packed & 0x80:
+            color_table = data[13 : 13 + 3 * (2 << (packed & 0x07))]
+        position = 13 + len(color_table)
+
+        # Extensions; only the transparent color of the graphic control one is kept
+        transparency = None
+        while data[position] == 0x21:
+            if data[position + 1] == 0xF9 and data[position + 3] & 0x01:
+                transparency = data[position + 6]
+            position += 2
+            while data[position]:
+                position += data[position] + 1
+            position += 1
+
+        descriptor = bytearray(data[position : position + 10])
+        if color_table and not descriptor[9] & 0x80:
+            descriptor[9] |= 0x80 | (packed & 0x07)
+        else:
+            color_table = b""
+
+        flags = (disposal & 0x07) << 2 | (transparency is not None)
+        self.file.write(
+            b"!\xf9\x04" + struct.pack("<BHBB", flags, round(duration / 10), transparency or 0, 0)
+        )
+        # Descriptor, local color table, then the image data up to the trailer
+        self.file.write(bytes(descriptor) + color_table + data[position + 10 : -1])
+
+    def close(self):
+        self.file.write(b";")
+
+
+FRAME_TARGETS = ("gif", "webp", "tiff")
+
+
+def can_convert_frames(img, target_format):
+    return target_format in FRAME_TARGETS and frame_count(img) > 1
+
+
+def convert_frames(img, output_path, target_format, prepare, save_kwargs, on_frame=None):
+    loop = img.info.get("loop")
+    if target_format == "gif":
+        total = frame_count(img)
+        with open(output_path, "wb") as output_file:
+            writer = None
+            for index in range(total):
+                img.seek(index)
+                img.load()
+                frame = prepare(img)
+                if writer is None:
+                    # Sized from a prepared frame, since frames may have been resized
+                    writer = GifFrameWriter(output_file, frame.size, loop)
+                writer.write(frame, frame_duration(img), frame_disposal(img), **save_kwargs)
+                if on_frame is not None:
+                    on_frame((index + 1) / total)
+            writer.close()
+        return
+
+    stream = FrameStream(img, prepare, on_frame)
+    if target_format == "webp":
+        # A GIF without a loop count plays once, which WebP spells as one loop
+        save_kwargs = dict(save_kwargs, duration=stream.durations, loop=1 if loop is None else loop)
+    stream.save(output_path, format=target_format.upper(), save_all=True, **save_kwargs)
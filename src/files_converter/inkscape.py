@@ -0,0 +1,238 @@
+import contextlib
+import gettext
+import multiprocessing.util
+import os
+import select
+import subprocess
+import threading
+import time
+
+from .cancellation import KILL_GRACE_PERIOD, WATCHDOG_INTERVAL, kill_process_group
+
+_ = gettext.gettext
+
+INKSCAPE = "inkscape"
+# Inkscape 1.x prints this when it is ready for the next line of actions
+PROMPT = b"> "
+# Shells running at once in one process, and files a shell converts before it is
+# replaced, which bounds what a long batch can leak into one Inkscape
+DEFAULT_MAX_SHELLS = 4
+DEFAULT_MAX_JOBS = 100
+# Seconds a shell may wait for its next file before it is closed. Every worker process
+# has its own shells, so idle ones would otherwise hold memory in each of them.
+DEFAULT_IDLE_TIMEOUT = 30.0
+OUTPUT_TAIL = 2000
+
+
+def export_command(input_path, output_path, target_format):
+    return [
+        INKSCAPE,
+        input_path,
+        f"--export-type={target_format}",
+        f"--export-filename={output_path}",
+    ]
+
+
+def export_actions(input_path, output_path, target_format):
+    return [
+        f"file-open:{input_path}",
+        f"export-type:{target_format}",
+        f"export-filename:{output_path}",
+        "export-do",
+        "file-close",
+    ]
+
+
+def can_use_shell(*paths):
+    # Actions are separated by ";" and end at the line, so such paths cannot be given
+    return not any(";" in path or "\n" in path or "\r" in path for path in paths)
+
+
+class InkscapeShell:
+    # One `inkscape --shell`, fed a line of actions per file. The prompt that follows
+    # each line tells when Inkscape is done with it.
+
+    def __init__(self, command=None):
+        self.command = command or [INKSCAPE, "--shell"]
+        self.process = None
+        self.jobs = 0
+        self.idle_since = None
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self, cancel_token=None):
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+        # The banner, up to the first prompt
+        self._read_until_prompt(cancel_token)
+
+    def run(self, actions, cancel_token=None):
+        self.jobs += 1
+        try:
+            self.process.stdin.write(os.fsencode("; ".join(actions)) + b"\n")
+            self.process.stdin.flush()
+        except OSError:
+            raise RuntimeError(_("Inkscape exited unexpectedly"))
+        return self._read_until_prompt(cancel_token)
+
+    def _read_until_prompt(self, cancel_token):
+        output = bytearray()
+        fd = self.process.stdout.fileno()
+        while not output.endswith(PROMPT):
+            if cancel_token is not None and (cancel_token.cancelled or cancel_token.expired):
+                self.kill()
+                cancel_token.check()
+            ready, _unused, _unused = select.select([fd], [], [], WATCHDOG_INTERVAL)
+            if not ready:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                self.kill()
+                message = _("Inkscape exited unexpectedly")
+                tail = output.decode(errors="replace").strip()[-OUTPUT_TAIL:]
+                raise RuntimeError("\n".join([message, tail]) if tail else message)
+            output += chunk
+        return output[: -len(PROMPT)].decode(errors="replace")
+
+    def kill(self):
+        if self.process is not None:
+            kill_process_group(self.process)
+            self._close_pipes()
+
+    def close(self):
+        if not self.alive:
+            self._close_pipes()
+            return
+        try:
+            self.process.stdin.write(b"quit\n")
+            self.process.stdin.flush()
+            self.process.wait(KILL_GRACE_PERIOD)
+        except (OSError, subprocess.TimeoutExpired):
+            kill_process_group(self.process)
+        self._close_pipes()
+
+    def _close_pipes(self):
+        for pipe in (self.process.stdin, self.process.stdout):
+            with contextlib.suppress(OSError):
+                pipe.close()
+        with contextlib.suppress(subprocess.TimeoutExpired):
+            self.process.wait(KILL_GRACE_PERIOD)
+
+
+class InkscapePool:
+    # Long-lived Inkscape shells, so that a batch of vectors pays Inkscape's startup once
+    # per shell rather than once per file. A shell that fails a file, or has converted
+    # max_jobs files, is closed and a fresh one started for the next file.
+
+    def __init__(
+        self,
+        max_shells=DEFAULT_MAX_SHELLS,
+        max_jobs=DEFAULT_MAX_JOBS,
+        command=None,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT,
+    ):
+        self.max_jobs = max_jobs
+        self.command = command
+        self.idle_timeout = idle_timeout
+        self.started = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_shells)
+        self._reaper = None
+
+    def _acquire_slot(self, cancel_token):
+        while not self._slots.acquire(timeout=WATCHDOG_INTERVAL):
+            if cancel_token is not None:
+                cancel_token.check()
+
+    @contextlib.contextmanager
+    def shell(self, cancel_token=None):
+        self._acquire_slot(cancel_token)
+        shell = None
+        healthy = False
+        try:
+            with self._lock:
+                while self._idle and shell is None:
+                    shell = self._idle.pop()
+                    if not shell.alive:
+                        shell.close()
+                        shell = None
+            if shell is None:
+                shell = InkscapeShell(self.command)
+                with self._lock:
+                    self.started += 1
+                shell.start(cancel_token)
+            yield shell
+            healthy = True
+        finally:
+            if shell is not None:
+                if healthy and shell.alive and shell.jobs < self.max_jobs:
+                    shell.idle_since = time.monotonic()
+                    with self._lock:
+                        self._idle.append(shell)
+                        self._start_reaper()
+                else:
+                    shell.close()
+            self._slots.release()
+
+    def convert(self, input_path, output_path, target_format, cancel_token=None):
+        with self.shell(cancel_token) as shell:
+            # Inkscape reports failures only as text, so success is an output it has
+            # just written
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            output = shell.run(export_actions(input_path, output_path, target_format), cancel_token)
+            if not os.path.isfile(output_path) or os.path.getsize(output_path) == 0:
+                message = _("Inkscape could not convert {}").format(input_path)
+                tail = output.strip()[-OUTPUT_TAIL:]
+                raise RuntimeError("\n".join([message, tail]) if tail else message)
+
+    def _start_reaper(self):
+        # Called with the lock held; the reaper runs while there are idle shells
+        if self.idle_timeout is not None and self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap, daemon=True)
+            self._reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(self.idle_timeout / 2)
+            deadline = time.monotonic() - self.idle_timeout
+            with self._lock:
+                expired = [shell for shell in self._idle if shell.idle_since <= deadline]
+                self._idle = [shell for shell in self._idle if shell.idle_since > deadline]
+                done = not self._idle
+                if done:
+                    self._reaper = None
+            for shell in expired:
+                shell.close()
+            if done:
+                return
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for shell in idle:
+            shell.close()
+
+
+_shared_pool = None
+_shared_pool_pid = None
+
+
+def shared_pool():
+    # One pool per process; a worker process forked from one that already had a pool
+    # starts its own rather than sharing the parent's shells. Pool workers leave through
+    # os._exit(), past atexit, but multiprocessing runs its finalizers first.
+    global _shared_pool, _shared_pool_pid
+    if _shared_pool is None or _shared_pool_pid != os.getpid():
+        _shared_pool = InkscapePool()
+        _shared_pool_pid = os.getpid()
+        multiprocessing.util.Finalize(_shared_pool, _shared_pool.close, exitpriority=10)
+    return _shared_pool
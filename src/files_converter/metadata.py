@@ -0,0 +1,115 @@
+import json
+import mimetypes
+import os
+import tempfile
+import threading
+
+METADATA_VERSION = 1
+DEFAULT_MAX_ENTRIES = 100000
+
+
+def default_metadata_path():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "files-converter", "metadata.json")
+
+
+class MetadataCache:
+    # What is known about each file (size, times, mime type, ffprobe output), keyed by
+    # its path and checked against its size and modification time on every lookup, so
+    # a file that changed is looked at afresh. With a path, entries are kept across
+    # runs in a JSON file, written by save().
+
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        # Called as on_probe(path, entry) after a probe, e.g. to hand it to another process
+        self.on_probe = None
+        self.probes = 0
+        self._entries = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        if path is not None:
+            self.load()
+
+    def __getstate__(self):
+        # Handed to worker processes without the lock, the callback or the file
+        with self._lock:
+            return {"max_entries": self.max_entries, "entries": dict(self._entries)}
+
+    def __setstate__(self, state):
+        self.__init__(max_entries=state["max_entries"])
+        self._entries = state["entries"]
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == METADATA_VERSION:
+            with self._lock:
+                self._entries.update(data.get("entries", {}))
+
+    def save(self):
+        if self.path is None or not self._dirty:
+            return
+        with self._lock:
+            entries = list(self._entries.items())[-self.max_entries :]
+            self._dirty = False
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"version": METADATA_VERSION, "entries": dict(entries)}, f)
+            os.replace(temp_path, self.path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _entry(self, path):
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if (
+                entry is None
+                or entry["size"] != stat.st_size
+                or entry["mtime_ns"] != stat.st_mtime_ns
+            ):
+                entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "ctime": stat.st_ctime}
+                self._entries[key] = entry
+                self._dirty = True
+            return entry
+
+    def size(self, path):
+        return self._entry(path)["size"]
+
+    def info(self, path):
+        entry = self._entry(path)
+        if "mime_type" not in entry:
+            entry["mime_type"] = mimetypes.guess_type(path)[0]
+        return entry
+
+    def has_probe(self, path):
+        return "probe" in self._entry(path)
+
+    def probe(self, path):
+        # ffprobe's view of a media file, run at most once per version of the file
+        entry = self._entry(path)
+        if "probe" not in entry:
+            import ffmpeg
+
+            entry["probe"] = ffmpeg.probe(path)
+            self.probes += 1
+            with self._lock:
+                self._dirty = True
+            if self.on_probe is not None:
+                self.on_probe(os.path.abspath(path), entry)
+        return entry["probe"]
+
+    def merge(self, path, entry):
+        with self._lock:
+            self._entries[path] = entry
+            self._dirty = True
@@ -0,0 +1,196 @@
+import gettext
+
+_ = gettext.gettext
+
+# Pillow is imported where it is used, since the command line reads the presets from here
+
+RESIZE_OPTIONS = ("max_size", "scale", "thumbnail")
+# Pillow shrinks by a whole factor with reduce() while the image stays at least this
+# many times the target size, and only resamples what is left (see Image.resize)
+REDUCING_GAP = 3.0
+
+# Save options per target, trading encoding time against file size. Quality settings
+# are the same in every preset, so the choice never changes how an image looks.
+ENCODER_PRESETS = {
+    "fast": {
+        "jpeg": {"quality": 75, "optimize": False, "progressive": False},
+        "png": {"compress_level": 1},
+        "webp": {"quality": 80, "method": 0},
+        "tiff": {"compression": "packbits"},
+    },
+    "balanced": {
+        "jpeg": {"quality": 75, "optimize": True, "progressive": False},
+        "png": {"compress_level": 6},
+        "webp": {"quality": 80, "method": 4},
+        "tiff": {"compression": "tiff_deflate"},
+    },
+    "small": {
+        "jpeg": {"quality": 75, "optimize": True, "progressive": True},
+        "png": {"compress_level": 9},
+        "webp": {"quality": 80, "method": 6},
+        "tiff": {"compression": "tiff_deflate"},
+    },
+}
+DEFAULT_PRESET = "balanced"
+
+# Modes each target stores as they are. Anything else is converted once, to the closest
+# mode the target has; GIF palettizes RGB itself, better than a conversion of ours would.
+TARGET_MODES = {
+    "jpeg": {"L", "RGB", "CMYK"},
+    "png": {"1", "L", "LA", "P", "RGB", "RGBA", "I;16"},
+    "webp": {"RGB", "RGBA"},
+    "tiff": {"1", "L", "LA", "P", "RGB", "RGBA", "CMYK", "I;16", "I", "F"},
+    "gif": {"1", "L", "P", "RGB", "RGBA"},
+    "bmp": {"1", "L", "P", "RGB"},
+}
+GRAYSCALE_MODES = {"1", "L", "LA", "La", "I", "I;16", "F"}
+# Targets that keep the transparent color of a palette image
+PALETTE_TRANSPARENCY = {"png", "gif"}
+
+
+def resize_requested(options):
+    return any(options.get(name) for name in RESIZE_OPTIONS)
+
+
+def resize_plan(size, options):
+    # The size to scale to and the size to crop to afterwards, which only differ for
+    # thumbnails; None when the options don't ask for a resize
+    requested = [name for name in RESIZE_OPTIONS if options.get(name)]
+    if not requested:
+        return None
+    if len(requested) > 1:
+        raise ValueError(_("Only one of {} can be given").format(", ".join(requested)))
+    name = requested[0]
+    value = options[name]
+    if value <= 0:
+        raise ValueError(_("Invalid {}: {}").format(name, value))
+
+    width, height = size
+    if name == "max_size":
+        ratio = min(value / max(width, height), 1.0)
+    elif name == "scale":
+        ratio = value
+    else:
+        # Fills a value x value square; the overflow of the longer side is cropped
+        ratio = min(max(value / width, value / height), 1.0)
+    scaled_size = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+    if name == "thumbnail":
+        return scaled_size, (min(value, scaled_size[0]), min(value, scaled_size[1]))
+    return scaled_size, scaled_size
+
+
+def reduce_factor(size, scaled_size, gap=REDUCING_GAP):
+    ratio = min(size[0] / scaled_size[0], size[1] / scaled_size[1])
+    return max(int(ratio / gap), 1)
+
+
+def draft(img, scaled_size):
+    # JPEG decodes straight to 1/2, 1/4 or 1/8 scale when asked before load(), which
+    # skips most of the decoding work; the result is never smaller than scaled_size.
+    # Other formats ignore drafts.
+    if scaled_size[0] < img.width and scaled_size[1] < img.height:
+        img.draft(img.mode, scaled_size)
+
+
+def resize(img, scaled_size, final_size):
+    from PIL import Image
+
+    if img.mode in ("1", "P") and img.size != scaled_size:
+        # These would only be resized nearest-neighbour
+        img = img.convert(
+            "L" if img.mode == "1" else "RGBA" if img.has_transparency_data else "RGB"
+        )
+    if img.size != scaled_size:
+        img = img.resize(scaled_size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+    if final_size != scaled_size:
+        left = (scaled_size[0] - final_size[0]) // 2
+        top = (scaled_size[1] - final_size[1]) // 2
+        img = img.crop((left, top, left + final_size[0], top + final_size[1]))
+    return img
+
+
+def encoder_format(target_format):
+    target_format = target_format.lower()
+    return "jpeg" if target_format == "jpg" else target_format
+
+
+def save_options(target_format, options):
+    # The preset's save options for the target, with the per-format overrides of
+    # options["encoder_options"], e.g. {"jpeg": {"quality": 90}}, on top
+    preset = options.get("preset") or DEFAULT_PRESET
+    if preset not in ENCODER_PRESETS:
+        raise ValueError(_("Unknown encoder preset: {}").format(preset))
+    target_format = encoder_format(target_format)
+    save_kwargs = dict(ENCODER_PRESETS[preset].get(target_format, {}))
+    save_kwargs.update(options.get("encoder_options", {}).get(target_format, {}))
+    return save_kwargs
+
+
+def strip_compress_level(target_format, options):
+    # zlib level for the streaming PNG and TIFF writers, which only deflate
+    save_kwargs = save_options(target_format, options)
+    if "compress_level" in save_kwargs:
+        return save_kwargs["compress_level"]
+    preset = options.get("preset") or DEFAULT_PRESET
+    return ENCODER_PRESETS[preset]["png"]["compress_level"]
+
+
+def can_stream(target_format, options):
+    # Strips are always deflated, so a TIFF asked to be compressed otherwise is
+    # written whole
+    if encoder_format(target_format) == "tiff":
+        return save_options(target_format, options).get("compression") == "tiff_deflate"
+    return True
+
+
+def flatten(img, mode):
+    # Composites onto white in a single pass: paste() takes the alpha straight from
+    # the image, with no separate alpha band or intermediate copy
+    from PIL import Image
+
+    if img.mode not in ("RGBA", "LA"):
+        img = img.convert("RGBA")
+    background = Image.new(mode, img.size, "white")
+    background.paste(img, mask=img)
+    return background
+
+
+def fit_to_16_bits(img):
+    # Mode "I" holds 32-bit samples, most often 16-bit ones widened. Those are kept as
+    # they are; a wider range is scaled down to 16 bits rather than clipped.
+    low, high = img.getextrema()
+    low, high = min(low, 0), max(high, 65535)
+    if (low, high) == (0, 65535):
+        return img
+    scale = 65535 / (high - low)
+    return img.point(lambda value: value * scale - low * scale)
+
+
+def prepare_for_target(img, target_format):
+    # The image itself when the target can store its mode, otherwise one conversion
+    target_format = encoder_format(target_format)
+    modes = TARGET_MODES.get(target_format)
+    if modes is None:
+        return img
+    if img.mode in modes and not (
+        img.mode == "P" and "transparency" in img.info and target_format not in PALETTE_TRANSPARENCY
+    ):
+        return img
+    grayscale = img.mode in GRAYSCALE_MODES
+    if img.mode == "I":
+        img = fit_to_16_bits(img)
+        if "I;16" in modes:
+            return img.convert("I;16")
+    if img.mode in ("I;16", "I"):
+        # 16-bit samples, which convert() would clip to 8 bits rather than scale
+        img = img.point(lambda value: value / 256)
+
+    if img.has_transparency_data:
+        for mode in ("LA", "RGBA") if grayscale else ("RGBA",):
+            if mode in modes:
+                return img.convert(mode)
+        return flatten(img, "L" if grayscale and "L" in modes else "RGB")
+    for mode in ("L", "RGB") if grayscale else ("RGB",):
+        if mode in modes:
+            return img.convert(mode)
+    return img.convert("RGB")
@@ -0,0 +1,111 @@
+import os
+
+# Entry point group that third-party packages can use to register converters:
+# each entry point is a callable that receives the registry and calls register().
+PLUGIN_GROUP = "files_converter.converters"
+
+
+class FormatRegistry:
+    def __init__(self):
+        self._families = {}
+        self._format_families = {}
+        self._converters = {}
+        self._targets = {}
+        self._aliases = {}
+        self._max_suffix_parts = 1
+        self._plugins_loaded = False
+
+    def add_family(self, family, formats):
+        family_formats = self._families.setdefault(family, [])
+        for fmt in formats:
+            fmt = fmt.lower()
+            if fmt not in family_formats:
+                family_formats.append(fmt)
+            families = self._format_families.setdefault(fmt, [])
+            if family not in families:
+                families.append(family)
+            self._max_suffix_parts = max(self._max_suffix_parts, fmt.count(".") + 1)
+
+    def add_alias(self, alias, fmt):
+        # Another extension for the same format, e.g. "jpeg" for "jpg"
+        self._aliases[alias.lower()] = fmt.lower()
+
+    def same_format(self, source_format, target_format):
+        return self._aliases.get(source_format, source_format) == self._aliases.get(
+            target_format, target_format
+        )
+
+    def register(self, source_format, target_format, handler, family=None, replace=False):
+        source_format = source_format.lower()
+        target_format = target_format.lower()
+        if family is not None:
+            self.add_family(family, [source_format, target_format])
+        elif source_format not in self._format_families:
+            raise ValueError(f"Unknown format {source_format!r}; pass the family it belongs to")
+
+        key = (source_format, target_format)
+        if key in self._converters and not replace:
+            return False
+        self._converters[key] = handler
+        targets = self._targets.setdefault(source_format, [])
+        if target_format not in targets:
+            targets.append(target_format)
+        return True
+
+    def register_family_converter(self, family, formats, handler):
+        self.add_family(family, formats)
+        for source_format in formats:
+            for target_format in formats:
+                if source_format != target_format:
+                    self.register(source_format, target_format, handler)
+
+    def detect_format(self, file_path):
+        parts = os.path.basename(file_path).lower().split(os.extsep)
+        # Longest suffix first, so "tar.gz" wins over "gz" and "my.photo.jpg" is a "jpg"
+        for count in range(min(self._max_suffix_parts, len(parts) - 1), 0, -1):
+            suffix = ".".join(parts[-count:])
+            if suffix in self._format_families:
+                return suffix
+        return None
+
+    def strip_format(self, file_path):
+        fmt = self.detect_format(file_path)
+        if fmt is None:
+            return os.path.splitext(file_path)[0]
+        return file_path[: -(len(fmt) + 1)]
+
+    def get_family(self, fmt):
+        families = self._format_families.get(fmt)
+        return families[0] if families else None
+
+    def get_converter(self, source_format, target_format):
+        return self._converters.get((source_format, target_format))
+
+    def get_targets(self, source_format):
+        return list(self._targets.get(source_format, []))
+
+    def families(self):
+        return {family: list(formats) for family, formats in self._families.items()}
+
+    def conversions(self):
+        return {source: list(targets) for source, targets in self._targets.items()}
+
+    def load_plugins(self):
+        if self._plugins_loaded:
+            return
+        self._plugins_loaded = True
+
+        from importlib.metadata import entry_points
+
+        for entry_point in entry_points(group=PLUGIN_GROUP):
+            try:
+                entry_point.load()(self)
+            except Exception as e:
+                print(f"Failed to load converter plugin {entry_point.name}: {e}")
+
+
+registry = FormatRegistry()
+
+
+def register_converter(source_format, target_format, handler, family=None, replace=False):
+    return registry.register(source_format, target_format, handler, family, replace)
@@ -0,0 +1,37 @@
+import os
+
+
+def get_supported_extensions(supported_formats):
+    supported_extensions = set()
+    for formats in supported_formats.values():
+        supported_extensions.update(f".{fmt.lower()}" for fmt in formats)
+    return supported_extensions
+
+
+def is_supported_file(file_path, supported_extensions):
+    # Try every suffix so that both "archive.tar.gz" and "my.photo.jpg" are recognised
+    suffixes = os.path.basename(file_path).lower().split(os.extsep)[1:]
+    for start in range(len(suffixes)):
+        if "." + ".".join(suffixes[start:]) in supported_extensions:
+            return file_path
+    return None
+
+
+def scan_folder(folder_path, supported_extensions):
+    # The extension check is a cheap string operation, so the walk is done inline
+    # rather than fanning the names out to worker processes.
+    for root, dirs, files in os.walk(folder_path):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            if is_supported_file(file_path, supported_extensions):
+                yield file_path
+
+
+def scan_paths(paths, supported_extensions):
+    for path in paths:
+        if os.path.isfile(path):
+            if is_supported_file(path, supported_extensions):
+                yield path
+        elif os.path.isdir(path):
+            yield from scan_folder(path, supported_extensions)
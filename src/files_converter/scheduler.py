@@ -0,0 +1,100 @@
+import os
+
+from .registry import registry
+
+
+class CostClass:
+    def __init__(self, weight=1.0, threads=1, max_concurrent=None):
+        # Relative cost of converting one byte, compared to a photo
+        self.weight = weight
+        # CPU cores one conversion keeps busy
+        self.threads = threads
+        # Cap on simultaneous conversions, for work bound by something other than the CPU
+        self.max_concurrent = max_concurrent
+
+    def __repr__(self):
+        return (
+            f"CostClass(weight={self.weight}, threads={self.threads}, "
+            f"max_concurrent={self.max_concurrent})"
+        )
+
+
+COST_CLASSES = {
+    "photos": CostClass(1),
+    # x264 and friends scale well up to a handful of threads per encode
+    "videos": CostClass(5, threads=4),
+    # Each conversion renders in an Inkscape shell taking a few hundred MB
+    "vectors": CostClass(2, max_concurrent=4),
+    "audio": CostClass(1.5),
+    "documents": CostClass(1),
+    # Extracting and recompressing mostly waits on the disk
+    "archives": CostClass(3, max_concurrent=2),
+    "ebooks": CostClass(1.2, threads=2),
+}
+DEFAULT_COST_CLASS = CostClass()
+
+
+def job_family(job):
+    return registry.get_family(registry.detect_format(job.input_path))
+
+
+class ResourceScheduler:
+    # Places jobs so that the threads of all running conversions add up to at most
+    # `cpu_budget`, and no family runs more conversions than its class allows.
+    # Not thread-safe: the engine calls it under its own lock.
+
+    def __init__(self, cpu_budget=None, cost_classes=None):
+        self.cpu_budget = max(cpu_budget or os.cpu_count() or 1, 1)
+        self.cost_classes = dict(COST_CLASSES)
+        self.cost_classes.update(cost_classes or {})
+        self.free_cpus = self.cpu_budget
+        self.running = {}
+        # How often the oldest waiting job has been overtaken by smaller ones
+        self._overtaken = 0
+
+    def cost_class(self, family):
+        return self.cost_classes.get(family, DEFAULT_COST_CLASS)
+
+    def threads_for(self, family, job=None):
+        threads = self.cost_class(family).threads
+        # A video encoded in segments runs an encoder for each of them at once
+        segments = getattr(job, "options", {}).get("segments") if family == "videos" else None
+        if segments and segments > 1:
+            threads *= segments
+        return min(threads, self.cpu_budget)
+
+    def _has_slot(self, family):
+        max_concurrent = self.cost_class(family).max_concurrent
+        return max_concurrent is None or self.running.get(family, 0) < max_concurrent
+
+    def _fits(self, family, job=None):
+        return self.threads_for(family, job) <= self.free_cpus
+
+    def pick(self, pending):
+        # First fit over (family, job) pairs, oldest first. Small jobs may overtake a
+        # big one waiting for cores, but only so often, or a steady stream of photos
+        # could keep a video waiting forever.
+        for index, (family, job) in enumerate(pending):
+            if not self._has_slot(family):
+                continue
+            if self._fits(family, job):
+                self._overtaken = 0
+                return index
+            if self._overtaken >= self.cpu_budget:
+                return None
+            for later_index in range(index + 1, len(pending)):
+                later_family, later_job = pending[later_index]
+                if self._has_slot(later_family) and self._fits(later_family, later_job):
+                    self._overtaken += 1
+                    return later_index
+            return None
+        return None
+
+    def acquire(self, family, job=None):
+        self.free_cpus -= self.threads_for(family, job)
+        self.running[family] = self.running.get(family, 0) + 1
+        return self.threads_for(family, job)
+
+    def release(self, family, job=None):
+        self.free_cpus += self.threads_for(family, job)
+        self.running[family] -= 1
@@ -0,0 +1,366 @@
+import struct
+import zlib
+
+from PIL import Image, ImageChops
+
+# Images whose decoded size is above this are converted a band of rows at a time
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+# A band exists several times over at once: decoded, converted, packed and encoded
+BAND_COPIES = 6
+# TIFF strips are kept small so that other readers don't need much memory either
+TIFF_STRIP_BYTES = 1024 * 1024
+
+
+def bytes_per_pixel(mode):
+    return len(Image.new(mode, (1, 1)).tobytes())
+
+
+def decoded_size(img):
+    return img.width * img.height * bytes_per_pixel(img.mode)
+
+
+def strip_layout(img):
+    # The decoder tiles of an image stored as uncompressed full-width rows, as
+    # (y0, y1, offset, rawmode, stride, orientation); None when the decoder can only
+    # produce the whole image at once (PNG, JPEG, compressed TIFF, ...)
+    layout = []
+    for tile in img.tile:
+        codec, extents, offset, args = tuple(tile)[:4]
+        x0, y0, x1, y1 = extents
+        if codec != "raw" or x0 != 0 or x1 != img.width:
+            return None
+        if isinstance(args, str):
+            args = (args,)
+        rawmode = args[0]
+        stride = args[1] if len(args) > 1 else 0
+        orientation = args[2] if len(args) > 2 else 1
+        if stride < 0:
+            return None
+        if not stride:
+            try:
+                stride = len(Image.new(img.mode, (img.width, 1)).tobytes("raw", rawmode))
+            except (ValueError, OSError):
+                return None
+        layout.append((y0, y1, offset, rawmode, stride, orientation))
+    return layout or None
+
+
+def can_convert_in_strips(img, target_format):
+    return target_format in STRIP_WRITERS and strip_layout(img) is not None
+
+
+def open_unbounded(path):
+    # Pillow refuses to open images above MAX_IMAGE_PIXELS to protect against
+    # decompression bombs; reading strip by strip keeps memory bounded regardless
+    max_image_pixels = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        return Image.open(path)
+    finally:
+        Image.MAX_IMAGE_PIXELS = max_image_pixels
+
+
+def read_band(file, layout, mode, width, y0, y1):
+    # Rows y0..y1 read straight from the file, so only the band is ever in memory
+    band = None
+    for tile_y0, tile_y1, offset, rawmode, stride, orientation in layout:
+        top, bottom = max(y0, tile_y0), min(y1, tile_y1)
+        if top >= bottom:
+            continue
+        if orientation < 0:
+            # Stored bottom-up, so the band's last row comes first
+            offset += (tile_y1 - bottom) * stride
+        else:
+            offset += (top - tile_y0) * stride
+        file.seek(offset)
+        data = file.read((bottom - top) * stride)
+        part = Image.frombytes(
+            mode, (width, bottom - top), data, "raw", rawmode, stride, orientation
+        )
+        if top == y0 and bottom == y1:
+            return part
+        if band is None:
+            band = Image.new(mode, (width, y1 - y0))
+        band.paste(part, (0, top - y0))
+    return band
+
+
+class PngStripWriter:
+    MODES = {
+        "L": (8, 0, "L"),
+        "LA": (8, 4, "LA"),
+        "RGB": (8, 2, "RGB"),
+        "RGBA": (8, 6, "RGBA"),
+        "I;16": (16, 0, "I;16B"),
+    }
+    MAX_CHUNK = 1 << 30
+
+    def __init__(self, file, width, height, mode, rows_per_strip, compress_level=6):
+        bit_depth, color_type, self.rawmode = self.MODES[mode]
+        self.file = file
+        self.row_bytes = len(Image.new(mode, (width, 1)).tobytes("raw", self.rawmode))
+        self._compressor = zlib.compressobj(compress_level)
+        self._previous_row = bytes(self.row_bytes)
+        file.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, bit_depth, color_type, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)) + kind + data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def _write_idat(self, data):
+        for start in range(0, len(data), self.MAX_CHUNK):
+            self._chunk(b"IDAT", data[start : start + self.MAX_CHUNK])
+
+    def write(self, band):
+        data = band.tobytes("raw", self.rawmode)
+        rows = band.height
+        # "Up" filter (each byte minus the one above it), done by Pillow on the band
+        # viewed as a grayscale image so that no per-byte Python loop is needed
+        current = Image.frombytes("L", (self.row_bytes, rows), data)
+        above = Image.new("L", (self.row_bytes, rows))
+        above.paste(Image.frombytes("L", (self.row_bytes, 1), self._previous_row), (0, 0))
+        if rows > 1:
+            above.paste(current.crop((0, 0, self.row_bytes, rows - 1)), (0, 1))
+        filtered = ImageChops.subtract_modulo(current, above).tobytes()
+        self._previous_row = data[-self.row_bytes :]
+
+        row_bytes = self.row_bytes
+        self._write_idat(
+            self._compressor.compress(
+                b"".join(
+                    b"\x02" + filtered[row * row_bytes : (row + 1) * row_bytes]
+                    for row in range(rows)
+                )
+            )
+        )
+
+    def close(self):
+        self._write_idat(self._compressor.flush())
+        self._chunk(b"IEND", b"")
+
+
+class TiffStripWriter:
+    # (samples per pixel, bits per sample, photometric interpretation, extra samples)
+    MODES = {
+        "L": (1, 8, 1, None, "L"),
+        "LA": (2, 8, 1, 2, "LA"),
+        "RGB": (3, 8, 2, None, "RGB"),
+        "RGBA": (4, 8, 2, 2, "RGBA"),
+        "I;16": (1, 16, 1, None, "I;16"),
+    }
+    SHORT = 3
+    LONG = 4
+    LONG8 = 16
+    TYPE_FORMATS = {SHORT: "H", LONG: "I", LONG8: "Q"}
+    DEFLATE = 8
+
+    def __init__(self, file, width, height, mode, rows_per_strip, compress_level=6):
+        samples, bits, self.photometric, self.extra_samples, self.rawmode = self.MODES[mode]
+        self.file = file
+        self.width = width
+        self.height = height
+        self.samples = samples
+        self.bits = bits
+        self.rows_per_strip = rows_per_strip
+        self.compress_level = compress_level
+        self.row_bytes = width * samples * bits // 8
+        self.offsets = []
+        self.byte_counts = []
+        # Classic TIFF offsets are 32 bits; BigTIFF is only used when they may not fit
+        self.bigtiff = self.row_bytes * height > 0xFFFFFFFF - (1 << 24)
+        if self.bigtiff:
+            file.write(b"II+\x00" + struct.pack("<HHQ", 8, 0, 0))
+        else:
+            file.write(b"II*\x00" + struct.pack("<I", 0))
+
+    def write(self, band):
+        data = band.tobytes("raw", self.rawmode)
+        strip_bytes = self.rows_per_strip * self.row_bytes
+        for start in range(0, len(data), strip_bytes):
+            compressed = zlib.compress(data[start : start + strip_bytes], self.compress_level)
+            self.offsets.append(self.file.tell())
+            self.byte_counts.append(len(compressed))
+            self.file.write(compressed)
+
+    def close(self):
+        file = self.file
+        offset_type = self.LONG8 if self.bigtiff else self.LONG
+        entries = [
+            (256, self.LONG, [self.width]),
+            (257, self.LONG, [self.height]),
+            (258, self.SHORT, [self.bits] * self.samples),
+            (259, self.SHORT, [self.DEFLATE]),
+            (262, self.SHORT, [self.photometric]),
+            (273, offset_type, self.offsets),
+            (277, self.SHORT, [self.samples]),
+            (278, self.LONG, [self.rows_per_strip]),
+            (279, offset_type, self.byte_counts),
+            (284, self.SHORT, [1]),
+        ]
+        if self.extra_samples is not None:
+            entries.append((338, self.SHORT, [self.extra_samples]))
+
+        pointer = "<Q" if self.bigtiff else "<I"
+        value_size = struct.calcsize(pointer)
+        directory = []
+        for tag, value_type, values in entries:
+            data = struct.pack(f"<{len(values)}{self.TYPE_FORMATS[value_type]}", *values)
+            if len(data) > value_size:
+                # Values that don't fit in the entry are stored before the directory
+                if file.tell() % 2:
+                    file.write(b"\x00")
+                value_offset = file.tell()
+                file.write(data)
+                data = struct.pack(pointer, value_offset)
+            directory.append((tag, value_type, len(values), data.ljust(value_size, b"\x00")))
+
+        if file.tell() % 2:
+            file.write(b"\x00")
+        directory_offset = file.tell()
+        entry_header = "<HHQ" if self.bigtiff else "<HHI"
+        file.write(struct.pack("<Q" if self.bigtiff else "<H", len(directory)))
+        for tag, value_type, count, data in directory:
+            file.write(struct.pack(entry_header, tag, value_type, count) + data)
+        file.write(struct.pack(pointer, 0))
+
+        file.seek(8 if self.bigtiff else 4)
+        file.write(struct.pack(pointer, directory_offset))
+        file.seek(0, 2)
+
+
+class BmpStripWriter:
+    # Written top-down (negative height), so rows can be appended in order
+    MODES = {"L": (8, "L"), "RGB": (24, "BGR"), "RGBA": (32, "BGRA")}
+
+    def __init__(self, file, width, height, mode, rows_per_strip, compress_level=None):
+        bits, self.rawmode = self.MODES[mode]
+        self.file = file
+        self.row_bytes = width * bits // 8
+        self.padding = b"\x00" * (-self.row_bytes % 4)
+        palette = b"".join(bytes((i, i, i, 0)) for i in range(256)) if mode == "L" else b""
+        pixel_offset = 14 + 40 + len(palette)
+        image_size = (self.row_bytes + len(self.padding)) * height
+        if pixel_offset + image_size > 0xFFFFFFFF:
+            raise ValueError("Image is too large for the BMP format")
+        file.write(b"BM" + struct.pack("<IHHI", pixel_offset + image_size, 0, 0, pixel_offset))
+        file.write(
+            struct.pack(
+                "<IiiHHIIiiII",
+                40,
+                width,
+                -height,
+                1,
+                bits,
+                0,
+                image_size,
+                2835,
+                2835,
+                256 if palette else 0,
+                0,
+            )
+        )
+        file.write(palette)
+
+    def write(self, band):
+        data = band.tobytes("raw", self.rawmode)
+        if self.padding:
+            data = b"".join(
+                data[start : start + self.row_bytes] + self.padding
+                for start in range(0, len(data), self.row_bytes)
+            )
+        self.file.write(data)
+
+    def close(self):
+        pass
+
+
+STRIP_WRITERS = {"png": PngStripWriter, "tiff": TiffStripWriter, "bmp": BmpStripWriter}
+# Modes reduce() works in, and the mode each is averaged in
+REDUCE_MODES = {
+    "L": "L",
+    "LA": "La",
+    "RGB": "RGB",
+    "RGBA": "RGBa",
+    "I": "I",
+    "I;16": "I",
+    "F": "F",
+}
+
+
+def convert_in_strips(
+    input_path,
+    img,
+    output_path,
+    target_format,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+    prepare_band=None,
+    on_band=None,
+    compress_level=6,
+):
+    layout = strip_layout(img)
+    width, height = img.size
+    writer_class = STRIP_WRITERS[target_format]
+
+    # Rows per band, rounded to whole TIFF strips; converted bands are assumed to be
+    # at most 4 bytes per pixel
+    row_bytes = width * max(bytes_per_pixel(img.mode), 4)
+    rows_per_strip = max(1, min(TIFF_STRIP_BYTES // row_bytes, height))
+    band_rows = max(1, memory_budget // (row_bytes * BAND_COPIES))
+    band_rows = max(rows_per_strip, band_rows // rows_per_strip * rows_per_strip)
+
+    with open(input_path, "rb") as input_file, open(output_path, "wb") as output_file:
+        writer = None
+        for y0 in range(0, height, band_rows):
+            y1 = min(y0 + band_rows, height)
+            band = read_band(input_file, layout, img.mode, width, y0, y1)
+            if prepare_band is not None:
+                band = prepare_band(band)
+            if band.mode not in writer_class.MODES:
+                band = band.convert("RGBA" if "A" in band.getbands() else "RGB")
+            if writer is None:
+                writer = writer_class(
+                    output_file, width, height, band.mode, rows_per_strip, compress_level
+                )
+            writer.write(band)
+            band.close()
+            if on_band is not None:
+                on_band(y1 / height)
+        writer.close()
+
+
+def reduce_in_strips(
+    input_path, img, factor, memory_budget=DEFAULT_MEMORY_BUDGET, prepare_band=None, on_band=None
+):
+    # The image shrunk by a whole factor, read a band at a time. Bands are cut on
+    # multiples of the factor, so the result is exactly what reduce() gives on the
+    # whole image, without ever holding it.
+    layout = strip_layout(img)
+    width, height = img.size
+    row_bytes = width * max(bytes_per_pixel(img.mode), 4)
+    band_rows = max(1, memory_budget // (row_bytes * BAND_COPIES))
+    band_rows = max(factor, band_rows // factor * factor)
+
+    reduced = None
+    with open(input_path, "rb") as input_file:
+        for y0 in range(0, height, band_rows):
+            y1 = min(y0 + band_rows, height)
+            band = read_band(input_file, layout, img.mode, width, y0, y1)
+            if prepare_band is not None:
+                band = prepare_band(band)
+            if band.mode == "1":
+                band = band.convert("L")
+            elif band.mode not in REDUCE_MODES:
+                band = band.convert("RGBA" if band.has_transparency_data else "RGB")
+            # Averaged with premultiplied alpha, as Image.resize() does
+            mode = band.mode
+            if REDUCE_MODES[mode] != mode:
+                band = band.convert(REDUCE_MODES[mode])
+            small = band.reduce(factor)
+            band.close()
+            if reduced is None:
+                reduced = Image.new(small.mode, (-(-width // factor), -(-height // factor)))
+            reduced.paste(small, (0, y0 // factor))
+            if on_band is not None:
+                on_band(y1 / height)
+    return reduced if reduced.mode == mode else reduced.convert(mode)
@@ -14,16 +14,29 @@ import time
 import requests
 from packaging import version
 from datetime import datetime, timedelta
-from functools import partial
-import mimetypes
 
 # Add the parent directory to the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 try:
     from files_converter.converter import FileConverter
+    from files_converter.engine import (
+        ConversionEngine,
+        ConversionJob,
+        OutputClaims,
+        build_output_path,
+    )
+    from files_converter.cache import ConversionCache
+    from files_converter.metadata import MetadataCache, default_metadata_path
+    from files_converter.scheduler import COST_CLASSES
+    from files_converter import scanner
 except ImportError:
     from converter import FileConverter
+    from engine import ConversionEngine, ConversionJob, OutputClaims, build_output_path
+    from cache import ConversionCache
+    from metadata import MetadataCache, default_metadata_path
+    from scheduler import COST_CLASSES
+    import scanner
 
 
 class FileCard(Gtk.ListBoxRow):
@@ -34,6 +47,8 @@ class FileCard(Gtk.ListBoxRow):
         self.parent_window = parent_window
         self.current_format = self.converter.get_current_format(self.file_path)
         self.target_format = None
+        # Further formats to convert to, from the same read of the file
+        self.extra_targets = []
         self.build_ui()
 
     def build_ui(self):
@@ -81,11 +96,7 @@ class FileCard(Gtk.ListBoxRow):
         self.to_label.set_halign(Gtk.Align.END)
         right_box.pack_start(self.to_label, False, False, 0)
 
-        file_type = self.converter.get_file_type(self.file_path)
-        target_formats = self.converter.get_target_formats(file_type)
-
-        # Remove the current format from the target formats
-        target_formats = [fmt for fmt in target_formats if fmt != self.current_format]
+        target_formats = self.converter.get_conversion_targets(self.file_path)
 
         self.to_combo = Gtk.ComboBoxText()
         self.to_combo.set_entry_text_column(0)
@@ -99,6 +110,23 @@ class FileCard(Gtk.ListBoxRow):
         self.to_combo.connect("changed", self.on_format_changed)
         right_box.pack_start(self.to_combo, False, False, 0)
 
+        self.more_button = Gtk.MenuButton(label=_("Also convert to"))
+        more_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=3)
+        more_box.set_margin_top(6)
+        more_box.set_margin_bottom(6)
+        more_box.set_margin_start(6)
+        more_box.set_margin_end(6)
+        for format in target_formats:
+            check = Gtk.CheckButton(label=format)
+            check.connect("toggled", self.on_extra_target_toggled, format)
+            more_box.pack_start(check, False, False, 0)
+        more_box.show_all()
+        popover = Gtk.Popover()
+        popover.add(more_box)
+        self.more_button.set_popover(popover)
+        self.more_button.set_sensitive(len(target_formats) > 1)
+        right_box.pack_start(self.more_button, False, False, 0)
+
         # Action buttons
         action_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         card.pack_start(action_box, False, False, 0)
@@ -111,7 +139,10 @@ class FileCard(Gtk.ListBoxRow):
         self.add(card)
 
     def get_file_icon(self):
-        mime_type, _ = mimetypes.guess_type(self.file_path)
+        try:
+            mime_type = self.parent_window.metadata.info(self.file_path)["mime_type"]
+        except OSError:
+            mime_type = None
         if mime_type:
             if mime_type.startswith("image/"):
                 return "image-x-generic"
@@ -129,11 +160,11 @@ class FileCard(Gtk.ListBoxRow):
 
     def get_file_metadata(self):
         try:
-            stat = os.stat(self.file_path)
-            mime_type, a = mimetypes.guess_type(self.file_path)
+            info = self.parent_window.metadata.info(self.file_path)
+            mime_type = info["mime_type"]
 
-            size = self.format_size(stat.st_size)
-            created = datetime.fromtimestamp(stat.st_ctime).strftime("%Y-%m-%d %H:%M:%S")
+            size = self.format_size(info["size"])
+            created = datetime.fromtimestamp(info["ctime"]).strftime("%Y-%m-%d %H:%M:%S")
 
             metadata = _("Type: {mime_type}\n").format(mime_type=mime_type or "Unknown")
             metadata += _("Size: {size}\n").format(size=size)
@@ -162,10 +193,24 @@ class FileCard(Gtk.ListBoxRow):
     def get_target_format(self):
         return self.target_format
 
+    def on_extra_target_toggled(self, check, format):
+        if check.get_active():
+            self.extra_targets.append(format)
+        else:
+            self.extra_targets.remove(format)
+
+    def get_target_formats(self):
+        target_formats = [self.target_format] if self.target_format else []
+        for format in self.extra_targets:
+            if format not in target_formats:
+                target_formats.append(format)
+        return target_formats
+
     def update_text(self):
         self.file_name_label.set_text(os.path.basename(self.file_path))
         self.metadata_label.set_text(self.get_file_metadata())
         self.to_label.set_label(_("Convert to:"))
+        self.more_button.set_label(_("Also convert to"))
 
 
 class ConversionWindow(Gtk.Window):
@@ -176,26 +221,25 @@ class ConversionWindow(Gtk.Window):
         self.start_time = None
         self.current_progress = 0
         self.conversion_active = False
+        self.engine = None
         self.file_queue = multiprocessing.Queue()
         self.processing_complete = threading.Event()
         self.batch_size = 100
         self.scan_start_time = None
         self.clear_all_button = None
         self.added_files = set()
+        # The scheduler's cost classes also weigh each file's share of the progress bar
         self.conversion_weights = {
-            "photos": 1,
-            "videos": 5,
-            "vectors": 2,
-            "audio": 1.5,
-            "documents": 1,
-            "archives": 3,
-            "ebooks": 1.2,
+            family: cost_class.weight for family, cost_class in COST_CLASSES.items()
         }
         self.total_weighted_size = 0
         self.converted_weighted_size = 0
+        self.metadata = None
         self.settings = self.load_settings()
         self.build_ui()
         self.apply_settings()
+        # Closing the window mid-conversion must not leave tools running in the background
+        self.connect("destroy", self.on_destroy)
 
     def build_ui(self):
         main_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
@@ -393,9 +437,18 @@ class ConversionWindow(Gtk.Window):
         GLib.timeout_add(1000, self.update_progress_bar)
 
     def convert_files(self, files, output_dir):
-        self.total_weighted_size = self.calculate_total_weighted_size(files)
         self.converted_weighted_size = 0
         successfully_converted = []
+        jobs = []
+        job_cards = {}
+        job_progress = {}
+        progress_lock = threading.Lock()
+        # Outputs may not replace an input, each other or, unless allowed, existing files
+        claims = OutputClaims(
+            [row.get_file_path() for row in files if isinstance(row, FileCard)],
+            self.overwrite_outputs,
+        )
+        refused = []
 
         for list_box_row in files:
             file_card = list_box_row
@@ -411,71 +464,92 @@ class ConversionWindow(Gtk.Window):
                     )
                     continue
 
-                if output_dir is None:  # "Same as input"
-                    output_dir = os.path.dirname(input_path)
-
-                output_path = os.path.join(
-                    output_dir,
-                    f"{os.path.splitext(os.path.basename(input_path))[0]}.{target_format}",
+                outputs = []
+                for format in file_card.get_target_formats():
+                    output_path = build_output_path(input_path, output_dir, format)
+                    reason = claims.claim(output_path)
+                    if reason is None:
+                        outputs.append((format, output_path))
+                    else:
+                        refused.append(reason)
+                if not outputs:
+                    continue
+                (target_format, output_path), *extra_outputs = outputs
+                job = ConversionJob(
+                    input_path,
+                    output_path,
+                    target_format,
+                    options=self.job_options,
+                    extra_outputs=extra_outputs,
                 )
 
-                try:
-                    file_type = self.converter.get_file_type(input_path)
-                    file_size = os.path.getsize(input_path)
-                    file_weight = self.conversion_weights.get(file_type, 1)
-                    weighted_size = file_size * file_weight
-
-                    file_progress = 0  # Track progress for this specific file
-
-                    def progress_callback(progress):
-                        nonlocal file_progress
-                        new_file_progress = progress * weighted_size
-                        progress_diff = new_file_progress - file_progress
-                        file_progress = new_file_progress
-                        self.converted_weighted_size += progress_diff
-                        overall_progress = min(
-                            self.converted_weighted_size / self.total_weighted_size, 1.0
-                        )
-                        GLib.idle_add(self.set_progress, overall_progress)
-
-                    self.converter.convert_file(
-                        input_path, output_path, target_format, progress_callback
-                    )
-                    successfully_converted.append(file_card)
-
-                    # Ensure we've accounted for the full file size after conversion
-                    if file_progress < weighted_size:
-                        remaining_progress = weighted_size - file_progress
-                        self.converted_weighted_size += remaining_progress
-                        overall_progress = min(
-                            self.converted_weighted_size / self.total_weighted_size, 1.0
-                        )
-                        GLib.idle_add(self.set_progress, overall_progress)
-
-                except Exception as e:
-                    GLib.idle_add(
-                        self.show_error_dialog,
-                        _("Error converting {}: {}").format(os.path.basename(input_path), str(e)),
-                    )
+                file_type = self.converter.get_file_type(input_path)
+                file_size = self.metadata.size(input_path)
+                file_weight = self.conversion_weights.get(file_type, 1)
+                weighted_size = file_size * file_weight
+
+                jobs.append(job)
+                job_cards[job.job_id] = (file_card, weighted_size)
+                job_progress[job.job_id] = 0  # Track progress for this specific file
 
             else:
                 print(_("Unexpected item in file list: {}").format(type(file_card)))
 
+        if refused:
+            GLib.idle_add(
+                self.show_error_dialog,
+                _("Some files were not converted:") + "\n" + "\n".join(refused),
+            )
+        # Only what is actually converted counts towards the progress bar
+        self.total_weighted_size = sum(weighted_size for _card, weighted_size in job_cards.values())
+
+        def advance(job_id, new_file_progress):
+            with progress_lock:
+                # Progress comes from the queue listener, results from the engine, so an
+                # update may arrive after the result; a file's share never goes back
+                if new_file_progress <= job_progress[job_id]:
+                    return
+                progress_diff = new_file_progress - job_progress[job_id]
+                job_progress[job_id] = new_file_progress
+                self.converted_weighted_size += progress_diff
+                overall_progress = min(self.converted_weighted_size / self.total_weighted_size, 1.0)
+            GLib.idle_add(self.set_progress, overall_progress)
+
+        def on_progress(job_id, progress):
+            weighted_size = job_cards[job_id][1]
+            advance(job_id, progress * weighted_size)
+
+        def on_result(result):
+            file_card, weighted_size = job_cards[result.job.job_id]
+            if result.success:
+                successfully_converted.append(file_card)
+                # Ensure we've accounted for the full file size after conversion
+                advance(result.job.job_id, weighted_size)
+            elif result.status != "cancelled":
+                GLib.idle_add(
+                    self.show_error_dialog,
+                    _("Error converting {}: {}").format(
+                        os.path.basename(result.job.input_path), result.error
+                    ),
+                )
+
+        cache = None
+        if self.cache_enabled:
+            cache = ConversionCache(max_size=self.cache_max_size_mb * 1024 * 1024)
+        self.engine = ConversionEngine(
+            max_workers=self.max_workers,
+            cache=cache,
+            timeouts=self.job_timeouts,
+            metadata=self.metadata,
+        )
+        self.engine.run(jobs, on_result=on_result, on_progress=on_progress)
+        cancelled = self.engine.cancelled
+        self.engine = None
+
         if self.autoremove_converted:
             GLib.idle_add(self.remove_converted_files, successfully_converted)
 
-        GLib.idle_add(self.conversion_completed)
-
-    def calculate_total_weighted_size(self, files):
-        total = 0
-        for list_box_row in files:
-            if isinstance(list_box_row, FileCard):
-                file_path = list_box_row.get_file_path()
-                file_type = self.converter.get_file_type(file_path)
-                file_size = os.path.getsize(file_path)
-                weight = self.conversion_weights.get(file_type, 1)
-                total += file_size * weight
-        return total
+        GLib.idle_add(self.conversion_completed, cancelled)
 
     def set_progress(self, progress):
         self.current_progress = progress
@@ -501,12 +575,15 @@ class ConversionWindow(Gtk.Window):
 
         return True
 
-    def conversion_completed(self):
+    def conversion_completed(self, cancelled=False):
         self.conversion_active = False
         self.convert_button.set_sensitive(True)
-        self.progress_bar.set_fraction(1.0)
-        self.progress_bar.set_text(_("Conversion completed"))
-        self.show_info_dialog(_("Conversion completed successfully!"))
+        if cancelled:
+            self.progress_bar.set_text(_("Conversion cancelled"))
+        else:
+            self.progress_bar.set_fraction(1.0)
+            self.progress_bar.set_text(_("Conversion completed"))
+            self.show_info_dialog(_("Conversion completed successfully!"))
 
         # Schedule the progress bar reset after 5 seconds
         GLib.timeout_add_seconds(5, self.reset_progress_bar)
@@ -518,8 +595,17 @@ class ConversionWindow(Gtk.Window):
         return False
 
     def on_cancel_clicked(self, widget):
+        # While converting, Cancel stops the batch; otherwise it closes the window
+        if self.conversion_active and self.engine is not None:
+            self.engine.cancel()
+            self.progress_bar.set_text(_("Cancelling..."))
+            return
         self.destroy()
 
+    def on_destroy(self, widget):
+        if self.engine is not None:
+            self.engine.cancel()
+
     def remove_file(self, file_card):
         self.file_list.remove(file_card)
         self.added_files.remove(file_card.get_file_path())
@@ -675,6 +761,26 @@ class ConversionWindow(Gtk.Window):
             "custom_directory": "",
             "notifications_enabled": True,
             "autoremove_converted": False,
+            "max_workers": 0,
+            "cache_enabled": True,
+            "cache_max_size_mb": 1024,
+            # Per-family limits in seconds, e.g. {"videos": 3600}; missing means no limit
+            "job_timeouts": {},
+            # Photo encoder preset ("fast", "balanced" or "small"), and per-format save
+            # options on top of it, e.g. {"jpeg": {"quality": 90}}
+            "photo_preset": "balanced",
+            "photo_encoder_options": {},
+            # Audio encoder options per target, e.g. {"mp3": {"bitrate": "192k"}}
+            "audio_encoder_options": {},
+            # Video profile for re-encodes ("preview", "balanced", "archive", or one of
+            # video_profiles); empty for ffmpeg's defaults
+            "video_profile": "",
+            "video_profiles": {},
+            # Keep file sizes and video probes between runs, so unchanged files are
+            # not probed again
+            "metadata_cache_enabled": True,
+            # Replace output files that already exist; outputs never replace an input
+            "overwrite_outputs": False,
         }
 
         if settings_path.exists():
@@ -714,6 +820,35 @@ class ConversionWindow(Gtk.Window):
         # Apply autoremove setting
         self.autoremove_converted = self.settings["autoremove_converted"]
 
+        # Apply parallel conversions setting (0 means one worker per CPU core)
+        self.max_workers = self.settings["max_workers"] or None
+
+        # Apply conversion cache settings
+        self.cache_enabled = self.settings["cache_enabled"]
+        self.cache_max_size_mb = self.settings["cache_max_size_mb"]
+
+        # Apply file metadata cache setting
+        metadata_path = None
+        if self.settings["metadata_cache_enabled"]:
+            metadata_path = default_metadata_path()
+        if self.metadata is None or self.metadata.path != metadata_path:
+            self.metadata = MetadataCache(metadata_path)
+
+        self.overwrite_outputs = self.settings["overwrite_outputs"]
+
+        # Apply per-family conversion time limits
+        self.job_timeouts = self.settings["job_timeouts"]
+
+        # Apply photo and audio encoder and video profile settings
+        self.job_options = {
+            "preset": self.settings["photo_preset"],
+            "encoder_options": dict(
+                self.settings["photo_encoder_options"], **self.settings["audio_encoder_options"]
+            ),
+            "video_profile": self.settings["video_profile"],
+            "video_profiles": self.settings["video_profiles"],
+        }
+
     def load_translations(self, lang_code):
         try:
             lang = gettext.translation(
@@ -790,32 +925,18 @@ class ConversionWindow(Gtk.Window):
 
     def process_folder(self, folder_path):
         supported_extensions = self.get_supported_extensions()
-        with multiprocessing.Pool() as pool:
-            for root, dirs, files in os.walk(folder_path):
-                file_paths = [os.path.join(root, file) for file in files]
-                chunk_size = max(1, len(file_paths) // (multiprocessing.cpu_count() * 4))
-                for supported_file in pool.imap_unordered(
-                    partial(self.is_supported_file, supported_extensions=supported_extensions),
-                    file_paths,
-                    chunksize=chunk_size,
-                ):
-                    if supported_file and supported_file not in self.added_files:
-                        self.file_queue.put(supported_file)
+        for supported_file in scanner.scan_folder(folder_path, supported_extensions):
+            if supported_file not in self.added_files:
+                self.file_queue.put(supported_file)
 
         self.processing_complete.set()
 
     @staticmethod
     def is_supported_file(file_path, supported_extensions):
-        ext = "." + ".".join(os.path.basename(file_path).split(os.extsep)[1:])
-        if ext.lower() in supported_extensions:
-            return file_path
-        return None
+        return scanner.is_supported_file(file_path, supported_extensions)
 
     def get_supported_extensions(self):
-        supported_extensions = set()
-        for formats in self.converter.supported_formats.values():
-            supported_extensions.update(f".{fmt.lower()}" for fmt in formats)
-        return supported_extensions
+        return scanner.get_supported_extensions(self.converter.supported_formats)
 
     def update_ui_from_queue(self):
         files_processed = 0
@@ -1044,6 +1165,28 @@ class SettingsDialog(Gtk.Dialog):
         autoremove_box.pack_end(self.autoremove_switch, False, False, 0)
         box.pack_start(autoremove_box, False, False, 0)
 
+        # Add a spin button for the number of parallel conversions (0 = automatic)
+        workers_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=20)
+        self.workers_label = Gtk.Label(label=_("Parallel conversions (0 = auto):"))
+        self.workers_label.set_halign(Gtk.Align.START)
+        self.workers_spin = Gtk.SpinButton.new_with_range(0, multiprocessing.cpu_count() * 4, 1)
+        self.workers_spin.set_value(current_settings["max_workers"])
+        self.workers_spin.connect("value-changed", self.on_setting_changed)
+        workers_box.pack_start(self.workers_label, False, False, 0)
+        workers_box.pack_end(self.workers_spin, False, False, 0)
+        box.pack_start(workers_box, False, False, 0)
+
+        # Add a switch for reusing previously converted outputs
+        cache_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=20)
+        self.cache_label = Gtk.Label(label=_("Reuse previous conversions:"))
+        self.cache_label.set_halign(Gtk.Align.START)
+        self.cache_switch = Gtk.Switch()
+        self.cache_switch.set_active(current_settings["cache_enabled"])
+        self.cache_switch.connect("notify::active", self.on_setting_changed)
+        cache_box.pack_start(self.cache_label, False, False, 0)
+        cache_box.pack_end(self.cache_switch, False, False, 0)
+        box.pack_start(cache_box, False, False, 0)
+
         self.show_all()
         self.on_dir_combo_changed(self.dir_combo)
         self.update_theme_icon()
@@ -1091,6 +1234,8 @@ class SettingsDialog(Gtk.Dialog):
         self.current_settings["custom_directory"] = self.custom_dir
         self.current_settings["notifications_enabled"] = self.notifications_switch.get_active()
         self.current_settings["autoremove_converted"] = self.autoremove_switch.get_active()
+        self.current_settings["max_workers"] = self.workers_spin.get_value_as_int()
+        self.current_settings["cache_enabled"] = self.cache_switch.get_active()
 
         # Save and apply the new settings
         self.parent.save_settings()
@@ -1113,6 +1258,8 @@ class SettingsDialog(Gtk.Dialog):
         self.custom_dir_button.set_label(_("Choose custom directory"))
         self.notifications_label.set_text(_("Enable notifications:"))
         self.autoremove_label.set_text(_("Auto-remove converted files:"))
+        self.workers_label.set_text(_("Parallel conversions (0 = auto):"))
+        self.cache_label.set_text(_("Reuse previous conversions:"))
 
         # Update combo box items
         self.update_combobox_texts(
@@ -0,0 +1,408 @@
+import gettext
+import os
+
+_ = gettext.gettext
+
+# Codecs each container can hold, as ffprobe names them. Streams already in one of
+# them are copied into the new container instead of being re-encoded.
+CONTAINER_CODECS = {
+    "mp4": {
+        "video": {"h264", "hevc", "av1", "vp9", "mpeg4", "mpeg2video"},
+        "audio": {"aac", "mp3", "ac3", "eac3", "opus", "flac", "alac"},
+    },
+    "mov": {
+        "video": {"h264", "hevc", "mpeg4", "prores", "mjpeg", "av1"},
+        "audio": {"aac", "mp3", "alac", "ac3", "pcm_s16le", "pcm_s24le"},
+    },
+    "mkv": {
+        "video": {"h264", "hevc", "av1", "vp8", "vp9", "mpeg4", "mpeg2video", "theora", "prores"},
+        "audio": {"aac", "mp3", "opus", "vorbis", "flac", "ac3", "eac3", "dts", "alac"},
+    },
+    "webm": {
+        "video": {"vp8", "vp9", "av1"},
+        "audio": {"vorbis", "opus"},
+    },
+    "avi": {
+        "video": {"mpeg4", "h264", "mjpeg", "msmpeg4v3"},
+        "audio": {"mp3", "ac3", "pcm_s16le"},
+    },
+}
+# Encoders for streams that do need re-encoding; ffmpeg picks its default for the
+# container otherwise
+TRANSCODE_CODECS = {"mkv": {"video": "libx264", "audio": "libvorbis"}}
+# Subtitle codecs each container can hold, copied as they are, and the encoder that
+# text subtitles in another codec are converted with. Bitmap subtitles only go where
+# they can be copied.
+SUBTITLE_CODECS = {
+    "mp4": {"mov_text"},
+    "mov": {"mov_text"},
+    "mkv": {"subrip", "ass", "ssa", "webvtt", "dvd_subtitle", "hdmv_pgs_subtitle", "dvb_subtitle"},
+    "webm": {"webvtt"},
+}
+SUBTITLE_ENCODERS = {"mp4": "mov_text", "mov": "mov_text", "mkv": "srt", "webm": "webvtt"}
+TEXT_SUBTITLES = {"subrip", "ass", "ssa", "webvtt", "mov_text", "text"}
+# ffmpeg muxer names, where they differ from the extension
+MUXERS = {"mkv": "matroska"}
+
+
+def _profile(x264, aac, vp9, opus, mpeg4, mp3, **settings):
+    # The same encoder settings for every container that can hold the codec
+    containers = {
+        "mp4": {"video": dict(x264, c="libx264"), "audio": dict(aac, c="aac")},
+        "mov": {"video": dict(x264, c="libx264"), "audio": dict(aac, c="aac")},
+        "mkv": {"video": dict(x264, c="libx264"), "audio": dict(aac, c="aac")},
+        "webm": {"video": dict(vp9, c="libvpx-vp9"), "audio": dict(opus, c="libopus")},
+        "avi": {"video": dict(mpeg4, c="mpeg4"), "audio": dict(mp3, c="libmp3lame")},
+    }
+    for container in containers.values():
+        container.update(settings)
+    return containers
+
+
+# Output settings per target container. "video" and "audio" hold ffmpeg options for
+# the streams that are encoded ("c" is the encoder), "max_height" scales taller videos
+# down and "threads" caps the encoder threads. The profiles trade encoding time
+# against size and quality; without one ffmpeg's defaults are used.
+VIDEO_PROFILES = {
+    "preview": _profile(
+        x264={"preset": "ultrafast", "crf": 28},
+        aac={"b": "96k"},
+        vp9={"deadline": "realtime", "cpu-used": 8, "crf": 40, "b": 0, "row-mt": 1},
+        opus={"b": "64k"},
+        mpeg4={"q": 8},
+        mp3={"b": "96k"},
+        max_height=720,
+        threads=2,
+    ),
+    "balanced": _profile(
+        x264={"preset": "medium", "crf": 23},
+        aac={"b": "128k"},
+        vp9={"deadline": "good", "cpu-used": 4, "crf": 32, "b": 0, "row-mt": 1},
+        opus={"b": "96k"},
+        mpeg4={"q": 5},
+        mp3={"b": "192k"},
+    ),
+    "archive": _profile(
+        x264={"preset": "slow", "crf": 18},
+        aac={"b": "192k"},
+        vp9={"deadline": "good", "cpu-used": 1, "crf": 24, "b": 0, "row-mt": 1},
+        opus={"b": "160k"},
+        mpeg4={"q": 2},
+        mp3={"b": "320k"},
+    ),
+}
+
+
+def muxer(target_format):
+    return MUXERS.get(target_format, target_format)
+
+
+def streams_of(probe, codec_type):
+    # Cover art shows up as a video stream and is skipped
+    return [
+        stream
+        for stream in probe.get("streams", [])
+        if stream.get("codec_type") == codec_type
+        and not stream.get("disposition", {}).get("attached_pic")
+    ]
+
+
+def pick_stream(probe, codec_type):
+    # The stream ffmpeg would convert: the default one of its type, else the first
+    streams = streams_of(probe, codec_type)
+    for stream in streams:
+        if stream.get("disposition", {}).get("default"):
+            return stream
+    return streams[0] if streams else None
+
+
+def profile_settings(target_format, options):
+    # The settings of options["video_profile"] for the target container, {} without
+    # one. options["video_profiles"] may add profiles or replace the built-in ones.
+    name = options.get("video_profile")
+    if not name:
+        return {}
+    profiles = dict(VIDEO_PROFILES)
+    profiles.update(options.get("video_profiles", {}))
+    if name not in profiles:
+        raise ValueError(_("Unknown video profile: {}").format(name))
+    return profiles[name].get(target_format, {})
+
+
+def find_stream(probe, index):
+    for stream in probe.get("streams", []):
+        if stream.get("index") == index:
+            return stream
+    return None
+
+
+def scaled_height(stream, settings):
+    # The height to scale the stream down to, None when it fits the profile
+    max_height = settings.get("max_height")
+    if stream is not None and max_height and stream.get("height", 0) > max_height:
+        return max_height
+    return None
+
+
+def encoder_options(codec_type, settings, specifier):
+    # The profile's ffmpeg options for one output stream, besides its encoder
+    return {
+        f"{name}:{specifier}": value
+        for name, value in settings.get(codec_type, {}).items()
+        if name != "c" and value is not None
+    }
+
+
+def thread_count(threads, settings):
+    # A profile may cap the threads the scheduler gave the job
+    cap = settings.get("threads")
+    if cap and threads:
+        return min(cap, threads)
+    return cap or threads
+
+
+def subtitle_codec(stream, target_format):
+    # "copy", the encoder to convert the subtitles with, or None when the target
+    # cannot hold them
+    if stream.get("codec_name") in SUBTITLE_CODECS.get(target_format, ()):
+        return "copy"
+    if stream.get("codec_name") in TEXT_SUBTITLES:
+        return SUBTITLE_ENCODERS.get(target_format)
+    return None
+
+
+def stream_plan(probe, target_format, reencode=False, settings=None):
+    # (input stream index, codec type, output codec) for the main video stream, then
+    # the main audio stream, the other audio streams and the subtitles the target can
+    # hold. The codec is "copy" when the stream can go into the target as it is, and
+    # None to let ffmpeg choose.
+    settings = settings or {}
+    plan = []
+    codecs = CONTAINER_CODECS.get(target_format, {})
+    streams = [pick_stream(probe, "video")]
+    main_audio = pick_stream(probe, "audio")
+    if main_audio is not None:
+        streams.append(main_audio)
+        streams += [stream for stream in streams_of(probe, "audio") if stream is not main_audio]
+    for stream in streams:
+        if stream is None:
+            continue
+        codec_type = stream["codec_type"]
+        if (
+            not reencode
+            and stream.get("codec_name") in codecs.get(codec_type, ())
+            and scaled_height(stream, settings) is None
+        ):
+            codec = "copy"
+        else:
+            codec = settings.get(codec_type, {}).get("c") or TRANSCODE_CODECS.get(
+                target_format, {}
+            ).get(codec_type)
+        plan.append((stream["index"], codec_type, codec))
+    for stream in streams_of(probe, "subtitle"):
+        codec = subtitle_codec(stream, target_format)
+        if codec is not None:
+            plan.append((stream["index"], "subtitle", codec))
+    return plan
+
+
+def dropped_streams(probe, plan):
+    # The input's streams that the plan leaves out
+    planned = {index for index, _codec_type, _codec in plan}
+    return [stream for stream in probe.get("streams", []) if stream.get("index") not in planned]
+
+
+def is_remux(plan):
+    return bool(plan) and all(codec == "copy" for _index, _codec_type, codec in plan)
+
+
+# Segments shorter than this aren't worth an encoder process of their own
+MIN_SEGMENT_SECONDS = 30
+
+
+def segment_count(duration, segments):
+    # How many pieces to encode side by side; below 2 the video is encoded whole
+    if not segments or segments < 2:
+        return 1
+    return max(min(segments, int(duration // MIN_SEGMENT_SECONDS)), 1)
+
+
+def video_entry(plan):
+    for entry in plan:
+        if entry[1] == "video":
+            return entry
+    return None
+
+
+def can_segment(plan):
+    # Only a re-encode gains from it; copied streams are split for nothing
+    entry = video_entry(plan)
+    return entry is not None and entry[2] != "copy"
+
+
+def split_command(input_path, stream_index, segment_seconds, directory):
+    # Cuts the video stream, copied as it is, into Matroska pieces at the first
+    # keyframe after every `segment_seconds`
+    import ffmpeg
+
+    source = ffmpeg.input(input_path)
+    stream = ffmpeg.output(
+        source[str(stream_index)],
+        os.path.join(directory, "split%04d.mkv"),
+        c="copy",
+        format="segment",
+        segment_time=segment_seconds,
+        reset_timestamps=1,
+    )
+    return ffmpeg.compile(stream.overwrite_output())
+
+
+def segment_command(
+    input_path, output_path, target_format, codec, threads=None, settings=None, height=None
+):
+    # Encodes one piece into the target's own container, so that ffmpeg picks the
+    # same default encoder for every piece as it would for the whole video
+    import ffmpeg
+
+    output_kwargs = {"format": muxer(target_format)}
+    if codec is not None:
+        output_kwargs["c:v"] = codec
+    output_kwargs.update(encoder_options("video", settings or {}, "v"))
+    if threads:
+        output_kwargs["threads"] = threads
+    stream = ffmpeg.input(input_path)["v"]
+    if height:
+        stream = stream.filter("scale", -2, height)
+    stream = ffmpeg.output(stream, output_path, **output_kwargs)
+    return ffmpeg.compile(stream.overwrite_output())
+
+
+def concat_list(paths):
+    # Input for the concat demuxer, quoted as it expects
+    return "".join("file '{}'\n".format(path.replace("'", "'\\''")) for path in paths)
+
+
+def concat_command(list_path, input_path, output_path, target_format, plan, settings=None):
+    # Joins the encoded pieces without touching them, and takes the other streams from
+    # the original input as the plan says
+    import ffmpeg
+
+    streams = [ffmpeg.input(list_path, format="concat", safe=0)["v"]]
+    output_kwargs = {"format": muxer(target_format), "c:v": "copy"}
+    source = ffmpeg.input(input_path)
+    for index, codec_type, codec in plan:
+        if codec_type == "video":
+            continue
+        position = len(streams)
+        streams.append(source[str(index)])
+        if codec is not None:
+            output_kwargs[f"c:{position}"] = codec
+        if codec != "copy":
+            output_kwargs.update(encoder_options(codec_type, settings or {}, position))
+    stream = ffmpeg.output(*streams, output_path, **output_kwargs)
+    return ffmpeg.compile(stream.overwrite_output())
+
+
+# Keys of ffmpeg's -progress output; a block of them is written every stats period and
+# ends with "progress", which is "end" after the last one
+PROGRESS_KEYS = {
+    "frame",
+    "fps",
+    "bitrate",
+    "total_size",
+    "out_time_us",
+    "out_time_ms",
+    "out_time",
+    "dup_frames",
+    "drop_frames",
+    "speed",
+    "progress",
+}
+
+
+def progress_args(interval=None):
+    # Global options asking for key=value progress on stdout instead of the stats line
+    args = ["-nostats", "-progress", "pipe:1"]
+    if interval:
+        args += ["-stats_period", str(interval)]
+    return args
+
+
+class ProgressReader:
+    def __init__(self):
+        self.values = {}
+
+    def feed(self, line):
+        # The values of a block once its last line is read, {} for the lines before,
+        # None for a line that is no progress at all
+        key, separator, value = line.strip().partition("=")
+        if not separator or not (key in PROGRESS_KEYS or key.startswith("stream_")):
+            return None
+        self.values[key] = value.strip()
+        if key != "progress":
+            return {}
+        values, self.values = self.values, {}
+        return values
+
+
+def _number(value, suffix=""):
+    # ffmpeg writes N/A until it knows a value
+    if value is None:
+        return None
+    try:
+        return float(value[: -len(suffix)] if suffix and value.endswith(suffix) else value)
+    except ValueError:
+        return None
+
+
+def progress_stats(values):
+    out_time_us = _number(values.get("out_time_us"))
+    bitrate = _number(values.get("bitrate"), "kbits/s")
+    total_size = _number(values.get("total_size"))
+    return {
+        "out_time_us": max(int(out_time_us), 0) if out_time_us is not None else 0,
+        "fps": _number(values.get("fps")),
+        "speed": _number(values.get("speed"), "x"),
+        "bitrate": bitrate * 1000 if bitrate is not None else None,
+        "total_size": int(total_size) if total_size is not None else None,
+    }
+
+
+def combine_stats(stats):
+    # Totals over encoders running side by side, each on its own part of the video
+    out_time_us = sum(item["out_time_us"] for item in stats)
+    combined = {"out_time_us": out_time_us}
+    for key in ("fps", "speed", "total_size"):
+        values = [item[key] for item in stats if item[key] is not None]
+        combined[key] = sum(values) if values else None
+    combined["bitrate"] = None
+    if combined["total_size"] is not None and out_time_us:
+        combined["bitrate"] = combined["total_size"] * 8 / (out_time_us / 1e6)
+    return combined
+
+
+class EncodeProgress(float):
+    # The fraction done, so callbacks that want only that can take it as a number,
+    # with what ffmpeg reported about the encode: the position reached in the
+    # output, frames and seconds of video encoded per second of wall time, the
+    # bitrate in bits per second and the bytes written so far
+    def __new__(
+        cls, fraction, out_time_us=0, fps=None, speed=None, bitrate=None, total_size=None, eta=None
+    ):
+        progress = super().__new__(cls, fraction)
+        progress.out_time_us = out_time_us
+        progress.fps = fps
+        progress.speed = speed
+        progress.bitrate = bitrate
+        progress.total_size = total_size
+        # Seconds left at the current speed
+        progress.eta = eta
+        return progress
+
+
+def encode_progress(stats, duration):
+    fraction = min(stats["out_time_us"] / 1e6 / duration, 1.0)
+    eta = None
+    if stats["speed"]:
+        eta = duration * (1.0 - fraction) / stats["speed"]
+    return EncodeProgress(fraction, eta=eta, **stats)
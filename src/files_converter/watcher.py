@@ -0,0 +1,353 @@
+import ctypes
+import ctypes.util
+import fnmatch
+import gettext
+import heapq
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+import time
+
+from .converter import FileConverter
+from .engine import ConversionEngine, ConversionJob, OutputClaims, build_output_path
+from .scanner import get_supported_extensions, is_supported_file
+
+_ = gettext.gettext
+
+# inotify(7) event bits
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+)
+FILE_CHANGED = IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO
+FILE_GONE = IN_DELETE | IN_MOVED_FROM
+
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+PRODUCED_PURGE_THRESHOLD = 10000
+# Longest the main loop waits, for events or for room in the job queue, before it looks
+# at its deadlines and the stop flag again
+POLL_INTERVAL = 1.0
+# The engine's run lasts as long as the daemon, so its cache is pruned and the file
+# metadata saved after this many finished jobs or seconds, and when the daemon stops
+FLUSH_EVERY_JOBS = 100
+FLUSH_INTERVAL = 300.0
+
+
+class Inotify:
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = {}
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.watches[wd] = path
+        return wd
+
+    def read_events(self, timeout):
+        ready, _w, _x = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+
+            directory = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            if directory is None and not mask & IN_Q_OVERFLOW:
+                continue
+            events.append((mask, os.path.join(directory, name) if name else directory))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConversionRule:
+    SEPARATORS = ("->", "→", "=")
+
+    def __init__(self, pattern, target_format):
+        self.pattern = pattern.lower()
+        self.target_format = target_format.lower().lstrip(".")
+
+    @classmethod
+    def parse(cls, spec):
+        for separator in cls.SEPARATORS:
+            if separator in spec:
+                pattern, target_format = spec.split(separator, 1)
+                if pattern.strip() and target_format.strip():
+                    return cls(pattern.strip(), target_format.strip())
+        raise ValueError(_("Invalid rule {!r}, expected e.g. '*.mov=mp4'").format(spec))
+
+    def matches(self, file_path):
+        return fnmatch.fnmatchcase(os.path.basename(file_path).lower(), self.pattern)
+
+    def __repr__(self):
+        return f"ConversionRule({self.pattern!r} -> {self.target_format!r})"
+
+
+class WatchDaemon:
+    def __init__(
+        self,
+        paths,
+        rules,
+        output_dir=None,
+        engine=None,
+        debounce=2.0,
+        queue_size=1000,
+        on_result=None,
+        on_event=None,
+        options=None,
+        overwrite=False,
+        on_skip=None,
+    ):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.rules = rules
+        self.output_dir = output_dir
+        self.engine = engine or ConversionEngine()
+        self.debounce = debounce
+        self.on_result = on_result
+        self.on_event = on_event
+        # Called with (input_path, target_format, output_path, reason) for a file whose
+        # output may not be written
+        self.on_skip = on_skip
+        # Conversion options given to every job
+        self.options = dict(options or {})
+        self.converter = FileConverter()
+        self.supported_extensions = get_supported_extensions(self.converter.supported_formats)
+
+        # Files wait here until they have been quiet for `debounce` seconds
+        self._pending = {}
+        self._deadlines = []
+        # Ready jobs; bounded so a burst of events cannot outrun the workers unboundedly
+        self._jobs = queue.Queue(maxsize=queue_size)
+        # Outputs we are writing or have just written, so they are not picked up again
+        self._produced = {}
+        self._produced_lock = threading.Lock()
+        # Outputs being written, checked like a batch's; guarded by _produced_lock
+        self._claims = OutputClaims((), overwrite, is_input=self._is_input)
+        self._stop = threading.Event()
+        self._inotify = None
+        self._unflushed = 0
+        self._next_flush = time.monotonic() + FLUSH_INTERVAL
+        self._flush_lock = threading.Lock()
+
+    def match(self, file_path):
+        if not is_supported_file(file_path, self.supported_extensions):
+            return None
+        for rule in self.rules:
+            if rule.matches(file_path) and self.converter.can_convert(
+                file_path, rule.target_format
+            ):
+                return rule
+        return None
+
+    def _is_input(self, path):
+        # A file the daemon would convert itself, were it to change
+        path = os.path.abspath(path)
+        return (
+            os.path.lexists(path)
+            and any(os.path.commonpath([root, path]) == root for root in self.paths)
+            and self.match(path) is not None
+        )
+
+    def run(self):
+        self._inotify = Inotify()
+        try:
+            for path in self.paths:
+                self._watch_tree(path, schedule_existing=False)
+
+            dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+            dispatcher.start()
+            try:
+                while not self._stop.is_set():
+                    for mask, path in self._inotify.read_events(self._next_timeout()):
+                        self._handle_event(mask, path)
+                    self._flush_ready()
+                    if time.monotonic() >= self._next_flush:
+                        self._flush_engine()
+            finally:
+                self._jobs.put(None)
+                dispatcher.join()
+                self._flush_engine()
+        finally:
+            self._inotify.close()
+            self._inotify = None
+
+    def stop(self):
+        self._stop.set()
+
+    def _watch_tree(self, root, schedule_existing):
+        # Directories are walked once when they appear; after that only events count
+        for dirpath, dirs, files in os.walk(root):
+            try:
+                self._inotify.add_watch(dirpath)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                print(_("Cannot watch {}: {}").format(dirpath, e), file=sys.stderr)
+                continue
+            if schedule_existing:
+                for file in files:
+                    self._schedule(os.path.join(dirpath, file))
+
+    def _handle_event(self, mask, path):
+        if mask & IN_Q_OVERFLOW:
+            print(
+                _("Warning: inotify event queue overflowed, some changes were missed."),
+                file=sys.stderr,
+            )
+        elif mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(path, schedule_existing=True)
+        elif mask & FILE_GONE:
+            self._pending.pop(path, None)
+        elif mask & FILE_CHANGED:
+            self._schedule(path)
+
+    def _schedule(self, path):
+        deadline = time.monotonic() + self.debounce
+        if path in self._pending:
+            # A file still being written: just push its deadline back
+            self._pending[path] = deadline
+            return
+        if self._is_produced(path) or self.match(path) is None:
+            return
+        self._pending[path] = deadline
+        heapq.heappush(self._deadlines, (deadline, path))
+
+    def _is_produced(self, path):
+        with self._produced_lock:
+            if path not in self._produced:
+                return False
+            expiry = self._produced[path]
+            if expiry is not None and expiry < time.monotonic():
+                del self._produced[path]
+                return False
+            return True
+
+    def _purge_produced(self):
+        now = time.monotonic()
+        with self._produced_lock:
+            for path, expiry in list(self._produced.items()):
+                if expiry is not None and expiry < now:
+                    del self._produced[path]
+
+    def _next_timeout(self):
+        if not self._deadlines:
+            return POLL_INTERVAL
+        return min(max(self._deadlines[0][0] - time.monotonic(), 0.0), POLL_INTERVAL)
+
+    def _flush_ready(self):
+        now = time.monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, path = self._deadlines[0]
+            pending_deadline = self._pending.get(path)
+            if pending_deadline != deadline:
+                # The file was removed, or changed again since it was scheduled
+                heapq.heappop(self._deadlines)
+                if pending_deadline is not None:
+                    heapq.heappush(self._deadlines, (pending_deadline, path))
+                continue
+
+            rule = self.match(path)
+            if rule is None or not os.path.isfile(path):
+                heapq.heappop(self._deadlines)
+                del self._pending[path]
+                continue
+
+            output_path = build_output_path(path, self.output_dir, rule.target_format)
+            with self._produced_lock:
+                reason = self._claims.claim(output_path, path)
+            if reason is not None:
+                heapq.heappop(self._deadlines)
+                del self._pending[path]
+                self._skip(path, rule.target_format, output_path, reason)
+                continue
+            try:
+                # Waits for the workers rather than coming straight back to a deadline
+                # that has already passed
+                self._jobs.put(
+                    ConversionJob(path, output_path, rule.target_format, options=self.options),
+                    timeout=POLL_INTERVAL,
+                )
+            except queue.Full:
+                # Leave it pending; it is retried once the workers free up space
+                with self._produced_lock:
+                    self._claims.release(output_path)
+                break
+            heapq.heappop(self._deadlines)
+            del self._pending[path]
+            with self._produced_lock:
+                self._produced[output_path] = None
+
+        if len(self._produced) > PRODUCED_PURGE_THRESHOLD:
+            self._purge_produced()
+
+    def _skip(self, path, target_format, output_path, reason):
+        if self.on_skip:
+            self.on_skip(path, target_format, output_path, reason)
+        else:
+            print(_("Skipping {}: {}").format(path, reason), file=sys.stderr)
+
+    def _iter_jobs(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            yield job
+
+    def _dispatch(self):
+        self.engine.run(self._iter_jobs(), on_result=self._job_finished, on_event=self.on_event)
+
+    def _job_finished(self, result):
+        # Keep ignoring the events caused by writing the output for a little longer
+        with self._produced_lock:
+            self._produced[result.job.output_path] = time.monotonic() + self.debounce * 2 + 1
+            self._claims.release(
+                result.job.output_path, result.job.input_path if result.success else None
+            )
+        with self._flush_lock:
+            self._unflushed += 1
+        if self._unflushed >= FLUSH_EVERY_JOBS:
+            self._flush_engine()
+        if self.on_result:
+            self.on_result(result)
+
+    def _flush_engine(self):
+        with self._flush_lock:
+            self._next_flush = time.monotonic() + FLUSH_INTERVAL
+            if not self._unflushed:
+                return
+            self._unflushed = 0
+            self.engine.flush()
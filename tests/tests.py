@@ -1,11 +1,50 @@
 import unittest
+import unittest.mock
+import importlib.util
+import io
+import json
 import os
+import pickle
+import queue
+import shutil
+import subprocess
+import sys
 import tempfile
+import threading
+import time
+
+from PIL import Image, ImageChops, ImageSequence
 
 try:
-    from files_converter.converter import FileConverter
+    from files_converter.converter import FileConverter, register_builtin_converters
+    from files_converter.registry import FormatRegistry, register_converter
+    from files_converter.engine import ConversionEngine, ConversionJob
+    from files_converter.cache import ConversionCache
+    from files_converter.scheduler import CostClass, ResourceScheduler
+    from files_converter.events import ConversionEvent, JsonLinesSink, PrometheusSink
+    from files_converter.cancellation import (
+        CancellationToken,
+        ConversionCancelled,
+        ConversionTimeout,
+    )
+    from files_converter.watcher import ConversionRule, WatchDaemon
+    from files_converter.metadata import MetadataCache
+    from files_converter import audio, cli, inkscape, photos, video
 except ImportError:
-    from src.files_converter.converter import FileConverter
+    from src.files_converter.converter import FileConverter, register_builtin_converters
+    from src.files_converter.registry import FormatRegistry, register_converter
+    from src.files_converter.engine import ConversionEngine, ConversionJob
+    from src.files_converter.cache import ConversionCache
+    from src.files_converter.scheduler import CostClass, ResourceScheduler
+    from src.files_converter.events import ConversionEvent, JsonLinesSink, PrometheusSink
+    from src.files_converter.cancellation import (
+        CancellationToken,
+        ConversionCancelled,
+        ConversionTimeout,
+    )
+    from src.files_converter.watcher import ConversionRule, WatchDaemon
+    from src.files_converter.metadata import MetadataCache
+    from src.files_converter import audio, cli, inkscape, photos, video
 
 
 class TestFileConverter(unittest.TestCase):
@@ -27,6 +66,16 @@ class TestFileConverter(unittest.TestCase):
         self.assertEqual(self.converter.get_file_type("example.epub"), "ebooks")
         self.assertIsNone(self.converter.get_file_type("example.unknown"))
 
+    def test_backends_are_imported_lazily(self):
+        src_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+        code = (
+            "import sys, files_converter.converter; "
+            "backends = ['PIL', 'ffmpeg', 'docx', 'PyPDF2', 'pdf2docx', 'striprtf', 'odf']; "
+            "sys.exit(any(name in sys.modules for name in backends))"
+        )
+        env = dict(os.environ, PYTHONPATH=src_dir)
+        self.assertEqual(subprocess.run([sys.executable, "-c", code], env=env).returncode, 0)
+
     def test_get_target_formats(self):
         self.assertIn("jpg", self.converter.get_target_formats("photos"))
         self.assertIn("png", self.converter.get_target_formats("photos"))
@@ -180,5 +229,1446 @@ class TestFileConverter(unittest.TestCase):
         self.assertTrue(os.path.exists(output_path))
 
 
+class TestFormatRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = FormatRegistry()
+        register_builtin_converters(self.registry)
+        self.converter = FileConverter(registry=self.registry)
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_detect_format(self):
+        self.assertEqual(self.registry.detect_format("backup.tar.gz"), "tar.gz")
+        self.assertEqual(self.registry.detect_format("/tmp/my.photo.JPG"), "jpg")
+        self.assertEqual(self.registry.detect_format("report.final.pdf"), "pdf")
+        self.assertIsNone(self.registry.detect_format("archive.gz"))
+        self.assertIsNone(self.registry.detect_format("README"))
+        self.assertEqual(self.converter.get_file_type("my.photo.jpg"), "photos")
+        self.assertEqual(self.converter.get_current_format("backup.tar.gz"), "tar.gz")
+        self.assertEqual(self.registry.strip_format("/tmp/backup.tar.gz"), "/tmp/backup")
+
+    def test_conversion_matrix(self):
+        matrix = self.converter.get_conversion_matrix()
+        self.assertIn("webp", matrix["png"])
+        self.assertNotIn("png", matrix["png"])
+        self.assertIn("zip", matrix["tar.gz"])
+        # txt is both a document and an ebook format
+        self.assertIn("docx", matrix["txt"])
+        self.assertIn("epub", matrix["txt"])
+        self.assertNotIn("mp3", matrix["png"])
+
+    def test_register_third_party_converter(self):
+        def convert_foo(converter, input_path, output_path, target_format):
+            with open(output_path, "w") as f:
+                f.write(target_format)
+
+        self.registry.register("foo", "bar", convert_foo, family="foobar")
+        input_path = os.path.join(self.temp_dir.name, "input.foo")
+        output_path = os.path.join(self.temp_dir.name, "output.bar")
+        open(input_path, "w").close()
+
+        self.assertEqual(self.converter.get_file_type(input_path), "foobar")
+        self.assertTrue(self.converter.can_convert(input_path, "bar"))
+        self.converter.convert_file(input_path, output_path, "bar")
+        with open(output_path) as f:
+            self.assertEqual(f.read(), "bar")
+
+    def test_unregistered_pair_raises(self):
+        with self.assertRaises(ValueError):
+            self.converter.convert_file("input.png", "output.mp3", "mp3")
+
+
+def convert_by_crashing(converter, input_path, output_path, target_format):
+    os._exit(1)
+
+
+class TestConversionEngine(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), "test_files")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def make_job(self, input_name, target_format):
+        input_path = os.path.join(self.test_files_dir, input_name)
+        base_name = os.path.splitext(input_name)[0]
+        output_path = os.path.join(
+            self.temp_dir.name, f"{base_name}-{target_format}.{target_format}"
+        )
+        return ConversionJob(input_path, output_path, target_format)
+
+    def test_parallel_batch(self):
+        jobs = [self.make_job(f"input.{fmt}", "png") for fmt in ["jpg", "bmp", "gif", "webp"]]
+        streamed = []
+        results = ConversionEngine(max_workers=2).run(jobs, on_result=streamed.append)
+        self.assertEqual(len(results), len(jobs))
+        self.assertEqual(len(streamed), len(jobs))
+        for result in results:
+            self.assertTrue(result.success, result.error)
+            self.assertTrue(os.path.exists(result.job.output_path))
+
+    def test_errors_are_isolated_per_job(self):
+        good_job = self.make_job("input.jpg", "png")
+        bad_job = self.make_job("non-existent.jpg", "png")
+        results = ConversionEngine(max_workers=2).run([bad_job, good_job])
+        by_id = {result.job.job_id: result for result in results}
+        self.assertFalse(by_id[bad_job.job_id].success)
+        self.assertTrue(by_id[bad_job.job_id].error)
+        self.assertTrue(by_id[good_job.job_id].success)
+
+    def test_worker_that_dies_only_fails_its_own_job(self):
+        register_converter("crash", "png", convert_by_crashing, family="crashes")
+        crash_input = os.path.join(self.temp_dir.name, "input.crash")
+        open(crash_input, "w").close()
+        crash_job = ConversionJob(crash_input, os.path.join(self.temp_dir.name, "crash.png"), "png")
+        jobs = [self.make_job("input.jpg", "png")]
+        jobs += [crash_job]
+        jobs += [self.make_job(f"input.{fmt}", "png") for fmt in ["bmp", "gif", "webp", "tiff"]]
+        results = ConversionEngine(max_workers=2).run(jobs)
+        self.assertEqual(
+            sorted(result.job.job_id for result in results), sorted(job.job_id for job in jobs)
+        )
+        for result in results:
+            if result.job is crash_job:
+                self.assertEqual(result.status, "failed")
+                self.assertIn("Worker process failed", result.error)
+            else:
+                self.assertTrue(result.success, result.error)
+
+    def test_few_jobs_still_get_their_threads(self):
+        # Three jobs on eight cores: each gets the four threads of its class
+        jobs = [self.make_job(f"input.{fmt}", "png") for fmt in ["jpg", "bmp", "gif"]]
+        engine = ConversionEngine(max_workers=8, cost_classes={"photos": CostClass(1, threads=4)})
+        results = engine.run(jobs)
+        self.assertTrue(all(result.success for result in results))
+        self.assertEqual([job.threads for job in jobs], [4, 4, 4])
+
+    def test_single_worker_runs_inline(self):
+        jobs = [self.make_job("input.png", "jpg"), self.make_job("input.tiff", "webp")]
+        results = ConversionEngine(max_workers=1).run(jobs)
+        self.assertTrue(all(result.success for result in results))
+
+
+class TestResourceScheduler(unittest.TestCase):
+    def start_all(self, scheduler, pending):
+        started = []
+        while True:
+            index = scheduler.pick(pending)
+            if index is None:
+                return started
+            family, job = pending.pop(index)
+            scheduler.acquire(family)
+            started.append(job)
+
+    def test_video_encodes_share_the_cores(self):
+        scheduler = ResourceScheduler(32)
+        pending = [("videos", f"video-{i}") for i in range(32)]
+        started = self.start_all(scheduler, pending)
+        self.assertEqual(len(started), 32 // scheduler.threads_for("videos"))
+        self.assertLessEqual(scheduler.threads_for("videos") * len(started), 32)
+
+    def test_mixed_batch_fills_remaining_cores(self):
+        scheduler = ResourceScheduler(10)
+        pending = [("videos", "video-1"), ("videos", "video-2"), ("videos", "video-3")]
+        pending += [("photos", f"photo-{i}") for i in range(10)]
+        started = self.start_all(scheduler, pending)
+        self.assertEqual(started, ["video-1", "video-2", "photo-0", "photo-1"])
+        self.assertEqual(scheduler.free_cpus, 0)
+
+    def test_segmented_video_claims_a_core_set_per_segment(self):
+        scheduler = ResourceScheduler(64)
+        job = ConversionJob("in.mp4", "out.mkv", "mkv", options={"segments": 8})
+        self.assertEqual(scheduler.acquire("videos", job), 32)
+        self.assertEqual(scheduler.free_cpus, 32)
+        scheduler.release("videos", job)
+        self.assertEqual(scheduler.free_cpus, 64)
+        job.options["segments"] = 32
+        self.assertEqual(scheduler.threads_for("videos", job), 64)
+        self.assertEqual(scheduler.threads_for("photos", job), 1)
+
+    def test_concurrency_limit(self):
+        scheduler = ResourceScheduler(16, {"archives": CostClass(3, max_concurrent=2)})
+        started = self.start_all(scheduler, [("archives", f"archive-{i}") for i in range(5)])
+        self.assertEqual(len(started), 2)
+        scheduler.release("archives")
+        self.assertEqual(self.start_all(scheduler, [("archives", "archive-5")]), ["archive-5"])
+
+    def test_big_job_is_not_starved(self):
+        scheduler = ResourceScheduler(4)
+        scheduler.acquire("photos")
+        pending = [("videos", "video")] + [("photos", f"photo-{i}") for i in range(20)]
+        # Photos overtake the waiting video at most cpu_budget times
+        overtaken = 0
+        while True:
+            index = scheduler.pick(pending)
+            if index is None:
+                break
+            family, job = pending.pop(index)
+            self.assertEqual(family, "photos")
+            overtaken += 1
+            scheduler.acquire(family)
+            scheduler.release(family)
+        self.assertEqual(overtaken, 4)
+        scheduler.release("photos")
+        self.assertEqual(pending[scheduler.pick(pending)], ("videos", "video"))
+
+
+class TestCancellation(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), "test_files")
+        self.converter = FileConverter()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_timeout_kills_external_tool(self):
+        self.converter.cancel_token = CancellationToken(timeout=0.5)
+        start = time.monotonic()
+        with self.assertRaises(ConversionTimeout):
+            self.converter._run_process([sys.executable, "-c", "import time; time.sleep(30)"])
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_cancelled_token_stops_conversion(self):
+        token = CancellationToken()
+        token.cancel()
+        output_path = os.path.join(self.temp_dir.name, "output.png")
+        with self.assertRaises(ConversionCancelled):
+            self.converter.convert_file(
+                os.path.join(self.test_files_dir, "input.jpg"),
+                output_path,
+                "png",
+                cancel_token=token,
+            )
+        self.assertFalse(os.path.exists(output_path))
+
+    def test_engine_cancel_drops_queued_jobs(self):
+        jobs = [
+            ConversionJob(
+                os.path.join(self.test_files_dir, "input.jpg"),
+                os.path.join(self.temp_dir.name, f"output-{i}.png"),
+                "png",
+            )
+            for i in range(5)
+        ]
+        engine = ConversionEngine(max_workers=1)
+        results = engine.run(jobs, on_result=lambda result: engine.cancel())
+        self.assertTrue(engine.cancelled)
+        self.assertEqual(len(results), 1)
+        self.assertFalse(os.path.exists(jobs[-1].output_path))
+
+    def test_pool_reports_queued_jobs_it_never_started(self):
+        jobs = [
+            ConversionJob(
+                os.path.join(self.test_files_dir, "input.jpg"),
+                os.path.join(self.temp_dir.name, f"output-{i}.png"),
+                "png",
+            )
+            for i in range(6)
+        ]
+        queued = []
+        engine = ConversionEngine(max_workers=2)
+        results = engine.run(
+            jobs,
+            on_result=lambda result: engine.cancel(),
+            on_event=lambda event: event.kind == "queued" and queued.append(event.job_id),
+        )
+        self.assertEqual(sorted(result.job.job_id for result in results), sorted(queued))
+        self.assertIn("cancelled", [result.status for result in results])
+
+    def test_family_timeouts(self):
+        engine = ConversionEngine(timeouts={"videos": 60}, default_timeout=5)
+        video_job = ConversionJob("clip.mp4", "clip.mkv", "mkv")
+        photo_job = ConversionJob("photo.jpg", "photo.png", "png")
+        explicit_job = ConversionJob("clip.mp4", "clip.webm", "webm", timeout=1)
+        self.assertEqual(engine.job_timeout(video_job), 60)
+        self.assertEqual(engine.job_timeout(photo_job), 5)
+        self.assertEqual(engine.job_timeout(explicit_job), 1)
+
+
+class TestPhotoConversion(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.converter = FileConverter()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def temp_path(self, name):
+        return os.path.join(self.temp_dir.name, name)
+
+    def make_image(self, name, mode="RGB", size=(640, 480), **save_kwargs):
+        image = Image.effect_mandelbrot(size, (-2, -1.5, 1, 1.5), 64).convert(mode)
+        path = self.temp_path(name)
+        image.save(path, **save_kwargs)
+        return path
+
+    def assertSamePixels(self, path, expected):
+        with Image.open(path) as converted:
+            self.assertEqual(converted.size, expected.size)
+            self.assertEqual(converted.mode, expected.mode)
+            diff = ImageChops.difference(converted, expected)
+            self.assertIsNone(diff.getbbox())
+
+    def test_strips_match_whole_image_conversion(self):
+        # Uncompressed TIFF with many strips, and a bottom-up BMP
+        sources = [
+            self.make_image("strips.tiff", tiffinfo={278: 16}),
+            self.make_image("rgba.tiff", mode="RGBA"),
+            self.make_image("image.bmp"),
+        ]
+        progress = []
+        for source in sources:
+            for target_format in ("png", "tiff", "bmp"):
+                if source.endswith(target_format):
+                    continue
+                with Image.open(source) as image:
+                    expected = photos.prepare_for_target(image.copy(), target_format)
+                output_path = self.temp_path(f"{os.path.basename(source)}.{target_format}")
+                self.converter.convert_file(
+                    source,
+                    output_path,
+                    target_format,
+                    progress_callback=progress.append,
+                    options={"memory_budget": 64 * 1024},
+                )
+                self.assertSamePixels(output_path, expected)
+        # Progress is reported once per strip
+        self.assertGreater(len(progress), 10)
+
+    def test_compressed_input_uses_whole_image_path(self):
+        source = self.make_image("deflate.tiff", compression="tiff_deflate")
+        output_path = self.temp_path("deflate.png")
+        progress = []
+        self.converter.convert_file(
+            source,
+            output_path,
+            "png",
+            progress_callback=progress.append,
+            options={"memory_budget": 64 * 1024},
+        )
+        self.assertEqual(progress, [])
+        with Image.open(source) as image:
+            self.assertSamePixels(output_path, image)
+
+    def test_resize_options(self):
+        source = self.make_image("photo.jpg", size=(1600, 1200), quality=90)
+        for options, size in (
+            ({"max_size": 400}, (400, 300)),
+            ({"max_size": 4000}, (1600, 1200)),
+            ({"scale": 0.25}, (400, 300)),
+            ({"thumbnail": 128}, (128, 128)),
+        ):
+            output_path = self.temp_path("resized.webp")
+            self.converter.convert_file(source, output_path, "webp", options=options)
+            with Image.open(output_path) as converted:
+                self.assertEqual(converted.size, size)
+        with self.assertRaises(ValueError):
+            self.converter.convert_file(
+                source, output_path, "png", options={"max_size": 400, "scale": 0.5}
+            )
+
+    def test_encoder_presets(self):
+        source = self.make_image("photo.bmp")
+        sizes = {}
+        for preset in ("fast", "balanced", "small"):
+            output_path = self.temp_path(f"{preset}.png")
+            self.converter.convert_file(source, output_path, "png", options={"preset": preset})
+            sizes[preset] = os.path.getsize(output_path)
+            with Image.open(source) as image:
+                self.assertSamePixels(output_path, image)
+        self.assertGreater(sizes["fast"], sizes["small"])
+
+        output_path = self.temp_path("photo.jpg")
+        self.converter.convert_file(
+            source,
+            output_path,
+            "jpg",
+            options={"preset": "small", "encoder_options": {"jpeg": {"progressive": False}}},
+        )
+        with Image.open(output_path) as converted:
+            self.assertNotIn("progressive", converted.info)
+        self.converter.convert_file(source, output_path, "jpg", options={"preset": "small"})
+        with Image.open(output_path) as converted:
+            self.assertIn("progressive", converted.info)
+        with self.assertRaises(ValueError):
+            self.converter.convert_file(source, output_path, "jpg", options={"preset": "tiny"})
+
+    def test_modes_are_kept_when_the_target_supports_them(self):
+        rgba = self.make_image("rgba.png", mode="RGBA")
+        with Image.open(rgba) as image:
+            image.putalpha(Image.linear_gradient("L").resize(image.size))
+            image.save(rgba)
+        gray16 = self.temp_path("gray16.png")
+        Image.new("I;16", (64, 64), 32768).save(gray16)
+        palette = self.temp_path("palette.gif")
+        gradient = Image.linear_gradient("L")
+        colors = Image.merge("RGB", (gradient, gradient.rotate(90), gradient.rotate(180)))
+        colors.convert("P", palette=Image.Palette.ADAPTIVE).save(palette)
+        for source, target_format, mode in (
+            (rgba, "webp", "RGBA"),
+            (rgba, "tiff", "RGBA"),
+            (rgba, "jpg", "RGB"),
+            (gray16, "tiff", "I;16"),
+            (palette, "png", "P"),
+            (palette, "jpg", "RGB"),
+        ):
+            output_path = self.temp_path(f"output.{target_format}")
+            self.converter.convert_file(source, output_path, target_format)
+            with Image.open(output_path) as converted:
+                self.assertEqual(converted.mode, mode, (source, target_format))
+        # 16-bit samples are scaled down to 8 bits, not clipped
+        self.converter.convert_file(gray16, self.temp_path("gray.jpg"), "jpg")
+        with Image.open(self.temp_path("gray.jpg")) as converted:
+            self.assertEqual(converted.mode, "L")
+            self.assertAlmostEqual(converted.getpixel((0, 0)), 128, delta=2)
+
+    def test_32_bit_samples_are_scaled_not_clipped(self):
+        # A gradient from 0 to 255 million, far past what 16 bits hold
+        gray32 = self.temp_path("gray32.tiff")
+        Image.linear_gradient("L").convert("I").point(lambda value: value * 1000000).save(gray32)
+        with Image.open(gray32) as image:
+            self.assertEqual(image.mode, "I")
+        self.converter.convert_file(gray32, self.temp_path("gray16.png"), "png")
+        with Image.open(self.temp_path("gray16.png")) as converted:
+            self.assertIn(converted.mode, ("I;16", "I"))
+            self.assertEqual(converted.getextrema(), (0, 65535))
+        self.converter.convert_file(gray32, self.temp_path("gray8.jpg"), "jpg")
+        with Image.open(self.temp_path("gray8.jpg")) as converted:
+            self.assertEqual(converted.mode, "L")
+            low, high = converted.getextrema()
+            self.assertLessEqual(low, 2)
+            self.assertGreaterEqual(high, 253)
+            self.assertAlmostEqual(converted.getpixel((0, 128)), 128, delta=3)
+
+    def test_flatten_onto_white(self):
+        image = Image.new("LA", (4, 4), (0, 0))
+        flattened = photos.prepare_for_target(image, "jpg")
+        self.assertEqual(flattened.mode, "L")
+        self.assertEqual(flattened.getpixel((0, 0)), 255)
+        image = Image.new("RGBA", (4, 4), (255, 0, 0, 255))
+        self.assertEqual(photos.prepare_for_target(image, "bmp").getpixel((0, 0)), (255, 0, 0))
+        self.assertIs(photos.prepare_for_target(image, "png"), image)
+
+    def make_animation(self, name, count=8, **save_kwargs):
+        frames = []
+        for index in range(count):
+            frame = Image.new("RGBA", (96, 64), (0, 0, 0, 0))
+            frame.paste((255, 64, 0, 255), (index * 8, 8, index * 8 + 24, 40))
+            # Partial transparency, without which WebP may drop the alpha channel
+            frame.putpixel((95, 63), (0, 0, 0, 192))
+            frames.append(frame)
+        path = self.temp_path(name)
+        frames[0].save(path, save_all=True, append_images=frames[1:], **save_kwargs)
+        return path, frames
+
+    def test_animations_keep_every_frame(self):
+        durations = [40 + 10 * index for index in range(8)]
+        gif, frames = self.make_animation("anim.gif", duration=durations, loop=2, disposal=2)
+        webp, _frames = self.make_animation("anim.webp", duration=durations, loop=0)
+        progress = []
+        for source, target_format, loop in (
+            (gif, "webp", 2),
+            (webp, "gif", 0),
+            (gif, "tiff", None),
+        ):
+            output_path = self.temp_path(f"output.{target_format}")
+            self.converter.convert_file(
+                source, output_path, target_format, progress_callback=progress.append
+            )
+            with Image.open(output_path) as converted:
+                self.assertEqual(converted.n_frames, len(frames))
+                self.assertEqual(converted.info.get("loop"), loop)
+                for index, frame in enumerate(ImageSequence.Iterator(converted)):
+                    frame.load()
+                    if target_format != "tiff":
+                        self.assertEqual(frame.info["duration"], durations[index])
+                    # Transparent areas stay transparent, without trails of earlier frames
+                    alpha = frame.convert("RGBA").getchannel("A").point(lambda a: 255 * (a > 127))
+                    expected = frames[index].getchannel("A").point(lambda a: 255 * (a > 127))
+                    self.assertIsNone(ImageChops.difference(alpha, expected).getbbox())
+        self.assertEqual(progress[-1], 1)
+
+    def test_several_targets_share_one_decode(self):
+        source = self.make_image("photo.jpg", quality=90)
+        targets = ["png", "webp", "tiff", "jpeg"]
+        outputs = [(target, self.temp_path(f"many.{target}")) for target in targets]
+        events = []
+        progress = []
+        self.converter.convert_file_to_many(
+            source,
+            outputs,
+            progress.append,
+            options={"max_size": 320},
+            event_callback=lambda stage, seconds, tool: events.append(stage),
+        )
+        self.assertEqual(events.count("decode"), 1)
+        self.assertEqual(progress[-1], 1.0)
+        for target, output_path in outputs[:3]:
+            single_path = self.temp_path(f"single.{target}")
+            self.converter.convert_file(source, single_path, target, options={"max_size": 320})
+            with Image.open(single_path) as expected:
+                expected.load()
+                self.assertSamePixels(output_path, expected)
+        # A name of the source's own format is still a copy
+        with open(source, "rb") as a, open(outputs[3][1], "rb") as b:
+            self.assertNotEqual(a.read(), b.read())
+        self.converter.convert_file_to_many(
+            source, [("png", outputs[0][1]), ("jpeg", outputs[3][1])]
+        )
+        with open(source, "rb") as a, open(outputs[3][1], "rb") as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_alias_conversion_copies_bytes(self):
+        source = self.make_image("photo.jpg", quality=90)
+        with open(source, "rb") as f:
+            original = f.read()
+        events = []
+        output_path = self.temp_path("photo.jpeg")
+        self.converter.convert_file(
+            source, output_path, "jpeg", event_callback=lambda *event: events.append(event)
+        )
+        with open(output_path, "rb") as f:
+            self.assertEqual(f.read(), original)
+        self.assertEqual(events[0][0], "write")
+        self.assertIn(events[0][2], ("reflink", "copy_file_range", "copy"))
+
+        self.converter.convert_file(
+            source, output_path, "jpeg", options={"passthrough": "hardlink"}
+        )
+        self.assertTrue(os.path.samefile(source, output_path))
+
+        for options in ({"reencode": True}, {"max_size": 100}):
+            self.converter.convert_file(source, output_path, "jpeg", options=options)
+            with open(output_path, "rb") as f:
+                self.assertNotEqual(f.read(), original)
+            # The hardlinked input is left alone
+            with open(source, "rb") as f:
+                self.assertEqual(f.read(), original)
+
+        self.converter.convert_file(source, output_path, "jpeg", options={"passthrough": "rename"})
+        self.assertFalse(os.path.exists(source))
+        with open(output_path, "rb") as f:
+            self.assertEqual(f.read(), original)
+
+    def test_oversized_input_is_reduced_in_strips(self):
+        source = self.make_image("large.tiff", size=(1200, 900))
+        progress = []
+        output_path = self.temp_path("large.jpg")
+        self.converter.convert_file(
+            source,
+            output_path,
+            "jpg",
+            progress_callback=progress.append,
+            options={"memory_budget": 256 * 1024, "max_size": 100},
+        )
+        self.assertGreater(len(progress), 1)
+        with Image.open(source) as image:
+            expected = image.reduce(4).resize((100, 75), Image.Resampling.LANCZOS)
+        with Image.open(output_path) as converted:
+            self.assertEqual(converted.size, (100, 75))
+            diff = ImageChops.difference(converted.convert("RGB"), expected)
+            # Only JPEG's own loss separates the two
+            self.assertLess(max(high for low, high in diff.getextrema()), 64)
+
+
+class TestVideoConversion(unittest.TestCase):
+    PROBE = {
+        "streams": [
+            {"index": 0, "codec_type": "video", "codec_name": "h264"},
+            {"index": 1, "codec_type": "audio", "codec_name": "aac"},
+            {
+                "index": 2,
+                "codec_type": "video",
+                "codec_name": "mjpeg",
+                "disposition": {"attached_pic": 1},
+            },
+        ]
+    }
+
+    def test_compatible_streams_are_copied(self):
+        plan = video.stream_plan(self.PROBE, "mkv")
+        self.assertEqual(plan, [(0, "video", "copy"), (1, "audio", "copy")])
+        self.assertTrue(video.is_remux(plan))
+
+    def test_incompatible_streams_are_transcoded(self):
+        self.assertEqual(
+            video.stream_plan(self.PROBE, "webm"), [(0, "video", None), (1, "audio", None)]
+        )
+        probe = {"streams": [dict(self.PROBE["streams"][0]), self.PROBE["streams"][1]]}
+        probe["streams"][0]["codec_name"] = "vp9"
+        plan = video.stream_plan(probe, "mov")
+        self.assertEqual(plan, [(0, "video", None), (1, "audio", "copy")])
+        self.assertFalse(video.is_remux(plan))
+        plan = video.stream_plan(self.PROBE, "mkv", reencode=True)
+        self.assertEqual(plan, [(0, "video", "libx264"), (1, "audio", "libvorbis")])
+
+    def test_extra_audio_and_subtitles_are_kept(self):
+        probe = {
+            "streams": self.PROBE["streams"]
+            + [
+                {"index": 3, "codec_type": "audio", "codec_name": "ac3"},
+                {"index": 4, "codec_type": "subtitle", "codec_name": "subrip"},
+                {"index": 5, "codec_type": "subtitle", "codec_name": "hdmv_pgs_subtitle"},
+            ]
+        }
+        plan = video.stream_plan(probe, "mkv")
+        self.assertEqual(
+            plan,
+            [
+                (0, "video", "copy"),
+                (1, "audio", "copy"),
+                (3, "audio", "copy"),
+                (4, "subtitle", "copy"),
+                (5, "subtitle", "copy"),
+            ],
+        )
+        # mp4 converts text subtitles and has no place for bitmap ones
+        plan = video.stream_plan(probe, "mp4")
+        self.assertEqual(plan[3:], [(4, "subtitle", "mov_text")])
+        self.assertEqual([stream["index"] for stream in video.dropped_streams(probe, plan)], [2, 5])
+        concat = video.concat_command("list.txt", "in.mkv", "out.mp4", "mp4", plan)
+        self.assertEqual(concat[concat.index("-c:3") + 1], "mov_text")
+
+    def test_video_profiles(self):
+        probe = {"streams": [dict(stream) for stream in self.PROBE["streams"]]}
+        probe["streams"][0].update(width=3840, height=2160)
+        settings = video.profile_settings("mkv", {"video_profile": "preview"})
+        # Too tall for the profile, so the video is encoded even though mkv holds h264
+        plan = video.stream_plan(probe, "mkv", settings=settings)
+        self.assertEqual(plan, [(0, "video", "libx264"), (1, "audio", "copy")])
+        self.assertEqual(video.scaled_height(probe["streams"][0], settings), 720)
+        self.assertEqual(
+            video.encoder_options("video", settings, 0), {"preset:0": "ultrafast", "crf:0": 28}
+        )
+        self.assertEqual(video.thread_count(4, settings), 2)
+        self.assertEqual(video.thread_count(None, settings), 2)
+
+        settings = video.profile_settings("webm", {"video_profile": "archive"})
+        self.assertEqual(
+            video.stream_plan(self.PROBE, "webm", settings=settings),
+            [(0, "video", "libvpx-vp9"), (1, "audio", "libopus")],
+        )
+        self.assertEqual(video.stream_plan(self.PROBE, "mkv", settings=settings)[0][2], "copy")
+        self.assertEqual(video.thread_count(4, settings), 4)
+        self.assertEqual(video.profile_settings("mp4", {}), {})
+        custom = {"video_profile": "farm", "video_profiles": {"farm": {"mp4": {"threads": 8}}}}
+        self.assertEqual(video.profile_settings("mp4", custom), {"threads": 8})
+        with self.assertRaises(ValueError):
+            video.profile_settings("mp4", {"video_profile": "nonexistent"})
+
+    def test_progress_reader(self):
+        reader = video.ProgressReader()
+        lines = [
+            "Input #0, matroska,webm, from 'in.mkv':",
+            "frame=240",
+            "fps=48.00",
+            "stream_0_0_q=28.0",
+            "bitrate=1024.0kbits/s",
+            "total_size=1280000",
+            "out_time_us=10000000",
+            "out_time=00:00:10.000000",
+            "speed=2.5x",
+            "progress=continue",
+        ]
+        blocks = [reader.feed(line + "\n") for line in lines]
+        self.assertIsNone(blocks[0])
+        self.assertEqual(blocks[1:-1], [{}] * 8)
+        stats = video.progress_stats(blocks[-1])
+        self.assertEqual(
+            stats,
+            {
+                "out_time_us": 10000000,
+                "fps": 48.0,
+                "speed": 2.5,
+                "bitrate": 1024000.0,
+                "total_size": 1280000,
+            },
+        )
+        progress = video.encode_progress(stats, 40.0)
+        self.assertEqual(progress, 0.25)
+        self.assertEqual(progress.eta, 12.0)
+        self.assertEqual(progress.fps, 48.0)
+
+        first = video.progress_stats({"out_time_us": "N/A", "bitrate": "N/A", "speed": "N/A"})
+        self.assertEqual(first["out_time_us"], 0)
+        self.assertIsNone(first["speed"])
+        self.assertIsNone(video.encode_progress(first, 40.0).eta)
+        combined = video.combine_stats([stats, stats])
+        self.assertEqual(combined["out_time_us"], 20000000)
+        self.assertEqual(combined["speed"], 5.0)
+        self.assertEqual(combined["bitrate"], 1024000.0)
+        self.assertEqual(video.progress_args(0.25)[-2:], ["-stats_period", "0.25"])
+
+    def test_segment_commands(self):
+        self.assertEqual(video.segment_count(3600, 16), 16)
+        self.assertEqual(video.segment_count(95, 16), 3)
+        self.assertEqual(video.segment_count(20, 16), 1)
+        self.assertEqual(video.segment_count(3600, None), 1)
+        plan = video.stream_plan(self.PROBE, "webm")
+        self.assertTrue(video.can_segment(plan))
+        self.assertFalse(video.can_segment(video.stream_plan(self.PROBE, "mkv")))
+
+        split = video.split_command("in.mp4", 0, 225.0, "pieces")
+        self.assertIn("segment", split)
+        self.assertEqual(split[split.index("-c") + 1], "copy")
+        piece = video.segment_command("split0000.mkv", "part0000.webm", "webm", None, 4)
+        self.assertEqual(piece[piece.index("-f") + 1], "webm")
+        self.assertEqual(piece[piece.index("-threads") + 1], "4")
+        concat = video.concat_command("list.txt", "in.mp4", "out.webm", "webm", plan)
+        self.assertEqual(
+            concat[: concat.index("list.txt")], ["ffmpeg", "-f", "concat", "-safe", "0", "-i"]
+        )
+        self.assertEqual(concat[concat.index("-c:v") + 1], "copy")
+        self.assertIn("1:1", concat)
+        self.assertEqual(video.concat_list(["/tmp/it's.webm"]), "file '/tmp/it'\\''s.webm'\n")
+
+
+class TestAudioConversion(unittest.TestCase):
+    def test_output_options(self):
+        self.assertEqual(audio.output_options("aac", {}), {"format": "adts", "c:a": "aac"})
+        options = {"encoder_options": {"mp3": {"bitrate": "192k", "sample_rate": 44100, "q:a": 2}}}
+        self.assertEqual(
+            audio.output_options("mp3", options),
+            {"format": "mp3", "b:a": "192k", "ar": 44100, "q:a": 2},
+        )
+        self.assertEqual(audio.output_options("ogg", options), {"format": "ogg"})
+        self.assertEqual(audio.duration({"format": {"duration": "61.5"}}), 61.5)
+        self.assertEqual(audio.duration({"format": {"duration": "N/A"}}), 0)
+        self.assertEqual(audio.duration({}), 0)
+
+    def test_native_targets(self):
+        self.assertTrue(audio.can_convert_natively("wav", "flac", {}))
+        self.assertFalse(audio.can_convert_natively("mp3", "wav", {}))
+        self.assertFalse(audio.can_convert_natively("wav", "aac", {}))
+        options = {"encoder_options": {"flac": {"sample_rate": 22050}}}
+        self.assertFalse(audio.can_convert_natively("wav", "flac", options))
+        self.assertEqual(audio.native_subtype("flac", "PCM_24"), "PCM_24")
+        self.assertEqual(audio.native_subtype("flac", "FLOAT"), "PCM_24")
+        self.assertEqual(audio.native_subtype("wav", "VORBIS"), "PCM_16")
+        self.assertEqual(audio.native_subtype("ogg", "PCM_16"), "VORBIS")
+
+    @unittest.skipUnless(importlib.util.find_spec("soundfile"), "soundfile is not installed")
+    def test_native_fan_out(self):
+        import soundfile
+
+        test_files_dir = os.path.join(os.path.dirname(__file__), "test_files")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            outputs = [
+                (target, os.path.join(temp_dir, f"output.{target}")) for target in ("flac", "ogg")
+            ]
+            events = []
+            FileConverter().convert_file_to_many(
+                os.path.join(test_files_dir, "input.wav"),
+                outputs,
+                event_callback=lambda stage, seconds, tool: events.append((stage, tool)),
+            )
+            self.assertEqual(events, [("encode", "libsndfile")])
+            self.assertEqual(soundfile.info(outputs[0][1]).format, "FLAC")
+            self.assertEqual(soundfile.info(outputs[1][1]).subtype, "VORBIS")
+
+    @unittest.skipUnless(importlib.util.find_spec("soundfile"), "soundfile is not installed")
+    def test_native_round_trip(self):
+        import soundfile
+
+        test_files_dir = os.path.join(os.path.dirname(__file__), "test_files")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            converter = FileConverter()
+            flac_path = os.path.join(temp_dir, "output.flac")
+            wav_path = os.path.join(temp_dir, "output.wav")
+            events = []
+            converter.convert_file(
+                os.path.join(test_files_dir, "input.wav"),
+                flac_path,
+                "flac",
+                event_callback=lambda stage, seconds, tool: events.append((stage, tool)),
+            )
+            self.assertEqual(events, [("encode", "libsndfile")])
+            converter.convert_file(flac_path, wav_path, "wav")
+            original, rate = soundfile.read(
+                os.path.join(test_files_dir, "input.wav"), dtype="int16"
+            )
+            converted, converted_rate = soundfile.read(wav_path, dtype="int16")
+            self.assertEqual(rate, converted_rate)
+            self.assertEqual(original.tolist(), converted.tolist())
+
+    @unittest.skipUnless(importlib.util.find_spec("soundfile"), "soundfile is not installed")
+    def test_unwritable_native_target_falls_back_to_ffmpeg(self):
+        import numpy
+        import soundfile
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # FLAC takes at most eight channels
+            wav_path = os.path.join(temp_dir, "nine.wav")
+            soundfile.write(wav_path, numpy.zeros((1000, 9), dtype="int16"), 44100)
+            flac_path = os.path.join(temp_dir, "nine.flac")
+            commands = []
+            converter = FileConverter()
+            converter._probe = lambda path: {"format": {"duration": "1"}}
+            converter._run_ffmpeg = lambda cmd, *args, **kwargs: commands.append(cmd)
+            converter._convert_audio(wav_path, flac_path, "flac")
+            self.assertEqual(len(commands), 1)
+            self.assertIn(flac_path, commands[0])
+            self.assertFalse(os.path.exists(flac_path))
+
+
+class TestConversionEvents(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), "test_files")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def make_job(self, input_name, target_format):
+        return ConversionJob(
+            os.path.join(self.test_files_dir, input_name),
+            os.path.join(self.temp_dir.name, f"output.{target_format}"),
+            target_format,
+        )
+
+    def test_job_and_stage_events(self):
+        events = []
+        ConversionEngine(max_workers=1).run(
+            [self.make_job("input.jpg", "png")], on_event=events.append
+        )
+        self.assertEqual(
+            [event.kind for event in events], ["queued", "started", "decode", "encode", "finished"]
+        )
+        finished = events[-1]
+        self.assertEqual(finished.family, "photos")
+        self.assertEqual(finished.source_format, "jpg")
+        self.assertGreater(finished.bytes_in, 0)
+        self.assertGreater(finished.bytes_out, 0)
+        self.assertEqual(events[2].tool, "pillow")
+
+    def test_failed_event(self):
+        events = []
+        ConversionEngine(max_workers=1).run(
+            [self.make_job("non-existent.jpg", "png")], on_event=events.append
+        )
+        self.assertEqual(events[-1].kind, "failed")
+        self.assertEqual(events[-1].status, "failed")
+        self.assertTrue(events[-1].error)
+
+    def test_sinks(self):
+        events_path = os.path.join(self.temp_dir.name, "events.jsonl")
+        metrics_path = os.path.join(self.temp_dir.name, "metrics.prom")
+        json_sink = JsonLinesSink(events_path)
+        prometheus_sink = PrometheusSink(metrics_path)
+
+        def on_event(event):
+            json_sink(event)
+            prometheus_sink(event)
+
+        jobs = [self.make_job("input.jpg", "png"), self.make_job("input.bmp", "webp")]
+        ConversionEngine(max_workers=2).run(jobs, on_event=on_event)
+        json_sink.close()
+        prometheus_sink.close()
+
+        with open(events_path) as f:
+            kinds = [json.loads(line)["kind"] for line in f]
+        self.assertEqual(kinds.count("finished"), 2)
+        with open(metrics_path) as f:
+            metrics = f.read()
+        self.assertIn('files_converter_jobs_total{family="photos",source="jpg",', metrics)
+        self.assertIn('files_converter_job_seconds_count{family="photos"} 2', metrics)
+        self.assertIn('stage="encode",tool="pillow"', metrics)
+
+    def test_metrics_file_is_readable_and_tolerates_unknown_formats(self):
+        metrics_path = os.path.join(self.temp_dir.name, "metrics.prom")
+        sink = PrometheusSink(metrics_path)
+        sink(ConversionEvent("failed", 1, "notes.xyz", None, "png", None, status="failed"))
+        sink(ConversionEvent("finished", 2, "a.jpg", "jpg", "png", "photos", seconds=0.1))
+        sink.close()
+        self.assertEqual(os.stat(metrics_path).st_mode & 0o777, 0o644)
+        with open(metrics_path) as f:
+            self.assertIn(
+                'family="unknown",source="unknown",status="failed",target="png"', f.read()
+            )
+
+
+class TestConversionCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), "test_files")
+        self.cache = ConversionCache(os.path.join(self.temp_dir.name, "cache"))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def make_job(self, input_name, target_format, output_name, **options):
+        return ConversionJob(
+            os.path.join(self.test_files_dir, input_name),
+            os.path.join(self.temp_dir.name, output_name),
+            target_format,
+            options=options,
+        )
+
+    def test_repeated_conversion_is_served_from_cache(self):
+        engine = ConversionEngine(max_workers=1, cache=self.cache)
+        first = engine.run([self.make_job("input.png", "webp", "first.webp")])[0]
+        second = engine.run([self.make_job("input.png", "webp", "second.webp")])[0]
+        self.assertFalse(first.cached)
+        self.assertTrue(second.cached)
+        with open(first.job.output_path, "rb") as a, open(second.job.output_path, "rb") as b:
+            self.assertEqual(a.read(), b.read())
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_key_depends_on_target_and_options(self):
+        input_path = os.path.join(self.test_files_dir, "input.png")
+        keys = {
+            self.cache.make_key(input_path, "webp"),
+            self.cache.make_key(input_path, "jpg"),
+            self.cache.make_key(input_path, "webp", {"quality": 50}),
+        }
+        self.assertEqual(len(keys), 3)
+
+    def test_key_depends_on_source_format(self):
+        # The same bytes as .txt and .rtf are converted differently
+        text_path = os.path.join(self.temp_dir.name, "notes.txt")
+        rtf_path = os.path.join(self.temp_dir.name, "notes.rtf")
+        for path in (text_path, rtf_path):
+            with open(path, "w") as f:
+                f.write("{\\rtf1 notes}")
+        self.assertNotEqual(
+            self.cache.make_key(text_path, "docx"), self.cache.make_key(rtf_path, "docx")
+        )
+
+    def test_bypass(self):
+        engine = ConversionEngine(max_workers=1, cache=self.cache)
+        engine.run([self.make_job("input.png", "webp", "first.webp")])
+        result = engine.run([self.make_job("input.png", "webp", "again.webp", no_cache=True)])[0]
+        self.assertIsNone(result.cached)
+        self.assertTrue(os.path.exists(result.job.output_path))
+
+    def test_lru_eviction(self):
+        engine = ConversionEngine(max_workers=1, cache=self.cache)
+        engine.run([self.make_job("input.png", "webp", "a.webp")])
+        engine.run([self.make_job("input.jpg", "webp", "b.webp")])
+        self.cache.max_size = os.path.getsize(os.path.join(self.temp_dir.name, "b.webp"))
+        remaining = self.cache.prune()
+        self.assertLessEqual(remaining, self.cache.max_size)
+        self.assertEqual(self.cache.evictions, 1)
+        # The most recently used entry survives
+        result = engine.run([self.make_job("input.jpg", "webp", "c.webp")])[0]
+        self.assertTrue(result.cached)
+
+    def test_store_evicts_as_the_cache_grows(self):
+        output_path = os.path.join(self.temp_dir.name, "output.bin")
+        with open(output_path, "wb") as f:
+            f.write(b"\0" * 1000)
+        self.cache.max_size = 3000
+        for index in range(10):
+            self.assertTrue(self.cache.store(f"{index:064x}", output_path))
+            self.assertLessEqual(self.cache.size(), self.cache.max_size)
+        self.assertEqual(self.cache.evictions, 7)
+
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "clip.mp4")
+        with open(self.path, "wb") as f:
+            f.write(b"\0" * 100)
+        self.cache_path = os.path.join(self.temp_dir.name, "metadata.json")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def seed(self, cache):
+        entry = dict(cache.info(self.path), probe={"format": {"duration": "12.5"}})
+        cache.merge(os.path.abspath(self.path), entry)
+
+    def test_lookups_are_shared_until_the_file_changes(self):
+        cache = MetadataCache()
+        self.assertEqual(cache.size(self.path), 100)
+        self.assertEqual(cache.info(self.path)["mime_type"], "video/mp4")
+        self.seed(cache)
+        # Known already, so no ffprobe is run
+        self.assertTrue(cache.has_probe(self.path))
+        self.assertEqual(cache.probe(self.path)["format"]["duration"], "12.5")
+        self.assertEqual(cache.probes, 0)
+
+        with open(self.path, "ab") as f:
+            f.write(b"\0")
+        self.assertEqual(cache.size(self.path), 101)
+        self.assertFalse(cache.has_probe(self.path))
+
+    def test_entries_persist(self):
+        cache = MetadataCache(self.cache_path)
+        self.seed(cache)
+        cache.save()
+        reloaded = MetadataCache(self.cache_path)
+        self.assertTrue(reloaded.has_probe(self.path))
+        # Handed to worker processes with the entries, without the file
+        copy = pickle.loads(pickle.dumps(reloaded))
+        self.assertIsNone(copy.path)
+        self.assertTrue(copy.has_probe(self.path))
+
+    def test_worker_probes_reach_the_engine(self):
+        worker_cache = MetadataCache()
+        engine = ConversionEngine(max_workers=2, metadata=MetadataCache())
+        updates = queue.Queue()
+        worker_cache.on_probe = lambda path, entry: updates.put(("metadata", path, entry))
+        self.seed(worker_cache)
+        worker_cache.on_probe(os.path.abspath(self.path), worker_cache.info(self.path))
+        updates.put(None)
+        engine._forward_updates(updates, None, None, engine.metadata)
+        self.assertTrue(engine.metadata.has_probe(self.path))
+
+
+# Stands in for `inkscape --shell`: exports write the input's bytes to the output, and
+# the process id, so tests can tell shells apart
+FAKE_INKSCAPE_SHELL = """
+import os, sys
+sys.stdout.write("Inkscape interactive shell mode.\\n> ")
+sys.stdout.flush()
+for line in sys.stdin:
+    actions = dict(
+        (action.strip().split(":", 1) + [""])[:2] for action in line.split(";") if action.strip()
+    )
+    if "quit" in actions:
+        break
+    if "sleep" in actions:
+        import time
+        time.sleep(float(actions["sleep"]))
+    if os.path.exists(actions.get("file-open", "")):
+        with open(actions["export-filename"], "w") as f:
+            f.write(actions["export-type"] + " " + str(os.getpid()))
+    else:
+        sys.stdout.write("Failed to open\\n")
+    sys.stdout.write("> ")
+    sys.stdout.flush()
+"""
+
+
+class TestInkscapeShells(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        script = os.path.join(self.temp_dir.name, "inkscape_shell.py")
+        with open(script, "w") as f:
+            f.write(FAKE_INKSCAPE_SHELL)
+        self.command = [sys.executable, script]
+        self.input_path = os.path.join(self.temp_dir.name, "icon.svg")
+        with open(self.input_path, "w") as f:
+            f.write("<svg/>")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def output(self, name):
+        path = os.path.join(self.temp_dir.name, name)
+        with open(path) as f:
+            return f.read().split()
+
+    def test_shells_are_reused_then_recycled(self):
+        pool = inkscape.InkscapePool(max_shells=1, max_jobs=2, command=self.command)
+        try:
+            for index in range(3):
+                output_path = os.path.join(self.temp_dir.name, f"icon{index}.png")
+                pool.convert(self.input_path, output_path, "png")
+            self.assertEqual(self.output("icon0.png")[0], "png")
+            self.assertEqual(self.output("icon0.png"), self.output("icon1.png"))
+            self.assertNotEqual(self.output("icon1.png"), self.output("icon2.png"))
+            self.assertEqual(pool.started, 2)
+        finally:
+            pool.close()
+
+    def test_failed_file_replaces_its_shell(self):
+        pool = inkscape.InkscapePool(command=self.command)
+        try:
+            missing = os.path.join(self.temp_dir.name, "missing.svg")
+            with self.assertRaisesRegex(RuntimeError, "Failed to open"):
+                pool.convert(missing, os.path.join(self.temp_dir.name, "missing.eps"), "eps")
+            pool.convert(self.input_path, os.path.join(self.temp_dir.name, "icon.eps"), "eps")
+            self.assertEqual(pool.started, 2)
+        finally:
+            pool.close()
+
+    def test_cancelling_kills_the_shell(self):
+        pool = inkscape.InkscapePool(command=self.command)
+        token = CancellationToken(timeout=0.5)
+        try:
+            with pool.shell(token) as shell:
+                with self.assertRaises(ConversionTimeout):
+                    shell.run(["sleep:30"], token)
+                self.assertFalse(shell.alive)
+        finally:
+            pool.close()
+
+    def test_idle_shells_are_closed(self):
+        pool = inkscape.InkscapePool(command=self.command, idle_timeout=0.2)
+        try:
+            with pool.shell() as shell:
+                pass
+            self.assertTrue(shell.alive)
+            deadline = time.monotonic() + 5
+            while shell.alive and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertFalse(shell.alive)
+            # A later file starts a fresh shell
+            pool.convert(self.input_path, os.path.join(self.temp_dir.name, "icon.png"), "png")
+            self.assertEqual(pool.started, 2)
+        finally:
+            pool.close()
+
+    def test_worker_processes_close_their_shells_on_exit(self):
+        src_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+        code = (
+            "import concurrent.futures, multiprocessing, sys\n"
+            "from files_converter import inkscape\n"
+            "def start(command):\n"
+            "    pool = inkscape.shared_pool()\n"
+            "    pool.command = command\n"
+            "    with pool.shell() as shell:\n"
+            "        return shell.process.pid\n"
+            "if __name__ == '__main__':\n"
+            "    context = multiprocessing.get_context('fork')\n"
+            "    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:\n"
+            "        print(executor.submit(start, sys.argv[1:]).result())\n"
+        )
+        env = dict(os.environ, PYTHONPATH=src_dir)
+        output = subprocess.run(
+            [sys.executable, "-c", code] + self.command,
+            env=env,
+            capture_output=True,
+            text=True,
+            timeout=60,
+        )
+        pid = int(output.stdout)
+        # Closed by the worker on its way out, rather than left for stdin to close
+        with self.assertRaises(ProcessLookupError):
+            os.kill(pid, 0)
+
+    def test_paths_that_cannot_be_given_to_a_shell(self):
+        self.assertTrue(inkscape.can_use_shell("/tmp/a b.svg", "/tmp/a b.png"))
+        self.assertFalse(inkscape.can_use_shell("/tmp/a;b.svg", "/tmp/a.png"))
+        self.assertIn("--export-type=eps", inkscape.export_command("a.svg", "a.eps", "eps"))
+
+
+class TestWatchDaemon(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), "test_files")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_parse_rule(self):
+        rule = ConversionRule.parse("*.PNG=webp")
+        self.assertEqual(rule.target_format, "webp")
+        self.assertTrue(rule.matches("/photos/holiday.png"))
+        self.assertFalse(rule.matches("/photos/holiday.jpg"))
+        self.assertEqual(ConversionRule.parse("*.mov -> mp4").target_format, "mp4")
+        with self.assertRaises(ValueError):
+            ConversionRule.parse("*.mov")
+
+    def test_converts_new_files(self):
+        watched_dir = os.path.join(self.temp_dir.name, "watched")
+        os.makedirs(watched_dir)
+        results = []
+        done = threading.Event()
+
+        def on_result(result):
+            results.append(result)
+            done.set()
+
+        daemon = WatchDaemon(
+            [watched_dir],
+            [ConversionRule.parse("*.png=webp")],
+            engine=ConversionEngine(max_workers=1),
+            debounce=0.2,
+            on_result=on_result,
+        )
+        thread = threading.Thread(target=daemon.run, daemon=True)
+        thread.start()
+        time.sleep(0.2)
+
+        # Files in new subdirectories are picked up too; non-matching files are ignored
+        os.makedirs(os.path.join(watched_dir, "sub"))
+        time.sleep(0.2)
+        shutil.copy(os.path.join(self.test_files_dir, "input.jpg"), watched_dir)
+        shutil.copy(
+            os.path.join(self.test_files_dir, "input.png"), os.path.join(watched_dir, "sub")
+        )
+
+        self.assertTrue(done.wait(10))
+        daemon.stop()
+        thread.join(5)
+
+        self.assertEqual(len(results), 1)
+        self.assertTrue(results[0].success, results[0].error)
+        self.assertTrue(os.path.exists(os.path.join(watched_dir, "sub", "input.webp")))
+        self.assertFalse(os.path.exists(os.path.join(watched_dir, "input.webp")))
+
+    def test_engine_is_flushed_while_running(self):
+        # The engine's run never returns while watching, so the daemon prunes the cache
+        # and saves metadata itself
+        watched_dir = os.path.join(self.temp_dir.name, "watched")
+        os.makedirs(watched_dir)
+        engine = ConversionEngine(max_workers=1)
+        flushed = threading.Event()
+        engine.flush = flushed.set
+        daemon = WatchDaemon(
+            [watched_dir], [ConversionRule.parse("*.png=webp")], engine=engine, debounce=0.2
+        )
+        watcher_module = sys.modules[WatchDaemon.__module__]
+        with unittest.mock.patch.object(watcher_module, "FLUSH_EVERY_JOBS", 1):
+            thread = threading.Thread(target=daemon.run, daemon=True)
+            thread.start()
+            time.sleep(0.2)
+            shutil.copy(os.path.join(self.test_files_dir, "input.png"), watched_dir)
+            self.assertTrue(flushed.wait(10))
+            daemon.stop()
+            thread.join(5)
+
+    def test_full_queue_does_not_spin(self):
+        watched_dir = os.path.join(self.temp_dir.name, "watched")
+        os.makedirs(watched_dir)
+        started = threading.Event()
+        release = threading.Event()
+
+        class StalledEngine:
+            def run(self, jobs, on_result=None, on_event=None):
+                started.set()
+                release.wait()
+                for job in jobs:
+                    pass
+
+            def flush(self):
+                pass
+
+        daemon = WatchDaemon(
+            [watched_dir],
+            [ConversionRule.parse("*.png=webp")],
+            engine=StalledEngine(),
+            debounce=0.1,
+            queue_size=1,
+        )
+        thread = threading.Thread(target=daemon.run, daemon=True)
+        thread.start()
+        self.assertTrue(started.wait(5))
+        for i in range(3):
+            shutil.copy(
+                os.path.join(self.test_files_dir, "input.png"),
+                os.path.join(watched_dir, f"input-{i}.png"),
+            )
+        time.sleep(0.5)
+        cpu_start = time.process_time()
+        time.sleep(2)
+        self.assertLess(time.process_time() - cpu_start, 1.0)
+        release.set()
+        daemon.stop()
+        thread.join(5)
+
+    def test_outputs_never_replace_watched_files(self):
+        watched_dir = os.path.join(self.temp_dir.name, "watched")
+        os.makedirs(watched_dir)
+        results = []
+        skipped = []
+        converted = threading.Event()
+        daemon = WatchDaemon(
+            [watched_dir],
+            [
+                ConversionRule.parse("*.png=jpg"),
+                ConversionRule.parse("*.jpg=png"),
+                ConversionRule.parse("*.bmp=webp"),
+            ],
+            engine=ConversionEngine(max_workers=1),
+            debounce=0.2,
+            on_result=lambda result: (results.append(result), converted.set()),
+            on_skip=lambda input_path, target_format, output_path, reason: skipped.append(
+                (os.path.basename(input_path), reason)
+            ),
+        )
+        thread = threading.Thread(target=daemon.run, daemon=True)
+        thread.start()
+        time.sleep(0.2)
+
+        # Each of these is the other's output
+        shutil.copy(os.path.join(self.test_files_dir, "input.png"), watched_dir)
+        shutil.copy(os.path.join(self.test_files_dir, "input.jpg"), watched_dir)
+        # A file changed again may replace the output made from it before
+        bmp_path = os.path.join(watched_dir, "input.bmp")
+        shutil.copy(os.path.join(self.test_files_dir, "input.bmp"), bmp_path)
+        self.assertTrue(converted.wait(10))
+        converted.clear()
+        shutil.copy(os.path.join(self.test_files_dir, "input.bmp"), bmp_path)
+        self.assertTrue(converted.wait(10))
+        daemon.stop()
+        thread.join(5)
+
+        self.assertEqual(sorted(name for name, _reason in skipped), ["input.jpg", "input.png"])
+        for _name, reason in skipped:
+            self.assertIn("input file", reason)
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertTrue(result.success, result.error)
+            self.assertEqual(result.job.input_path, bmp_path)
+        with open(os.path.join(self.test_files_dir, "input.jpg"), "rb") as f:
+            with open(os.path.join(watched_dir, "input.jpg"), "rb") as g:
+                self.assertEqual(f.read(), g.read())
+
+
+class TestCommandLine(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.test_files_dir = os.path.join(os.path.dirname(__file__), "test_files")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def run_cli(self, *argv):
+        stream = io.StringIO()
+        cache_dir = os.path.join(self.temp_dir.name, "cache")
+        exit_code = cli.main(list(argv) + ["--cache-dir", cache_dir], stream=stream)
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        return exit_code, records
+
+    def test_convert_reports_results_and_totals(self):
+        exit_code, records = self.run_cli(
+            "convert",
+            "--to",
+            "webp",
+            "--jobs",
+            "2",
+            "-o",
+            self.temp_dir.name,
+            os.path.join(self.test_files_dir, "input.png"),
+            os.path.join(self.test_files_dir, "input.mp3"),
+        )
+        self.assertEqual(exit_code, 0)
+        statuses = {os.path.basename(r["input"]): r["status"] for r in records if "input" in r}
+        self.assertEqual(statuses, {"input.png": "ok", "input.mp3": "skipped"})
+        summary = records[-1]["summary"]
+        self.assertEqual(summary["succeeded"], 1)
+        self.assertEqual(summary["failed"], 0)
+        self.assertIn("files_per_second", summary)
+        self.assertIn("mb_per_second", summary)
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir.name, "input.webp")))
+
+    def test_failures_set_exit_code(self):
+        broken_path = os.path.join(self.temp_dir.name, "broken.jpg")
+        with open(broken_path, "w") as f:
+            f.write("not an image")
+        exit_code, records = self.run_cli("convert", "--to", "png", broken_path)
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(records[0]["status"], "failed")
+        self.assertEqual(records[-1]["summary"]["failed"], 1)
+
+    def test_photo_options(self):
+        exit_code, records = self.run_cli(
+            "convert",
+            "--to",
+            "jpg",
+            "--max-size",
+            "32",
+            "--preset",
+            "fast",
+            "--encoder-option",
+            "jpg.quality=50",
+            "-o",
+            self.temp_dir.name,
+            os.path.join(self.test_files_dir, "input.png"),
+        )
+        self.assertEqual(exit_code, 0)
+        with Image.open(os.path.join(self.temp_dir.name, "input.jpg")) as converted:
+            self.assertLessEqual(max(converted.size), 32)
+        self.assertEqual(
+            cli.parse_encoder_options(["jpg.quality=50", "webp.lossless=true"]),
+            {"jpeg": {"quality": 50}, "webp": {"lossless": True}},
+        )
+        exit_code, records = self.run_cli(
+            "convert", "--to", "jpg", "--encoder-option", "quality", self.test_files_dir
+        )
+        self.assertEqual(exit_code, 2)
+
+    def test_several_targets(self):
+        exit_code, records = self.run_cli(
+            "convert",
+            "--to",
+            "webp,PNG,.tiff",
+            "-o",
+            self.temp_dir.name,
+            os.path.join(self.test_files_dir, "input.jpg"),
+            os.path.join(self.test_files_dir, "input.mp3"),
+        )
+        self.assertEqual(exit_code, 0)
+        results = [record for record in records if record.get("status") == "ok"]
+        self.assertEqual(len(results), 1)
+        self.assertEqual(
+            [output["target"] for output in results[0]["outputs"]], ["webp", "png", "tiff"]
+        )
+        for output in results[0]["outputs"]:
+            self.assertTrue(os.path.exists(output["output"]))
+        skipped = [record for record in records if record.get("status") == "skipped"]
+        self.assertEqual(len(skipped), 3)
+
+    def test_outputs_never_replace_inputs_or_each_other(self):
+        folder = os.path.join(self.temp_dir.name, "photos")
+        for subfolder in ("a", "b"):
+            os.makedirs(os.path.join(folder, subfolder))
+            shutil.copy(
+                os.path.join(self.test_files_dir, "input.png"), os.path.join(folder, subfolder)
+            )
+        shutil.copy(os.path.join(self.test_files_dir, "input.jpg"), os.path.join(folder, "a"))
+        with open(os.path.join(folder, "a", "input.jpg"), "rb") as f:
+            original = f.read()
+        output_dir = os.path.join(self.temp_dir.name, "out")
+
+        # a/input.png -> a/input.jpg would replace the other input
+        exit_code, records = self.run_cli("convert", "--to", "jpg", "--overwrite", folder)
+        self.assertEqual(exit_code, 0)
+        with open(os.path.join(folder, "a", "input.jpg"), "rb") as f:
+            self.assertEqual(f.read(), original)
+        refused = [r for r in records if r.get("status") == "skipped" and "error" in r]
+        self.assertEqual([r["output"] for r in refused], [os.path.join(folder, "a", "input.jpg")])
+
+        # Both input.png files map to out/input.webp
+        inputs = [os.path.join(folder, subfolder, "input.png") for subfolder in ("a", "b")]
+        exit_code, records = self.run_cli("convert", "--to", "webp", "-o", output_dir, *inputs)
+        self.assertEqual(exit_code, 0)
+        self.assertEqual([r["status"] for r in records if "input" in r], ["skipped", "ok"])
+
+        # out/input.webp exists now, so only --overwrite replaces it
+        exit_code, records = self.run_cli("convert", "--to", "webp", "-o", output_dir, inputs[0])
+        self.assertEqual(records[-1]["summary"]["files"], 0)
+        exit_code, records = self.run_cli(
+            "convert", "--to", "webp", "--overwrite", "-o", output_dir, inputs[0]
+        )
+        self.assertEqual(records[-1]["summary"]["succeeded"], 1)
+
+    def test_several_targets_never_collide(self):
+        folder = os.path.join(self.temp_dir.name, "photos")
+        os.makedirs(folder)
+        for name in ("input.png", "input.jpg"):
+            shutil.copy(os.path.join(self.test_files_dir, name), folder)
+        with open(os.path.join(folder, "input.jpg"), "rb") as f:
+            original = f.read()
+
+        exit_code, records = self.run_cli("convert", "--to", "webp,jpg", folder)
+        self.assertEqual(exit_code, 0)
+        with open(os.path.join(folder, "input.jpg"), "rb") as f:
+            self.assertEqual(f.read(), original)
+        written = [
+            output["output"]
+            for record in records
+            if record.get("status") == "ok"
+            for output in record.get("outputs", [record])
+        ]
+        self.assertEqual(written, [os.path.join(folder, "input.webp")])
+
+    def test_cli_does_not_import_gtk(self):
+        src_dir = os.path.join(os.path.dirname(__file__), "..", "src")
+        code = "import sys, files_converter.cli; sys.exit('gi' in sys.modules)"
+        env = dict(os.environ, PYTHONPATH=os.path.abspath(src_dir))
+        self.assertEqual(subprocess.run([sys.executable, "-c", code], env=env).returncode, 0)
+
+
 if __name__ == "__main__":
     unittest.main()